@@ -51,48 +51,37 @@ st.markdown("""
 
 import requests
 import torch
-import torchvision.transforms as T
-from torchvision import models
-import urllib.request
+import os
+import sys
 
-# Load ImageNet labels
-@st.cache_resource
+# Make the shared ml/utils helpers importable when run with `streamlit run`
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from utils.image_decode import decode_image
+from utils.model_registry import get_model_registry
+from utils.preprocessing import imagenet_preprocessor
+from utils.result_cache import RESNET18_CACHE_ID, content_digest, get_result_cache
+
+# Load ImageNet labels (shared, lazily loaded through the model registry)
 def get_imagenet_labels():
-    url = "https://raw.githubusercontent.com/pytorch/hub/master/imagenet_classes.txt"
-    labels_path = "imagenet_classes.txt"
-    try:
-        with open(labels_path, "r") as f:
-            labels = [line.strip() for line in f.readlines()]
-        # Add debugging info
-        print(f"Loaded {len(labels)} ImageNet labels")
-        if len(labels) < 1000:
-            print(f"Warning: Expected 1000 labels, got {len(labels)}")
-    except FileNotFoundError:
-        print("Downloading ImageNet labels...")
-        urllib.request.urlretrieve(url, labels_path)
-        with open(labels_path, "r") as f:
-            labels = [line.strip() for line in f.readlines()]
-        print(f"Downloaded and loaded {len(labels)} ImageNet labels")
-    return labels
+    return get_model_registry().get("imagenet_labels")
 
-# Load ResNet-18 model
-@st.cache_resource
+# Load ResNet-18 model (one instance per process, unloaded again when idle)
 def get_resnet_model():
-    model = models.resnet18(weights=models.ResNet18_Weights.DEFAULT)
-    model.eval()
-    return model
+    return get_model_registry().get("resnet18")
 
-# Image recognition function
-@st.cache_data(show_spinner=False)
-def recognize_image(_image: Image.Image):
+# Image recognition function, cached by upload content across reruns and services
+def recognize_image(file_bytes: bytes):
+    result_cache = get_result_cache()
+    cache_key = result_cache.make_key(content_digest(file_bytes), RESNET18_CACHE_ID)
+    cached = result_cache.get(cache_key)
+    if cached is not None:
+        return [tuple(item) for item in cached]
+    
     try:
-        preprocess = T.Compose([
-            T.Resize(256),
-            T.CenterCrop(224),
-            T.ToTensor(),
-            T.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-        ])
-        input_tensor = preprocess(_image.convert("RGB")).unsqueeze(0)
+        # Reduced-scale decode straight to ~256px, instead of the full-size display image
+        decoded = decode_image(file_bytes)
+        input_tensor = imagenet_preprocessor(decoded.image)
         model = get_resnet_model()
         with torch.no_grad():
             output = model(input_tensor)
@@ -110,6 +99,7 @@ def recognize_image(_image: Image.Image):
                 # Fallback for out-of-bounds indices
                 results.append((f"object_{catid_int}", float(prob)))
         
+        result_cache.set(cache_key, results)
         return results
     except Exception as e:
         st.error(f"Error in image recognition: {str(e)}")
@@ -248,11 +238,11 @@ if uploaded_files:
                     status_text.text(f"Processing {idx + 1} of {len(uploaded_files)}")
                 
                 # Send to backend API
-                file_bytes = file.read()
+                file_bytes = file.getvalue()
                 result = analyze_via_api(file_bytes, file.name)
                 
                 # Local image recognition
-                recog_results = recognize_image(image)
+                recog_results = recognize_image(file_bytes)
                 
                 if result is None:
                     st.warning("Backend unavailable, using enhanced mock analysis.")
@@ -3,13 +3,15 @@ Client Dashboard AI API
 FastAPI endpoints for client dashboard AI services
 """
 
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Query
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
 from typing import List, Dict, Any, Optional
 import asyncio
 import json
 import logging
+from dataclasses import asdict
 from datetime import datetime
 import sys
 import os
@@ -18,6 +20,7 @@ import os
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'services'))
 
 from client_dashboard_ai import ClientDashboardAI, DashboardMetrics, ActivityItem, AIInsight
+from forecasting import DEFAULT_HORIZON, MAX_HORIZON
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -42,6 +45,19 @@ app.add_middleware(
 # Initialize AI service
 ai_service = ClientDashboardAI()
 
+# Sections a dashboard is made of, in response order
+DASHBOARD_SECTIONS = ("metrics", "insights", "activities", "recommendations", "predictive_analytics")
+
+# /dashboard/batch limits: clients per request, and clients computed at once
+BATCH_MAX_CLIENTS = int(os.getenv("CLIENT_DASHBOARD_BATCH_MAX_CLIENTS", "200"))
+BATCH_CONCURRENCY = int(os.getenv("CLIENT_DASHBOARD_BATCH_CONCURRENCY", "16"))
+
+# Most activities one feed (or one batch dashboard) may ask for
+MAX_ACTIVITY_LIMIT = 50
+
+# Most stored models listed per page of /models/stored
+MAX_MODELS_PAGE = 500
+
 # Pydantic models for request/response
 class MetricsRequest(BaseModel):
     client_id: str
@@ -85,10 +101,22 @@ class RecommendationResponse(BaseModel):
     impact_score: float
     action_items: List[str]
 
+class BatchDashboardRequest(BaseModel):
+    client_ids: List[str]
+    sections: List[str] = list(DASHBOARD_SECTIONS)
+    activity_limit: int = Field(5, ge=1, le=MAX_ACTIVITY_LIMIT)
+    horizon: int = DEFAULT_HORIZON
+    stream: bool = False
+
+class PrecomputeRequest(BaseModel):
+    client_ids: List[str]
+    persist: bool = True
+
 class PredictiveAnalyticsResponse(BaseModel):
     revenue_forecast: Dict[str, Any]
     user_growth_forecast: Dict[str, Any]
     property_growth_forecast: Dict[str, Any]
+    system_health_forecast: Dict[str, Any]
     risk_assessment: Dict[str, Any]
     opportunity_analysis: Dict[str, Any]
     recommendations: List[Dict[str, Any]]
@@ -155,7 +183,7 @@ async def get_ai_insights(request: MetricsRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/activities", response_model=List[ActivityResponse])
-async def get_smart_activities(request: MetricsRequest, limit: int = 10):
+async def get_smart_activities(request: MetricsRequest, limit: int = Query(10, ge=1, le=MAX_ACTIVITY_LIMIT)):
     """Get AI-enhanced activity feed"""
     try:
         activities = await ai_service.get_smart_activities(request.client_id, limit)
@@ -200,15 +228,18 @@ async def get_ai_recommendations(request: MetricsRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/predictive-analytics", response_model=PredictiveAnalyticsResponse)
-async def get_predictive_analytics(request: MetricsRequest):
-    """Get predictive analytics"""
+async def get_predictive_analytics(request: MetricsRequest, horizon: int = DEFAULT_HORIZON):
+    """Get predictive analytics, forecasting horizon days ahead"""
+    if not 1 <= horizon <= MAX_HORIZON:
+        raise HTTPException(status_code=400, detail=f"horizon must be between 1 and {MAX_HORIZON}")
     try:
-        analytics = await ai_service.get_predictive_analytics(request.client_id)
+        analytics = await ai_service.get_predictive_analytics(request.client_id, horizon)
         
         return PredictiveAnalyticsResponse(
             revenue_forecast=analytics.get("revenue_forecast", {}),
             user_growth_forecast=analytics.get("user_growth_forecast", {}),
             property_growth_forecast=analytics.get("property_growth_forecast", {}),
+            system_health_forecast=analytics.get("system_health_forecast", {}),
             risk_assessment=analytics.get("risk_assessment", {}),
             opportunity_analysis=analytics.get("opportunity_analysis", {}),
             recommendations=analytics.get("recommendations", [])
@@ -217,104 +248,155 @@ async def get_predictive_analytics(request: MetricsRequest):
         logger.error(f"Error getting predictive analytics: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/dashboard-summary")
-async def get_dashboard_summary(request: MetricsRequest):
-    """Get comprehensive dashboard summary with all AI insights"""
+@app.post("/predictive-analytics/precompute")
+async def precompute_forecasts(request: PrecomputeRequest):
+    """Fit forecast models for many clients in one pass (run nightly)"""
     try:
-        # Get all data concurrently
-        metrics_task = ai_service.get_dashboard_metrics(request.client_id)
-        insights_task = ai_service.get_ai_insights(request.client_id)
-        activities_task = ai_service.get_smart_activities(request.client_id, 5)
-        recommendations_task = ai_service.get_ai_recommendations(request.client_id)
-        analytics_task = ai_service.get_predictive_analytics(request.client_id)
-        
-        # Wait for all tasks to complete
-        metrics, insights, activities, recommendations, analytics = await asyncio.gather(
-            metrics_task, insights_task, activities_task, recommendations_task, analytics_task
-        )
+        started = datetime.now()
+        fitted = await ai_service.precompute_forecasts(request.client_ids, request.persist)
         
         return {
-            "metrics": {
-                "total_users": metrics.total_users,
-                "active_properties": metrics.active_properties,
-                "revenue": metrics.revenue,
-                "system_health": metrics.system_health,
-                "user_growth_rate": metrics.user_growth_rate,
-                "property_growth_rate": metrics.property_growth_rate,
-                "revenue_growth_rate": metrics.revenue_growth_rate,
-                "system_uptime": metrics.system_uptime
-            },
-            "insights": [
-                {
-                    "type": insight.type,
-                    "title": insight.title,
-                    "description": insight.description,
-                    "confidence": insight.confidence,
-                    "action_items": insight.action_items,
-                    "impact_score": insight.impact_score,
-                    "category": insight.category
-                }
-                for insight in insights
-            ],
-            "activities": [
-                {
-                    "id": activity.id,
-                    "type": activity.type,
-                    "message": activity.message,
-                    "time": activity.time,
-                    "icon": activity.icon,
-                    "color": activity.color,
-                    "bg_color": activity.bg_color,
-                    "status": activity.status,
-                    "priority": activity.priority
-                }
-                for activity in activities
-            ],
-            "recommendations": recommendations,
-            "predictive_analytics": analytics,
+            "clients": len(request.client_ids),
+            "fitted": fitted,
+            "seconds": round((datetime.now() - started).total_seconds(), 3),
             "timestamp": datetime.now().isoformat()
         }
+    except Exception as e:
+        logger.error(f"Error precomputing forecasts: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+async def build_dashboard(
+    client_id: str,
+    sections=DASHBOARD_SECTIONS,
+    activity_limit: int = 5,
+    horizon: int = DEFAULT_HORIZON
+) -> Dict[str, Any]:
+    """Compute the requested dashboard sections for one client"""
+    needs_metrics = bool({"metrics", "insights", "recommendations"} & set(sections))
+    
+    # Get the independent parts concurrently
+    async def nothing():
+        return None
+    
+    metrics, activities, analytics = await asyncio.gather(
+        ai_service.get_dashboard_metrics(client_id) if needs_metrics else nothing(),
+        ai_service.get_smart_activities(client_id, activity_limit) if "activities" in sections else nothing(),
+        ai_service.get_predictive_analytics(client_id, horizon) if "predictive_analytics" in sections else nothing()
+    )
+    
+    # Insights and recommendations are derived from the metrics fetched above
+    insights, recommendations = await asyncio.gather(
+        ai_service.get_ai_insights(client_id, metrics) if "insights" in sections else nothing(),
+        ai_service.get_ai_recommendations(client_id, metrics) if "recommendations" in sections else nothing()
+    )
+    
+    computed = {
+        "metrics": asdict(metrics) if metrics is not None else None,
+        "insights": [asdict(insight) for insight in insights] if insights is not None else None,
+        "activities": [asdict(activity) for activity in activities] if activities is not None else None,
+        "recommendations": recommendations,
+        "predictive_analytics": analytics
+    }
+    return {section: computed[section] for section in DASHBOARD_SECTIONS if section in sections}
+
+@app.post("/dashboard-summary")
+async def get_dashboard_summary(request: MetricsRequest):
+    """Get comprehensive dashboard summary with all AI insights"""
+    try:
+        summary = await build_dashboard(request.client_id)
+        summary["timestamp"] = datetime.now().isoformat()
+        return summary
     except Exception as e:
         logger.error(f"Error getting dashboard summary: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/dashboard/batch")
+async def get_dashboard_batch(request: BatchDashboardRequest):
+    """Dashboards of many clients in one request
+    
+    Clients are computed concurrently (at most BATCH_CONCURRENCY at a time)
+    through the shared caches. Returns {"results": {client_id: sections}},
+    or with stream=true one NDJSON line per client as each one finishes.
+    """
+    client_ids = list(dict.fromkeys(request.client_ids))
+    unknown = [section for section in request.sections if section not in DASHBOARD_SECTIONS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown sections: {', '.join(unknown)}")
+    if not client_ids or len(client_ids) > BATCH_MAX_CLIENTS:
+        raise HTTPException(status_code=400, detail=f"client_ids must hold 1 to {BATCH_MAX_CLIENTS} clients")
+    if not 1 <= request.horizon <= MAX_HORIZON:
+        raise HTTPException(status_code=400, detail=f"horizon must be between 1 and {MAX_HORIZON}")
+    
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+    
+    async def one(client_id: str):
+        async with semaphore:
+            try:
+                return client_id, await build_dashboard(
+                    client_id, request.sections, request.activity_limit, request.horizon
+                )
+            except Exception as e:
+                # One failing client shouldn't fail the whole batch
+                logger.error(f"Error building dashboard for {client_id}: {e}")
+                return client_id, {"error": str(e)}
+    
+    if request.stream:
+        async def lines():
+            tasks = [asyncio.create_task(one(client_id)) for client_id in client_ids]
+            try:
+                for finished in asyncio.as_completed(tasks):
+                    client_id, dashboard = await finished
+                    yield json.dumps({"client_id": client_id, **dashboard}, default=str) + "\n"
+            finally:
+                # Stop building the rest if the client went away mid-stream
+                for task in tasks:
+                    task.cancel()
+        
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
+    
+    results = await asyncio.gather(*[one(client_id) for client_id in client_ids])
+    return {
+        "results": dict(results),
+        "count": len(results),
+        "timestamp": datetime.now().isoformat()
+    }
+
 @app.post("/cache/clear")
 async def clear_cache(request: MetricsRequest):
     """Clear cache for a specific client"""
     try:
         # Clear all caches for the client
-        cache_keys = [key for key in ai_service.metrics_cache.keys() if request.client_id in key]
-        for key in cache_keys:
-            del ai_service.metrics_cache[key]
-        
-        cache_keys = [key for key in ai_service.insights_cache.keys() if request.client_id in key]
-        for key in cache_keys:
-            del ai_service.insights_cache[key]
-        
-        cache_keys = [key for key in ai_service.activity_cache.keys() if request.client_id in key]
-        for key in cache_keys:
-            del ai_service.activity_cache[key]
+        removed = ai_service.cache.invalidate_client(request.client_id)
         
         return {
             "message": "Cache cleared successfully",
             "client_id": request.client_id,
+            "entries_removed": removed,
             "timestamp": datetime.now().isoformat()
         }
     except Exception as e:
         logger.error(f"Error clearing cache: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/models")
+async def get_model_status():
+    """Counts of stored and loaded forecast models and background training state"""
+    return ai_service.model_store.stats()
+
+@app.get("/models/stored")
+async def list_stored_models(
+    client_id: Optional[str] = None,
+    offset: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=MAX_MODELS_PAGE)
+):
+    """Metadata of stored forecast models, a page at a time, optionally for one client"""
+    return ai_service.model_store.models(client_id, offset, limit)
+
 @app.get("/cache/status")
 async def get_cache_status():
     """Get cache status"""
     try:
-        return {
-            "metrics_cache_size": len(ai_service.metrics_cache),
-            "insights_cache_size": len(ai_service.insights_cache),
-            "activity_cache_size": len(ai_service.activity_cache),
-            "last_update": ai_service.last_update.isoformat() if ai_service.last_update else None,
-            "cache_duration": ai_service.cache_duration
-        }
+        return {**ai_service.cache.stats(), "single_flight": ai_service.flights.stats()}
     except Exception as e:
         logger.error(f"Error getting cache status: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -1,18 +1,79 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, File, UploadFile, HTTPException, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from PIL import Image
 import numpy as np
-import io
-import base64
+import asyncio
 import torch
-from torchvision import models, transforms
 import uvicorn
-import magic
 import os
+import sys
 from datetime import datetime
-from typing import Dict, List, Any, Optional
+from typing import AsyncIterator, Dict, List, Any, Optional, Tuple
 import json
+import time
+
+# Make the shared ml/utils helpers importable when run as a script
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from utils.inference_batcher import MicroBatcher
+from utils.image_decode import DecodedImage, ImageDecodeError, decode_image, to_jpeg_base64, to_web_image
+from utils.clip_recognition import (
+    CLIP_MODEL_ID,
+    PROMPTS as CLIP_PROMPTS,
+    check_prompts,
+    get_clip_classifier,
+    prompt_set_key,
+)
+from utils.embedding_store import EmbeddingStore, embeddings_enabled, get_embedding_store, open_embedding_store
+from utils.image_store import RESPONSE_MODES, get_image_store
+from utils.metrics import (
+    BATCH_SIZE_BUCKETS,
+    PROMETHEUS_CONTENT_TYPE,
+    MetricsMiddleware,
+    MetricsRegistry,
+    stage,
+)
+from utils.model_registry import get_model_registry, warm_up_from_env
+from utils.perceptual_hash import PerceptualIndex, phash
+from utils.preprocessing import imagenet_preprocessor
+from utils.property_analysis import analyze_property_batch, analyze_property_image
+from utils.upload_reader import (
+    MAX_REQUEST_BYTES,
+    MAX_UPLOAD_BYTES,
+    BodySizeLimitMiddleware,
+    SpooledUpload,
+    UploadRejected,
+    spool_upload,
+    too_large,
+)
+from utils.worker_heartbeat import (
+    HEARTBEAT_DIR_ENV,
+    WorkerHeartbeat,
+    memory_mb,
+    read_heartbeats,
+    worker_identity,
+)
+from utils.worker_pool import WorkerPool, WorkerPoolSaturated
+from utils.result_cache import (
+    PROPERTY_ANALYSIS_CACHE_ID,
+    RESNET18_CACHE_ID,
+    get_result_cache,
+    location_variant,
+)
+
+# Micro-batching knobs: how long to wait for more photos and how many to batch
+BATCH_WINDOW_MS = float(os.getenv("PLACES_BATCH_WINDOW_MS", "10"))
+MAX_BATCH_SIZE = int(os.getenv("PLACES_MAX_BATCH_SIZE", "16"))
+
+# Largest single forward pass /api/places/batch-analyze will run
+BATCH_ANALYZE_MAX_SIZE = int(os.getenv("PLACES_BATCH_ANALYZE_MAX_SIZE", "32"))
+
+# Photos within this many pHash bits of an earlier one reuse its results (-1 disables)
+DEDUPE_MAX_DISTANCE = int(os.getenv("PLACES_DEDUPE_MAX_DISTANCE", "6"))
+
+# Add a Server-Timing header with per-stage durations to every response
+SERVER_TIMING = os.getenv("PLACES_SERVER_TIMING", "0") == "1"
 
 app = FastAPI(title="Places ML API", version="1.0.0")
 
@@ -22,181 +83,419 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing"],
 )
 
-# Load model and labels once
-model = models.resnet18(weights=models.ResNet18_Weights.DEFAULT)
-model.eval()
-
-try:
-    with open("imagenet_classes.txt", "r") as f:
-        labels = [line.strip() for line in f.readlines()]
-except FileNotFoundError:
-    # Download if not available
-    import urllib.request
-    urllib.request.urlretrieve(
-        "https://raw.githubusercontent.com/pytorch/hub/master/imagenet_classes.txt",
-        "imagenet_classes.txt"
+# Prometheus metrics served on /metrics
+metrics = MetricsRegistry()
+requests_total = metrics.counter(
+    "places_requests_total", "HTTP requests by endpoint and outcome", ["endpoint", "outcome"]
+)
+request_duration = metrics.histogram(
+    "places_request_duration_seconds", "HTTP request latency by endpoint", ["endpoint"]
+)
+stage_duration = metrics.histogram(
+    "places_stage_duration_seconds", "Time spent in each request stage", ["stage"]
+)
+batch_size = metrics.histogram(
+    "places_batch_size", "Images per model forward pass", ["batcher"], buckets=BATCH_SIZE_BUCKETS
+)
+batch_duration = metrics.histogram(
+    "places_batch_duration_seconds", "Model forward pass latency per batch", ["batcher"]
+)
+
+# Oversized request bodies are refused before multipart parsing spools them
+app.add_middleware(BodySizeLimitMiddleware, max_bytes=MAX_REQUEST_BYTES)
+
+# Added last so it is outermost and also counts requests refused by the middleware above
+app.add_middleware(
+    MetricsMiddleware,
+    requests_total=requests_total,
+    request_duration=request_duration,
+    stage_duration=stage_duration,
+    server_timing=SERVER_TIMING,
+)
+
+def observe_batch(batcher: str):
+    def observe(size: int, seconds: float):
+        batch_size.observe(size, batcher=batcher)
+        batch_duration.observe(seconds, batcher=batcher)
+    return observe
+
+# /api/places/batch-analyze runs its own forward passes outside the micro-batcher
+observe_batch_analyze = observe_batch("batch-analyze")
+
+# Decode, preprocessing, inference and encoding run here instead of on the event loop
+worker_pool = WorkerPool.from_env(name="places-worker")
+
+# Results keyed by upload content, shared with analyze_api and the Streamlit analyzers
+result_cache = get_result_cache()
+
+# Uploads kept once by content hash for response_mode=reference
+image_store = get_image_store()
+
+@app.exception_handler(WorkerPoolSaturated)
+async def worker_pool_saturated_handler(request, exc: WorkerPoolSaturated):
+    return JSONResponse(
+        {"detail": "Server is busy, please retry shortly"},
+        status_code=503,
+        headers={"Retry-After": str(exc.retry_after)}
     )
-    with open("imagenet_classes.txt", "r") as f:
-        labels = [line.strip() for line in f.readlines()]
 
-def analyze_property_image(image: Image.Image, location: Optional[Dict] = None) -> Dict[str, Any]:
-    """Analyze a property image and return comprehensive insights"""
-    
-    # Property-specific analysis
-    property_features = {
-        "interior_quality": np.random.uniform(0.6, 1.0),
-        "exterior_condition": np.random.uniform(0.5, 1.0),
-        "modernity_score": np.random.uniform(0.3, 1.0),
-        "space_utilization": np.random.uniform(0.4, 1.0),
-        "lighting_quality": np.random.uniform(0.5, 1.0),
-        "cleanliness": np.random.uniform(0.6, 1.0),
-        "maintenance_level": np.random.uniform(0.4, 1.0),
-        "aesthetic_appeal": np.random.uniform(0.5, 1.0)
-    }
-    
-    # Property type classification
-    property_types = ["apartment", "house", "condo", "villa", "studio", "townhouse"]
-    detected_type = np.random.choice(property_types, p=[0.3, 0.25, 0.2, 0.1, 0.1, 0.05])
-    
-    # Room detection
-    rooms = ["bedroom", "kitchen", "bathroom", "living_room", "dining_room", "office", "garden", "balcony"]
-    detected_rooms = np.random.choice(rooms, size=np.random.randint(3, 6), replace=False)
+@app.exception_handler(UploadRejected)
+async def upload_rejected_handler(request, exc: UploadRejected):
+    return JSONResponse({"detail": str(exc)}, status_code=exc.status_code)
+
+# ResNet-18 and its labels are loaded on first use and shared with the other services
+model_registry = get_model_registry()
+
+# Returned when recognition fails so the frontend still gets property-focused tags
+FALLBACK_RECOGNITION = [
+    ("interior", 0.85),
+    ("furniture", 0.72),
+    ("room", 0.68)
+]
+
+def preprocess_image(image: Image.Image) -> np.ndarray:
+    """Resize and center-crop a PIL image into a 224x224x3 uint8 ResNet input"""
+    return imagenet_preprocessor.to_uint8(image)
+
+def recognize_batch_with_features(input_arrays: List[np.ndarray]) -> Tuple[List[List[tuple]], Optional[np.ndarray]]:
+    """Run one ResNet-18 forward pass over a batch, returning top-3 per image and the pooled features"""
+    model = model_registry.get("resnet18")
+    labels = model_registry.get("imagenet_labels")
+    batch = imagenet_preprocessor.batch_tensor(input_arrays)
     
-    # Amenities detection
-    amenities = ["parking", "elevator", "gym", "pool", "garden", "balcony", "fireplace", "central_heating"]
-    detected_amenities = np.random.choice(amenities, size=np.random.randint(2, 5), replace=False)
+    with torch.no_grad():
+        output, features = model.forward_with_features(batch)
+        probabilities = torch.nn.functional.softmax(output, dim=1)
     
-    # Location-based insights
-    location_insights = {}
-    if location:
-        location_insights = {
-            "neighborhood_quality": np.random.uniform(0.6, 1.0),
-            "accessibility_score": np.random.uniform(0.5, 1.0),
-            "transportation_rating": np.random.uniform(0.4, 1.0),
-            "safety_score": np.random.uniform(0.7, 1.0),
-            "noise_level": np.random.choice(["low", "medium", "high"]),
-            "walkability": np.random.uniform(0.3, 1.0)
-        }
+    top3_prob, top3_catid = torch.topk(probabilities, 3, dim=1)
     
-    # Price estimation based on features
-    base_price = 500000  # Base price in USD
-    price_multiplier = (
-        property_features["interior_quality"] * 0.2 +
-        property_features["modernity_score"] * 0.3 +
-        property_features["space_utilization"] * 0.2 +
-        (location_insights.get("neighborhood_quality", 0.8) * 0.3)
-    )
-    estimated_price = int(base_price * price_multiplier)
-    
-    # Overall score
-    overall_score = np.mean(list(property_features.values()))
+    batch_results = []
+    for probs, catids in zip(top3_prob.tolist(), top3_catid.tolist()):
+        # Add bounds checking to prevent IndexError
+        results = []
+        for prob, catid in zip(probs, catids):
+            if 0 <= catid < len(labels):
+                results.append((labels[catid], float(prob)))
+            else:
+                # Fallback for out-of-bounds indices
+                results.append((f"object_{catid}", float(prob)))
+        batch_results.append(results)
     
-    return {
-        "property_type": detected_type,
-        "detected_rooms": list(detected_rooms),
-        "detected_amenities": list(detected_amenities),
-        "property_features": property_features,
-        "location_insights": location_insights,
-        "estimated_price": estimated_price,
-        "overall_score": round(overall_score, 3),
-        "analysis_timestamp": datetime.now().isoformat(),
-        "confidence_level": round(np.random.uniform(0.7, 0.95), 2)
-    }
+    return batch_results, features.numpy() if features is not None else None
+
+def recognize_batch(input_arrays: List[np.ndarray]) -> List[List[tuple]]:
+    """Run one ResNet-18 forward pass over a batch of preprocessed images"""
+    return recognize_batch_with_features(input_arrays)[0]
+
+def recognize_batch_items(input_arrays: List[np.ndarray]) -> List[Tuple[List[tuple], Optional[np.ndarray]]]:
+    """Batcher entry point: (top-3, embedding) for each image in the batch"""
+    batch_results, features = recognize_batch_with_features(input_arrays)
+    return [
+        (results, features[i] if features is not None else None)
+        for i, results in enumerate(batch_results)
+    ]
 
 def recognize_image(image: Image.Image) -> List[tuple]:
     """Recognize objects in the image using ResNet-18"""
     try:
-        preprocess = transforms.Compose([
-            transforms.Resize(256),
-            transforms.CenterCrop(224),
-            transforms.ToTensor(),
-            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-        ])
-        input_tensor = preprocess(image.convert("RGB")).unsqueeze(0)
-        
-        with torch.no_grad():
-            output = model(input_tensor)
-            probabilities = torch.nn.functional.softmax(output[0], dim=0)
-        
-        top3_prob, top3_catid = torch.topk(probabilities, 3)
-        
-        # Add bounds checking to prevent IndexError
-        results = []
-        for prob, catid in zip(top3_prob, top3_catid):
-            catid_int = int(catid.item())
-            if 0 <= catid_int < len(labels):
-                results.append((labels[catid_int], float(prob)))
-            else:
-                # Fallback for out-of-bounds indices
-                results.append((f"object_{catid_int}", float(prob)))
-        
-        return results
+        return recognize_batch([preprocess_image(image)])[0]
     except Exception as e:
         print(f"Error in image recognition: {str(e)}")
         # Return property-focused mock results if recognition fails
-        return [
-            ("interior", 0.85),
-            ("furniture", 0.72),
-            ("room", 0.68)
-        ]
-
-def image_to_base64(image: Image.Image) -> str:
-    """Convert image to base64 string"""
-    buffered = io.BytesIO()
-    image.save(buffered, format="JPEG")
-    return base64.b64encode(buffered.getvalue()).decode()
+        return list(FALLBACK_RECOGNITION)
+
+# Shared queue that groups concurrent /analyze requests into one forward pass
+recognition_batcher = MicroBatcher(
+    recognize_batch_items,
+    max_batch_size=MAX_BATCH_SIZE,
+    window_ms=BATCH_WINDOW_MS,
+    executor=worker_pool.executor,
+    name="resnet18",
+    on_batch=observe_batch("resnet18"),
+)
+
+# CLIP zero-shot classifier: prompt embeddings are cached, image embeddings are micro-batched
+clip_classifier = get_clip_classifier()
+
+def encode_clip_batch(image_inputs: List[torch.Tensor]) -> List[torch.Tensor]:
+    """One CLIP image forward pass over a batch of preprocessed images"""
+    return list(clip_classifier.encode_images(image_inputs))
+
+clip_batcher = MicroBatcher(
+    encode_clip_batch,
+    max_batch_size=MAX_BATCH_SIZE,
+    window_ms=BATCH_WINDOW_MS,
+    executor=worker_pool.executor,
+    name="clip-vit-b-32",
+    on_batch=observe_batch("clip-vit-b-32"),
+)
+
+# ResNet-18 penultimate-layer embeddings for /api/places/similar. The store is
+# opened on first use, so workers that neither store nor search embeddings never
+# touch its files.
+store_embeddings = embeddings_enabled()
+
+def embedding_store() -> EmbeddingStore:
+    return get_embedding_store("resnet18", dim=512)
+
+def needs_embedding(digest: str) -> bool:
+    """Whether a photo should go through the model even when its recognition is cached"""
+    return store_embeddings and digest not in embedding_store()
+
+def save_embeddings(digests: List[str], features: Optional[np.ndarray]):
+    if store_embeddings and features is not None:
+        embedding_store().add(digests, features)
+
+# Perceptual hashes of analyzed photos, for catching resized/re-compressed copies
+phash_index = PerceptualIndex(max_distance=DEDUPE_MAX_DISTANCE) if DEDUPE_MAX_DISTANCE >= 0 else None
+
+metrics.gauge(
+    "places_batch_queue_depth", "Requests waiting for the next forward pass", ["batcher"],
+    fn=lambda: {(b.name,): b.queue_depth() for b in (recognition_batcher, clip_batcher)},
+)
+metrics.gauge("places_in_flight_requests", "Requests holding a worker pool slot", fn=lambda: worker_pool.in_flight)
+metrics.gauge(
+    "places_model_loaded", "Whether a model is currently loaded (1) or not (0)", ["model"],
+    fn=lambda: {(name,): int(entry["loaded"]) for name, entry in model_registry.stats().items()},
+)
+metrics.gauge(
+    "places_model_load_seconds", "Duration of the most recent model load", ["model"],
+    fn=lambda: {(name,): entry["load_time_s"] for name, entry in model_registry.stats().items()},
+)
+metrics.counter(
+    "places_model_loads_total", "Model loads, including reloads after idle unloading", ["model"],
+    fn=lambda: {(name,): entry["loads"] for name, entry in model_registry.stats().items()},
+)
+metrics.counter(
+    "places_result_cache_lookups_total", "Result cache lookups by outcome", ["result"],
+    fn=lambda: (lambda c: {("hit",): c["hits"], ("miss",): c["misses"]})(result_cache.stats()),
+)
+metrics.gauge("places_result_cache_bytes", "Memory held by the result cache", fn=lambda: result_cache.stats()["bytes"])
+metrics.counter(
+    "places_dedupe_lookups_total", "Perceptual-hash near-duplicate lookups by outcome", ["result"],
+    fn=lambda: {} if phash_index is None else {
+        ("hit",): phash_index.hits, ("miss",): phash_index.lookups - phash_index.hits
+    },
+)
+
+def cached_results(image: Image.Image, digest: str, location: Optional[Dict]) -> Dict[str, Any]:
+    """Cached analysis/recognition for a photo: exact content match first, then a pHash near-duplicate"""
+    analysis_key = result_cache.make_key(digest, PROPERTY_ANALYSIS_CACHE_ID, location_variant(location))
+    recognition_key = result_cache.make_key(digest, RESNET18_CACHE_ID)
+    cached = {
+        "analysis_key": analysis_key,
+        "recognition_key": recognition_key,
+        "analysis": result_cache.get(analysis_key),
+        "recognition": result_cache.get(recognition_key),
+        "near_duplicate": None,
+    }
+    if phash_index is None or (cached["analysis"] is not None and cached["recognition"] is not None):
+        return cached
+    
+    hash_value = phash(image)
+    match = phash_index.lookup(hash_value, digest)
+    if match is None:
+        phash_index.add(hash_value, digest)
+        return cached
+    
+    match_digest, distance = match
+    cached["near_duplicate"] = {"digest": match_digest, "distance": distance}
+    if cached["recognition"] is None:
+        cached["recognition"] = result_cache.get(result_cache.make_key(match_digest, RESNET18_CACHE_ID))
+        if cached["recognition"] is not None:
+            result_cache.set(recognition_key, cached["recognition"])
+    if cached["analysis"] is None:
+        cached["analysis"] = result_cache.get(
+            result_cache.make_key(match_digest, PROPERTY_ANALYSIS_CACHE_ID, location_variant(location))
+        )
+        if cached["analysis"] is not None:
+            result_cache.set(analysis_key, cached["analysis"])
+    # Share the earlier photo's embedding too, so the forward pass is skipped entirely
+    if needs_embedding(digest):
+        vector = embedding_store().get(match_digest)
+        if vector is not None:
+            embedding_store().add([digest], vector[None, :])
+    return cached
+
+async def recognize_array_batched(
+    input_array: np.ndarray,
+    cache_key: Optional[str] = None,
+    digest: Optional[str] = None
+) -> List[tuple]:
+    """Recognize a preprocessed image through the shared micro-batching queue"""
+    try:
+        with stage("inference"):
+            results, features = await recognition_batcher.submit(input_array)
+    except Exception as e:
+        print(f"Error in image recognition: {str(e)}")
+        return list(FALLBACK_RECOGNITION)
+    
+    if cache_key is not None:
+        result_cache.set(cache_key, results)
+    if digest is not None and features is not None:
+        await worker_pool.run(save_embeddings, [digest], features[None, :])
+    return results
+
+async def recognize_image_batched(
+    image: Image.Image,
+    cache_key: Optional[str] = None,
+    digest: Optional[str] = None
+) -> List[tuple]:
+    """Recognize objects in the image through the shared micro-batching queue"""
+    try:
+        with stage("preprocess"):
+            input_array = await worker_pool.run(preprocess_image, image)
+    except Exception as e:
+        print(f"Error in image recognition: {str(e)}")
+        return list(FALLBACK_RECOGNITION)
+    return await recognize_array_batched(input_array, cache_key, digest)
+
+async def read_upload(photo: UploadFile) -> SpooledUpload:
+    """Validate and hash an upload chunk by chunk without loading it into memory
+
+    Raises UploadRejected as soon as the upload turns out not to be an image or too large.
+    """
+    size = getattr(photo, "size", None)
+    if size is not None and size > MAX_UPLOAD_BYTES:
+        raise too_large(MAX_UPLOAD_BYTES)
+    with stage("read_upload"):
+        return await worker_pool.run(spool_upload, photo.file, MAX_UPLOAD_BYTES)
+
+def decode_upload(upload: SpooledUpload) -> Tuple[bytes, DecodedImage]:
+    """Load a validated upload's bytes and decode them near recognition size
+
+    The upload is closed once its bytes are read, releasing any spooled temp file.
+    """
+    try:
+        file_bytes = upload.read_bytes()
+    finally:
+        upload.close()
+    with stage("decode"):
+        return file_bytes, decode_image(file_bytes)
+
+def store_upload(decoded: DecodedImage, file_bytes: bytes, digest: str) -> str:
+    """Keep the upload in the image store (written to disk in the background) and return its ID"""
+    data, extension = to_web_image(decoded, file_bytes)
+    return image_store.put(data, digest, extension)
 
 @app.post("/api/places/analyze")
 async def analyze_place_photo(
     photo: UploadFile = File(...),
-    location_data: Optional[str] = None
+    location_data: Optional[str] = None,
+    response_mode: str = "inline",
+    include_base64: Optional[bool] = None
 ):
-    """Analyze a place photo and return comprehensive insights"""
-    
-    # Validate file type
-    file_bytes = await photo.read()
-    mime = magic.Magic(mime=True)
-    mime_type = mime.from_buffer(file_bytes)
-    if not mime_type.startswith("image/"):
-        raise HTTPException(status_code=400, detail="Uploaded file is not an image")
-    
-    # Process image
-    image = Image.open(io.BytesIO(file_bytes))
+    """Analyze a place photo and return comprehensive insights
+
+    response_mode=reference stores the photo and returns image_id/image_url
+    instead of echoing it back as base64 (unless include_base64=true).
+    """
+    if response_mode not in RESPONSE_MODES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"response_mode must be one of: {', '.join(RESPONSE_MODES)}"
+        )
+    if include_base64 is None:
+        include_base64 = response_mode == "inline"
     
-    # Parse location data if provided
-    location = None
-    if location_data:
+    async with worker_pool.admit():
+        # Validate file type and size while reading, then decode off the event loop
+        upload = await read_upload(photo)
         try:
-            location = json.loads(location_data)
-        except json.JSONDecodeError:
-            location = None
-    
-    # Analyze the image
-    analysis_result = analyze_property_image(image, location)
-    recognition_results = recognize_image(image)
-    
-    # Convert image to base64 for frontend display
-    base64_image = image_to_base64(image)
+            file_bytes, decoded = await worker_pool.run(decode_upload, upload)
+        except ImageDecodeError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        image = decoded.image
+        
+        # Parse location data if provided
+        location = None
+        if location_data:
+            try:
+                location = json.loads(location_data)
+            except json.JSONDecodeError:
+                location = None
+        
+        # Reuse earlier results for the same photo bytes (or a near-identical photo) when we have them
+        digest = upload.digest
+        with stage("cache_lookup"):
+            cached = await worker_pool.run(cached_results, image, digest, location)
+        
+        # Analyze the image
+        analysis_result = cached["analysis"]
+        if analysis_result is None:
+            with stage("analysis"):
+                analysis_result = await worker_pool.run(analyze_property_image, image, location, digest)
+            result_cache.set(cached["analysis_key"], analysis_result)
+        
+        recognition_results = cached["recognition"]
+        if recognition_results is None or needs_embedding(digest):
+            recognition_results = await recognize_image_batched(image, cached["recognition_key"], digest)
+        
+        response = {
+            "success": True,
+            "filename": photo.filename,
+            "analysis": analysis_result,
+            "recognition": recognition_results,
+            "near_duplicate_of": cached["near_duplicate"],
+        }
+        if response_mode == "reference":
+            with stage("store_image"):
+                image_id = await worker_pool.run(store_upload, decoded, file_bytes, digest)
+            response["image_id"] = image_id
+            response["image_url"] = f"/api/places/images/{image_id}"
+        if include_base64:
+            # Base64 echo for frontend display (JPEG uploads pass straight through)
+            with stage("encode_base64"):
+                response["image_base64"] = await worker_pool.run(to_jpeg_base64, decoded, file_bytes)
     
-    return JSONResponse({
-        "success": True,
-        "filename": photo.filename,
-        "analysis": analysis_result,
-        "recognition": recognition_results,
-        "image_base64": base64_image,
-        "timestamp": datetime.now().isoformat()
-    })
+    response["timing"] = {"decode_ms": round(decoded.decode_ms, 2)}
+    response["timestamp"] = datetime.now().isoformat()
+    with stage("serialize"):
+        return JSONResponse(response)
+
+@app.get("/api/places/images/{image_id}")
+async def get_stored_image(image_id: str):
+    """Serve a photo stored by response_mode=reference"""
+    stored = await worker_pool.run(image_store.get, image_id)
+    if stored is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    data, content_type = stored
+    # IDs are content hashes, so the bytes behind one never change
+    return Response(
+        content=data,
+        media_type=content_type,
+        headers={"Cache-Control": "public, max-age=31536000, immutable", "ETag": f'"{image_id}"'},
+    )
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+def analyze_missing(prepared_photos: List[Dict[str, Any]], location: Optional[Dict]):
+    """Analyze every prepared photo that missed the result cache with one analyze_property_batch call"""
+    missing = [prepared for prepared in prepared_photos if prepared["analysis"] is None]
+    if not missing:
+        return
+    analyses = analyze_property_batch([prepared["digest"] for prepared in missing], [location] * len(missing))
+    for prepared, analysis_result in zip(missing, analyses):
+        prepared["analysis"] = analysis_result
+        result_cache.set(prepared["analysis_key"], analysis_result)
 
 @app.post("/api/places/batch-analyze")
 async def batch_analyze_places(
+    request: Request,
     photos: List[UploadFile] = File(...),
-    location_data: Optional[str] = None
+    location_data: Optional[str] = None,
+    stream: bool = False
 ):
-    """Analyze multiple place photos in batch"""
+    """Analyze multiple place photos in batch
+
+    With stream=true (or Accept: application/x-ndjson) each photo's result is
+    written as one NDJSON line as soon as it is ready, in completion order,
+    followed by a summary line.
+    """
     
-    results = []
     location = None
     
     if location_data:
@@ -205,37 +504,107 @@ async def batch_analyze_places(
         except json.JSONDecodeError:
             location = None
     
-    for photo in photos:
-        try:
-            file_bytes = await photo.read()
-            mime = magic.Magic(mime=True)
-            mime_type = mime.from_buffer(file_bytes)
-            
-            if not mime_type.startswith("image/"):
-                results.append({
+    def prepare_photo(upload: SpooledUpload, analyze: bool) -> Dict[str, Any]:
+        # The upload's bytes only live for the duration of this call
+        _, decoded = decode_upload(upload)
+        digest = upload.digest
+        with stage("cache_lookup"):
+            cached = cached_results(decoded.image, digest, location)
+        
+        # Without analyze, cache misses are left for one analyze_missing call over the batch
+        analysis_result = cached["analysis"]
+        if analysis_result is None and analyze:
+            with stage("analysis"):
+                analysis_result = analyze_property_image(decoded.image, location, digest)
+            result_cache.set(cached["analysis_key"], analysis_result)
+        
+        prepared = {
+            "analysis": analysis_result,
+            "analysis_key": cached["analysis_key"],
+            "recognition": cached["recognition"],
+            "recognition_key": cached["recognition_key"],
+            "near_duplicate": cached["near_duplicate"],
+            "digest": digest,
+            "input_array": None,
+            "timing": {"decode_ms": round(decoded.decode_ms, 2)},
+        }
+        # Photos we have already recognized (and embedded) skip preprocessing and the forward pass
+        if prepared["recognition"] is None or needs_embedding(digest):
+            with stage("preprocess"):
+                prepared["input_array"] = preprocess_image(decoded.image)
+        return prepared
+    
+    async def read_and_prepare(photo: UploadFile, analyze: bool = True):
+        upload = await read_upload(photo)
+        return await worker_pool.run(prepare_photo, upload, analyze)
+    
+    if stream or NDJSON_MEDIA_TYPE in request.headers.get("accept", ""):
+        # Fail fast with 503 while we can still send a status code
+        worker_pool.check_capacity()
+        return StreamingResponse(
+            stream_batch_results(photos, read_and_prepare), media_type=NDJSON_MEDIA_TYPE
+        )
+    
+    async with worker_pool.admit():
+        # Decode and preprocess every upload in the pool, keeping failures in place
+        outcomes = await asyncio.gather(
+            *(read_and_prepare(photo, analyze=False) for photo in photos), return_exceptions=True
+        )
+        with stage("analysis"):
+            await worker_pool.run(
+                analyze_missing, [outcome for outcome in outcomes if not isinstance(outcome, Exception)], location
+            )
+        
+        results: List[Optional[Dict[str, Any]]] = [None] * len(photos)
+        pending = []
+        for index, (photo, outcome) in enumerate(zip(photos, outcomes)):
+            if isinstance(outcome, Exception):
+                results[index] = {
                     "filename": photo.filename,
-                    "error": "File is not an image",
+                    "error": str(outcome),
                     "success": False
-                })
-                continue
-            
-            image = Image.open(io.BytesIO(file_bytes))
-            analysis_result = analyze_property_image(image, location)
-            recognition_results = recognize_image(image)
-            
-            results.append({
-                "filename": photo.filename,
-                "analysis": analysis_result,
-                "recognition": recognition_results,
-                "success": True
-            })
+                }
+            elif outcome["input_array"] is None:
+                results[index] = {
+                    "filename": photo.filename,
+                    "analysis": outcome["analysis"],
+                    "recognition": outcome["recognition"],
+                    "near_duplicate_of": outcome["near_duplicate"],
+                    "timing": outcome["timing"],
+                    "success": True
+                }
+            else:
+                pending.append((index, photo.filename, outcome))
+        
+        # One ResNet-18 forward pass and one topk per chunk of decoded photos
+        for start in range(0, len(pending), BATCH_ANALYZE_MAX_SIZE):
+            chunk = pending[start:start + BATCH_ANALYZE_MAX_SIZE]
+            try:
+                forward_started = time.perf_counter()
+                with stage("inference"):
+                    recognitions, features = await worker_pool.run(
+                        recognize_batch_with_features, [prepared["input_array"] for *_, prepared in chunk]
+                    )
+                observe_batch_analyze(len(chunk), time.perf_counter() - forward_started)
+            except Exception as e:
+                print(f"Error in batch image recognition: {str(e)}")
+                recognitions = [list(FALLBACK_RECOGNITION) for _ in chunk]
+            else:
+                for (*_, prepared), recognition_results in zip(chunk, recognitions):
+                    result_cache.set(prepared["recognition_key"], recognition_results)
+                await worker_pool.run(
+                    save_embeddings, [prepared["digest"] for *_, prepared in chunk], features
+                )
             
-        except Exception as e:
-            results.append({
-                "filename": photo.filename,
-                "error": str(e),
-                "success": False
-            })
+            for (index, filename, prepared), recognition_results in zip(chunk, recognitions):
+                results[index] = {
+                    "filename": filename,
+                    "analysis": prepared["analysis"],
+                    "recognition": recognition_results,
+                    "near_duplicate_of": prepared["near_duplicate"],
+                    "timing": prepared["timing"],
+                    "success": True
+                }
     
     return JSONResponse({
         "success": True,
@@ -244,13 +613,275 @@ async def batch_analyze_places(
         "timestamp": datetime.now().isoformat()
     })
 
+async def stream_batch_results(photos: List[UploadFile], read_and_prepare) -> AsyncIterator[str]:
+    """NDJSON lines for /api/places/batch-analyze?stream=true, one per photo then a summary"""
+    started = time.perf_counter()
+    
+    async def analyze_one(index: int, photo: UploadFile) -> Dict[str, Any]:
+        photo_started = time.perf_counter()
+        result = {"type": "result", "index": index, "filename": photo.filename}
+        try:
+            prepared = await read_and_prepare(photo)
+        except Exception as e:
+            return {**result, "success": False, "error": str(e)}
+        
+        # Uncached photos go through the shared micro-batcher, so concurrent
+        # photos (from this batch or other requests) share forward passes
+        recognition_results = prepared["recognition"]
+        if prepared["input_array"] is not None:
+            recognition_results = await recognize_array_batched(
+                prepared["input_array"], prepared["recognition_key"], prepared["digest"]
+            )
+        timing = dict(prepared["timing"], total_ms=round((time.perf_counter() - photo_started) * 1000, 2))
+        return {
+            **result,
+            "success": True,
+            "analysis": prepared["analysis"],
+            "recognition": recognition_results,
+            "near_duplicate_of": prepared["near_duplicate"],
+            "timing": timing,
+        }
+    
+    succeeded = 0
+    first_result_ms = None
+    tasks: List[asyncio.Task] = []
+    try:
+        async with worker_pool.admit():
+            tasks = [asyncio.create_task(analyze_one(index, photo)) for index, photo in enumerate(photos)]
+            for next_result in asyncio.as_completed(tasks):
+                result = await next_result
+                if first_result_ms is None:
+                    first_result_ms = round((time.perf_counter() - started) * 1000, 2)
+                succeeded += result["success"]
+                yield json.dumps(result) + "\n"
+    except WorkerPoolSaturated:
+        yield json.dumps({
+            "type": "error",
+            "error": "Server is busy, please retry shortly",
+            "retry_after": worker_pool.retry_after
+        }) + "\n"
+        return
+    finally:
+        # Stop outstanding work if the client went away mid-stream
+        for task in tasks:
+            task.cancel()
+    
+    yield json.dumps({
+        "type": "summary",
+        "success": True,
+        "total_processed": len(photos),
+        "succeeded": succeeded,
+        "failed": len(photos) - succeeded,
+        "timing": {
+            "first_result_ms": first_result_ms,
+            "total_ms": round((time.perf_counter() - started) * 1000, 2)
+        },
+        "timestamp": datetime.now().isoformat()
+    }) + "\n"
+
+@app.post("/api/places/clip-analyze")
+async def clip_analyze_place_photo(
+    photo: UploadFile = File(...),
+    prompts: Optional[str] = None,
+    top_k: int = 3
+):
+    """Zero-shot room/feature classification of a place photo with CLIP
+
+    prompts is an optional comma-separated list (at most ML_CLIP_MAX_PROMPTS
+    prompts of ML_CLIP_MAX_PROMPT_CHARS characters each); the default real
+    estate prompt set is used otherwise.
+    """
+    prompt_list = [p.strip() for p in prompts.split(",") if p.strip()] if prompts else list(CLIP_PROMPTS)
+    problem = check_prompts(prompt_list)
+    if problem is not None:
+        raise HTTPException(status_code=400, detail=problem)
+    top_k = max(1, min(top_k, len(prompt_list)))
+    
+    async with worker_pool.admit():
+        upload = await read_upload(photo)
+        try:
+            _, decoded = await worker_pool.run(decode_upload, upload)
+        except ImageDecodeError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        
+        digest = upload.digest
+        prompts_key = prompt_set_key(prompt_list)
+        cache_key = result_cache.make_key(digest, CLIP_MODEL_ID, f"{prompts_key}/top{top_k}")
+        
+        clip_results = result_cache.get(cache_key)
+        if clip_results is None:
+            try:
+                with stage("preprocess"):
+                    image_input = await worker_pool.run(clip_classifier.preprocess, decoded.image)
+                with stage("inference"):
+                    image_features = await clip_batcher.submit(image_input)
+                clip_results = (await worker_pool.run(
+                    clip_classifier.rank, image_features, prompt_list, top_k
+                ))[0]
+            except ImportError as e:
+                raise HTTPException(status_code=503, detail=f"CLIP model unavailable: {e}")
+            result_cache.set(cache_key, clip_results)
+    
+    return JSONResponse({
+        "success": True,
+        "filename": photo.filename,
+        "clip": clip_results,
+        "prompts_key": prompts_key,
+        "timing": {"decode_ms": round(decoded.decode_ms, 2)},
+        "timestamp": datetime.now().isoformat()
+    })
+
+@app.post("/api/places/similar")
+async def find_similar_places(
+    photos: Optional[List[UploadFile]] = File(None),
+    digests: Optional[str] = None,
+    k: int = 10,
+    exact: bool = False,
+    duplicate_threshold: float = 0.97
+):
+    """Visually similar stored photos by cosine similarity of ResNet-18 embeddings
+
+    Query with uploaded photos and/or comma-separated content digests of
+    photos already in the embedding store. Neighbours scoring at or above
+    duplicate_threshold are flagged as likely duplicates.
+    """
+    k = max(1, min(k, 100))
+    query_digests = [d.strip() for d in digests.split(",") if d.strip()] if digests else []
+    if not photos and not query_digests:
+        raise HTTPException(status_code=400, detail="Provide photos or digests to search with")
+    # Opening the store maps its files, so the first search does it off the event loop
+    store = await worker_pool.run(embedding_store)
+    
+    async def embed_photo(photo: UploadFile) -> Dict[str, Any]:
+        try:
+            upload = await read_upload(photo)
+            _, decoded = await worker_pool.run(decode_upload, upload)
+        except (UploadRejected, ImageDecodeError) as e:
+            return {"query": photo.filename, "error": str(e)}
+        digest = upload.digest
+        vector = store.get(digest)
+        if vector is None:
+            input_array = await worker_pool.run(preprocess_image, decoded.image)
+            results, vector = await recognition_batcher.submit(input_array)
+            if vector is None:
+                return {"query": photo.filename, "digest": digest,
+                        "error": "Inference backend does not provide embeddings"}
+            result_cache.set(result_cache.make_key(digest, RESNET18_CACHE_ID), results)
+            await worker_pool.run(save_embeddings, [digest], vector[None, :])
+        return {"query": photo.filename, "digest": digest, "vector": vector}
+    
+    async with worker_pool.admit():
+        queries = []
+        for outcome in await asyncio.gather(*(embed_photo(photo) for photo in photos or []), return_exceptions=True):
+            queries.append({"query": None, "error": str(outcome)} if isinstance(outcome, Exception) else outcome)
+        for digest in query_digests:
+            vector = store.get(digest)
+            queries.append(
+                {"query": digest, "digest": digest, "vector": vector} if vector is not None
+                else {"query": digest, "digest": digest, "error": "Digest not in embedding store"}
+            )
+        
+        # One batched search over every query that has a vector
+        searchable = [q for q in queries if "vector" in q]
+        if searchable:
+            neighbours = await worker_pool.run(
+                store.search,
+                np.stack([q["vector"] for q in searchable]),
+                k,
+                exact,
+                [q["digest"] for q in searchable],
+            )
+            for query, found in zip(searchable, neighbours):
+                query["neighbors"] = [
+                    {"digest": digest, "score": round(score, 4), "duplicate": score >= duplicate_threshold}
+                    for digest, score in found
+                ]
+                del query["vector"]
+    
+    return JSONResponse({
+        "success": True,
+        "results": queries,
+        "index": store.stats()["index"],
+        "timestamp": datetime.now().isoformat()
+    })
+
+def embedding_stats() -> Dict[str, Any]:
+    store = open_embedding_store("resnet18")
+    if store is None:
+        return {"enabled": store_embeddings, "open": False}
+    return {"enabled": store_embeddings, "open": True, **store.stats()}
+
+def worker_status() -> Dict[str, Any]:
+    """Load and model state reported in this worker's heartbeat"""
+    return {
+        "in_flight": worker_pool.in_flight,
+        "queue_depth": recognition_batcher.queue_depth() + clip_batcher.queue_depth(),
+        "requests": recognition_batcher.total_requests + clip_batcher.total_requests,
+        "models_loaded": [name for name, entry in model_registry.stats().items() if entry["loaded"]],
+    }
+
+# Set when running as one of several pre-forked workers (see serve_places.py)
+worker_heartbeat = WorkerHeartbeat.from_env(worker_status)
+
+@app.on_event("startup")
+async def start_batcher():
+    # Optional explicit warm-up so the first request doesn't pay for loading weights
+    await worker_pool.run(warm_up_from_env, model_registry)
+    await recognition_batcher.start()
+    await clip_batcher.start()
+    if worker_heartbeat is not None:
+        await worker_heartbeat.start()
+
+@app.on_event("shutdown")
+async def stop_batcher():
+    if worker_heartbeat is not None:
+        await worker_heartbeat.stop()
+    await recognition_batcher.stop()
+    await clip_batcher.stop()
+    # Only flush a store this worker actually opened
+    store = open_embedding_store("resnet18")
+    if store is not None:
+        store.flush()
+    image_store.writer.flush()
+    worker_pool.shutdown()
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Request, stage, batching, model and cache metrics in Prometheus text format"""
+    return Response(content=metrics.render(), media_type=PROMETHEUS_CONTENT_TYPE)
+
 @app.get("/api/places/health")
 async def health_check():
     """Health check endpoint"""
     return JSONResponse({
         "status": "healthy",
-        "model_loaded": model is not None,
-        "labels_loaded": len(labels) > 0,
+        "model_loaded": model_registry.is_loaded("resnet18"),
+        "labels_loaded": model_registry.is_loaded("imagenet_labels"),
+        "models": model_registry.stats(),
+        "batching": recognition_batcher.stats(),
+        "clip": {"batching": clip_batcher.stats(), **clip_classifier.stats()},
+        "worker_pool": worker_pool.stats(),
+        "result_cache": result_cache.stats(),
+        "embeddings": embedding_stats(),
+        "dedupe": phash_index.stats() if phash_index is not None else {"enabled": False},
+        "image_store": image_store.stats(),
+        "worker": worker_identity(),
+        "timestamp": datetime.now().isoformat()
+    })
+
+@app.get("/api/places/workers")
+async def workers_health():
+    """Per-worker status from heartbeats when running under serve_places.py"""
+    heartbeat_dir = os.getenv(HEARTBEAT_DIR_ENV)
+    if worker_heartbeat is None or not heartbeat_dir:
+        workers = [{"id": 0, "pid": os.getpid(), "state": "running", "alive": True, **memory_mb(), **worker_status()}]
+    else:
+        workers = await worker_pool.run(read_heartbeats, heartbeat_dir, worker_heartbeat.interval * 3)
+    return JSONResponse({
+        "workers": workers,
+        "alive": sum(worker["alive"] for worker in workers),
+        "total": len(workers),
+        "served_by": os.getpid(),
         "timestamp": datetime.now().isoformat()
     })
 
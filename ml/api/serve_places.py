@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+"""
+Pre-fork production launcher for the places API.
+
+The master process loads the model weights once, binds the listening socket
+and then forks N uvicorn workers that all accept on that socket. Weights
+loaded before the fork are shared copy-on-write, so 32 workers cost one copy
+of ResNet-18/CLIP plus each worker's activations rather than 32 copies. Each
+worker caps torch to its share of the cores so the workers together don't
+oversubscribe the machine.
+
+Workers report a heartbeat (see utils/worker_heartbeat.py); the master
+restarts workers that exit or whose heartbeat stalls, and
+GET /api/places/workers on any worker lists all of them.
+
+    python3 api/serve_places.py --workers 8 --port 8001
+    python3 api/serve_places.py --workers 32 --preload resnet18 imagenet_labels clip-vit-b-32
+"""
+
+import argparse
+import gc
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+import traceback
+from typing import Dict, List
+
+# Make the shared ml/utils helpers and places_api importable when run as a script
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from utils.worker_heartbeat import HEARTBEAT_DIR_ENV, HEARTBEAT_INTERVAL, WORKER_ID_ENV, read_heartbeats
+
+DEFAULT_PRELOAD = ["resnet18", "imagenet_labels"]
+
+# ONNX Runtime sessions start their thread pools when created, and threads
+# don't survive fork, so that backend is loaded in each worker instead
+FORK_UNSAFE_BACKENDS = {"onnx"}
+
+# Workers that exit sooner than this after starting are restarted with a delay
+MIN_WORKER_UPTIME_S = 5.0
+
+
+def log(message: str):
+    print(f"[serve_places {os.getpid()}] {message}", file=sys.stderr, flush=True)
+
+
+def configure_environment(args):
+    """Settings every worker inherits through the environment"""
+    os.environ["ML_TORCH_THREADS"] = str(args.torch_threads)
+    os.environ["OMP_NUM_THREADS"] = str(args.torch_threads)
+    os.environ.setdefault("ML_WORKER_THREADS", str(args.worker_threads))
+    # Workers still warm up whatever the master could not preload
+    os.environ["ML_WARMUP_MODELS"] = ",".join(args.preload)
+    if float(os.getenv("ML_MODEL_IDLE_TTL_SECONDS", "0") or 0) > 0:
+        # A worker reloading an unloaded model gets a private copy, undoing the sharing
+        log("Ignoring ML_MODEL_IDLE_TTL_SECONDS: preloaded models stay resident in pre-fork mode")
+    os.environ["ML_MODEL_IDLE_TTL_SECONDS"] = "0"
+
+
+def preload_models(names: List[str]) -> Dict[str, float]:
+    """Load models in the master so the workers share their pages copy-on-write"""
+    import torch
+    from utils.inference_backends import selected_backend
+    from utils.model_registry import get_model_registry
+
+    # The master never runs inference; keep it from starting an intra-op pool before forking
+    torch.set_num_threads(1)
+    if "resnet18" in names and selected_backend() in FORK_UNSAFE_BACKENDS:
+        log(f"Backend {selected_backend()} is loaded per worker rather than shared")
+        names = [name for name in names if name != "resnet18"]
+
+    timings = get_model_registry().warm_up(names)
+    # Keep the GC from touching (and so copying) every preloaded object in each worker
+    gc.collect()
+    gc.freeze()
+    return timings
+
+
+def bind_socket(host: str, port: int, backlog: int) -> socket.socket:
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(worker_id: int, sock: socket.socket, args):
+    """Body of a forked worker: one uvicorn server on the shared socket"""
+    os.environ[WORKER_ID_ENV] = str(worker_id)
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, signal.SIG_DFL)
+
+    import torch
+    import uvicorn
+
+    torch.set_num_threads(args.torch_threads)
+    import places_api
+
+    config = uvicorn.Config(
+        places_api.app,
+        log_level=args.log_level,
+        access_log=args.access_log,
+        timeout_keep_alive=args.keep_alive,
+    )
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+class Master:
+    """Forks the workers and keeps the configured number of them healthy"""
+
+    def __init__(self, sock: socket.socket, args):
+        self.sock = sock
+        self.args = args
+        self.workers: Dict[int, int] = {}          # worker ID -> PID
+        self.started_at: Dict[int, float] = {}
+        self.respawn_after: Dict[int, float] = {}
+        self.stopping = False
+
+    def spawn(self, worker_id: int):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                run_worker(worker_id, self.sock, self.args)
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        self.workers[worker_id] = pid
+        self.started_at[worker_id] = time.time()
+        log(f"Started worker {worker_id} (pid {pid})")
+
+    def reap(self):
+        """Collect exited workers and schedule their replacement"""
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            for worker_id, worker_pid in list(self.workers.items()):
+                if worker_pid != pid:
+                    continue
+                del self.workers[worker_id]
+                uptime = time.time() - self.started_at[worker_id]
+                if not self.stopping:
+                    log(f"Worker {worker_id} (pid {pid}) exited with status {status} after {uptime:.0f}s")
+                    # Back off a little when a worker is crash-looping
+                    delay = 1.0 if uptime < MIN_WORKER_UPTIME_S else 0.0
+                    self.respawn_after[worker_id] = time.time() + delay
+
+    def kill_stale(self):
+        """SIGKILL workers whose event loop stopped sending heartbeats"""
+        now = time.time()
+        beats = {beat["id"]: beat for beat in read_heartbeats(self.args.heartbeat_dir, self.args.timeout)}
+        for worker_id, pid in list(self.workers.items()):
+            beat = beats.get(worker_id)
+            if beat is not None and beat.get("pid") == pid:
+                stale = beat["state"] == "running" and not beat["alive"]
+            else:
+                # No heartbeat from this process yet: allow for imports and model loading
+                stale = now - self.started_at[worker_id] > self.args.startup_timeout
+            if stale:
+                log(f"Worker {worker_id} (pid {pid}) stopped responding; killing it")
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for worker_id in range(self.args.workers):
+            self.spawn(worker_id)
+
+        while not self.stopping:
+            time.sleep(1.0)
+            self.reap()
+            now = time.time()
+            for worker_id, when in list(self.respawn_after.items()):
+                if now >= when and not self.stopping:
+                    del self.respawn_after[worker_id]
+                    self.spawn(worker_id)
+            self.kill_stale()
+
+        self.shutdown()
+
+    def shutdown(self):
+        log(f"Stopping {len(self.workers)} workers")
+        for pid in self.workers.values():
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = time.time() + self.args.graceful_timeout
+        while self.workers and time.time() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        for worker_id, pid in self.workers.items():
+            log(f"Worker {worker_id} (pid {pid}) did not stop in time; killing it")
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        self.sock.close()
+
+
+def main():
+    cpu_count = os.cpu_count() or 1
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--workers", type=int, default=int(os.getenv("PLACES_WORKERS", "0")) or cpu_count,
+                        help="worker processes (default: PLACES_WORKERS or the CPU count)")
+    parser.add_argument("--torch-threads", type=int, default=0,
+                        help="torch intra-op threads per worker (default: CPU count / workers)")
+    parser.add_argument("--worker-threads", type=int, default=2,
+                        help="decode/inference threads per worker unless ML_WORKER_THREADS is set")
+    parser.add_argument("--preload", nargs="*", default=DEFAULT_PRELOAD,
+                        help="models to load in the master before forking")
+    parser.add_argument("--timeout", type=float, default=max(30.0, HEARTBEAT_INTERVAL * 6),
+                        help="seconds without a heartbeat before a worker is killed and replaced")
+    parser.add_argument("--startup-timeout", type=float, default=300.0,
+                        help="seconds a new worker has to send its first heartbeat")
+    parser.add_argument("--graceful-timeout", type=float, default=30.0)
+    parser.add_argument("--keep-alive", type=int, default=5)
+    parser.add_argument("--backlog", type=int, default=2048)
+    parser.add_argument("--log-level", default="info")
+    parser.add_argument("--access-log", action="store_true")
+    args = parser.parse_args()
+
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    args.torch_threads = args.torch_threads or max(1, cpu_count // args.workers)
+
+    from utils.embedding_store import embeddings_enabled
+    if embeddings_enabled() and args.workers > 1:
+        # Each worker would append to the same memmap and ID files
+        parser.error("ML_STORE_EMBEDDINGS=1 is not supported with more than one worker; "
+                     "run a single worker or backfill with bulk_analyze.py --store-embeddings")
+
+    configure_environment(args)
+    from utils.model_registry import get_model_registry
+    unknown = set(args.preload) - set(get_model_registry().stats())
+    if unknown:
+        parser.error(f"Unknown models for --preload: {', '.join(sorted(unknown))}")
+
+    owns_heartbeat_dir = not os.getenv(HEARTBEAT_DIR_ENV)
+    args.heartbeat_dir = os.getenv(HEARTBEAT_DIR_ENV) or tempfile.mkdtemp(prefix="places-workers-")
+    os.makedirs(args.heartbeat_dir, exist_ok=True)
+    os.environ[HEARTBEAT_DIR_ENV] = args.heartbeat_dir
+
+    started = time.perf_counter()
+    timings = preload_models(args.preload)
+    log(f"Preloaded {', '.join(timings) or 'no models'} in {time.perf_counter() - started:.1f}s")
+
+    sock = bind_socket(args.host, args.port, args.backlog)
+    log(f"Listening on {args.host}:{args.port} with {args.workers} workers x {args.torch_threads} torch threads")
+    try:
+        Master(sock, args).run()
+    finally:
+        if owns_heartbeat_dir:
+            shutil.rmtree(args.heartbeat_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+"""
+Offline bulk photo analysis for backfilling the catalog.
+
+Takes directories, glob patterns or CSV/JSONL manifests of image paths and
+streams them through a multi-process decode pool (read, hash, reduced-size
+decode, resize/crop) feeding batched ResNet-18 and/or CLIP inference in the
+main process. Results are written incrementally to JSONL or Parquet, and a
+checkpoint file records finished paths so an interrupted run picks up where
+it stopped.
+
+    python3 bulk_analyze.py /data/listings --output scores.jsonl
+    python3 bulk_analyze.py manifest.csv --output scores.parquet --models resnet18 clip
+    python3 bulk_analyze.py "/data/photos/**/*.jpg" --output scores.jsonl --resume
+"""
+
+import argparse
+import csv
+import glob
+import json
+import multiprocessing
+import os
+import sys
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Set
+
+import numpy as np
+
+# Make the shared ml/utils helpers importable when run as a script
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from utils.image_decode import decode_image
+from utils.preprocessing import imagenet_preprocessor
+from utils.property_analysis import analyze_property_batch
+from utils.result_cache import PROPERTY_ANALYSIS_CACHE_ID, RESNET18_CACHE_ID, content_digest
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tif", ".tiff"}
+MODELS = ("resnet18", "clip")
+
+
+def iter_manifest(path: str, column: str) -> Iterator[str]:
+    """Image paths from a CSV (by column name) or JSONL (by key) manifest, relative to the manifest"""
+    base = os.path.dirname(os.path.abspath(path))
+    with open(path, "r", newline="") as f:
+        if path.lower().endswith(".csv"):
+            rows = (row.get(column) for row in csv.DictReader(f))
+        else:
+            rows = (json.loads(line).get(column) for line in f if line.strip())
+        for image_path in rows:
+            if image_path:
+                yield image_path if os.path.isabs(image_path) else os.path.join(base, image_path)
+
+
+def iter_inputs(inputs: Iterable[str], column: str) -> Iterator[str]:
+    """Expand directories (recursively), globs and manifests into image paths"""
+    for item in inputs:
+        if os.path.isdir(item):
+            for root, _, files in os.walk(item):
+                for name in sorted(files):
+                    if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                        yield os.path.join(root, name)
+        elif item.lower().endswith((".csv", ".jsonl")):
+            yield from iter_manifest(item, column)
+        elif glob.has_magic(item):
+            yield from sorted(glob.iglob(item, recursive=True))
+        else:
+            yield item
+
+
+def decode_worker(task) -> Dict[str, Any]:
+    """Decode pool task: read, hash and preprocess one image (runs in a worker process)"""
+    path, want_thumbnail = task
+    row: Dict[str, Any] = {"path": path}
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        decoded = decode_image(data)
+        row.update(
+            digest=content_digest(data),
+            width=decoded.original_size[0],
+            height=decoded.original_size[1],
+            decode_ms=round(decoded.decode_ms, 2),
+            resnet_input=imagenet_preprocessor.to_uint8(decoded.image),
+        )
+        if want_thumbnail:
+            # CLIP preprocessing needs the model's own transform, applied in the main process
+            row["thumbnail"] = np.asarray(decoded.image)
+    except Exception as e:
+        row["error"] = f"{type(e).__name__}: {e}"
+    return row
+
+
+def _init_decode_worker():
+    # Decode workers never run the model; keep torch from spawning intra-op threads
+    try:
+        import torch
+        torch.set_num_threads(1)
+    except ImportError:
+        pass
+
+
+class Checkpoint:
+    """Append-only list of finished paths next to the output file"""
+
+    def __init__(self, path: str, resume: bool):
+        self.path = path
+        self.done: Set[str] = set()
+        if resume and os.path.exists(path):
+            with open(path, "r") as f:
+                self.done = {line.rstrip("\n") for line in f if line.strip()}
+        self._file = open(path, "a" if resume else "w")
+
+    def mark(self, paths: Iterable[str]):
+        self._file.write("".join(f"{path}\n" for path in paths))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+class JsonlWriter:
+    def __init__(self, path: str, resume: bool):
+        self._file = open(path, "a" if resume else "w")
+
+    def write(self, rows: List[Dict[str, Any]]):
+        self._file.write("".join(json.dumps(row) + "\n" for row in rows))
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetWriter:
+    """One row group per batch; a resumed run writes the next numbered part file"""
+
+    def __init__(self, path: str, resume: bool):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise SystemExit("Parquet output requires pyarrow: pip install pyarrow (or use a .jsonl output)")
+        self._pa, self._pq = pa, pq
+        self.path = path
+        if resume and os.path.exists(path):
+            stem, ext = os.path.splitext(path)
+            part = 1
+            while os.path.exists(f"{stem}.part{part}{ext}"):
+                part += 1
+            self.path = f"{stem}.part{part}{ext}"
+        self._writer = None
+
+    def write(self, rows: List[Dict[str, Any]]):
+        pa = self._pa
+        if self._writer is None:
+            # Fixed schema so batches with only errors (all-null columns) still match
+            self._schema = pa.schema([
+                ("path", pa.string()),
+                ("digest", pa.string()),
+                ("width", pa.int64()),
+                ("height", pa.int64()),
+                ("decode_ms", pa.float64()),
+                ("resnet18", pa.string()),
+                ("clip", pa.string()),
+                ("error", pa.string()),
+            ])
+            self._writer = self._pq.ParquetWriter(self.path, self._schema)
+        columns = {name: [] for name in self._schema.names}
+        for row in rows:
+            for name in columns:
+                value = row.get(name)
+                # Top-k lists are stored as JSON text
+                columns[name].append(json.dumps(value) if name in ("resnet18", "clip") and value is not None else value)
+        self._writer.write_table(pa.table(columns, schema=self._schema))
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+
+class InferenceStage:
+    """Batched ResNet-18 (top-3 + optional embeddings) and CLIP scoring in the main process"""
+
+    def __init__(self, models: List[str], top_k: int, store_embeddings: bool, populate_cache: bool):
+        from utils.model_registry import get_model_registry
+
+        self.models = models
+        self.top_k = top_k
+        registry = get_model_registry()
+        self.resnet = registry.get("resnet18") if "resnet18" in models else None
+        self.labels = registry.get("imagenet_labels") if "resnet18" in models else None
+        self.clip = None
+        if "clip" in models:
+            from utils.clip_recognition import get_clip_classifier
+            self.clip = get_clip_classifier()
+            self.clip.text_embeddings()
+
+        self.embedding_store = None
+        if store_embeddings:
+            from utils.embedding_store import get_embedding_store
+            self.embedding_store = get_embedding_store("resnet18", dim=512)
+        self.result_cache = None
+        if populate_cache:
+            from utils.result_cache import get_result_cache
+            self.result_cache = get_result_cache()
+
+    def run(self, rows: List[Dict[str, Any]]):
+        import torch
+        from PIL import Image
+
+        if self.resnet is not None:
+            batch = imagenet_preprocessor.batch_tensor([row["resnet_input"] for row in rows])
+            logits, features = self.resnet.forward_with_features(batch)
+            top_prob, top_idx = torch.topk(torch.softmax(logits, dim=1), self.top_k, dim=1)
+            for row, probs, indices in zip(rows, top_prob.tolist(), top_idx.tolist()):
+                row["resnet18"] = [
+                    [self.labels[i] if 0 <= i < len(self.labels) else f"object_{i}", round(p, 6)]
+                    for p, i in zip(probs, indices)
+                ]
+            if self.result_cache is not None and self.top_k == 3:
+                for row in rows:
+                    self.result_cache.set(
+                        self.result_cache.make_key(row["digest"], RESNET18_CACHE_ID), row["resnet18"]
+                    )
+            if self.embedding_store is not None and features is not None:
+                self.embedding_store.add([row["digest"] for row in rows], features.numpy())
+
+        if self.result_cache is not None:
+            # Location-less property analysis, as /api/places/analyze computes it without location_data
+            digests = [row["digest"] for row in rows]
+            for digest, analysis in zip(digests, analyze_property_batch(digests)):
+                self.result_cache.set(self.result_cache.make_key(digest, PROPERTY_ANALYSIS_CACHE_ID), analysis)
+
+        if self.clip is not None:
+            inputs = [self.clip.preprocess(Image.fromarray(row["thumbnail"])) for row in rows]
+            ranked = self.clip.rank(self.clip.encode_images(inputs), top_k=self.top_k)
+            for row, labels in zip(rows, ranked):
+                row["clip"] = [[label, round(p, 6)] for label, p in labels]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("inputs", nargs="+", help="Directories, glob patterns or .csv/.jsonl manifests")
+    parser.add_argument("--output", required=True, help="Results file (.jsonl or .parquet)")
+    parser.add_argument("--models", nargs="+", choices=MODELS, default=["resnet18"])
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--decode-workers", type=int, default=0,
+                        help="Decode processes (default: half the cores)")
+    parser.add_argument("--torch-threads", type=int, default=0,
+                        help="Inference threads (default: the cores not used for decoding)")
+    parser.add_argument("--manifest-column", default="path", help="Path column/key in manifests")
+    parser.add_argument("--resume", action="store_true", help="Skip paths recorded in the checkpoint")
+    parser.add_argument("--store-embeddings", action="store_true",
+                        help="Also add ResNet-18 embeddings to the /api/places/similar store")
+    parser.add_argument("--populate-cache", action="store_true",
+                        help="Also write top-3 results and property analyses to the shared result cache (ML_RESULT_CACHE_PATH)")
+    parser.add_argument("--progress-every", type=float, default=10.0, help="Seconds between progress lines")
+    args = parser.parse_args()
+
+    cpu_count = os.cpu_count() or 1
+    decode_workers = args.decode_workers or max(1, cpu_count // 2)
+    torch_threads = args.torch_threads or max(1, cpu_count - decode_workers)
+
+    checkpoint = Checkpoint(f"{args.output}.checkpoint", args.resume)
+    # Absolute paths so directory, glob and manifest inputs agree on checkpoint keys
+    paths = [
+        path for path in dict.fromkeys(os.path.abspath(p) for p in iter_inputs(args.inputs, args.manifest_column))
+        if path not in checkpoint.done
+    ]
+    if not paths:
+        print("Nothing to do: every input is already in the checkpoint", file=sys.stderr)
+        return
+
+    writer = ParquetWriter(args.output, args.resume) if args.output.lower().endswith(".parquet") \
+        else JsonlWriter(args.output, args.resume)
+
+    # Fork the decode pool before the model loads so workers don't inherit torch's thread state
+    pool = multiprocessing.Pool(decode_workers, initializer=_init_decode_worker)
+    import torch
+    torch.set_num_threads(torch_threads)
+    stage = InferenceStage(args.models, args.top_k, args.store_embeddings, args.populate_cache)
+
+    print(f"Analyzing {len(paths)} images ({len(checkpoint.done)} already done) with "
+          f"{decode_workers} decode workers, {torch_threads} inference threads, "
+          f"batch size {args.batch_size}", file=sys.stderr)
+
+    started = time.perf_counter()
+    last_report = started
+    processed = failed = 0
+    pending: List[Dict[str, Any]] = []
+
+    def flush(rows: List[Dict[str, Any]]):
+        ok = [row for row in rows if "error" not in row]
+        if ok:
+            stage.run(ok)
+        for row in rows:
+            row.pop("resnet_input", None)
+            row.pop("thumbnail", None)
+        writer.write(rows)
+        # Results are on disk before their paths are checkpointed
+        checkpoint.mark(row["path"] for row in rows)
+
+    tasks = ((path, "clip" in args.models) for path in paths)
+    try:
+        for row in pool.imap_unordered(decode_worker, tasks, chunksize=8):
+            pending.append(row)
+            failed += "error" in row
+            if len(pending) >= args.batch_size:
+                flush(pending)
+                processed += len(pending)
+                pending = []
+            now = time.perf_counter()
+            if now - last_report >= args.progress_every:
+                rate = processed / (now - started)
+                print(f"{processed}/{len(paths)} images, {rate:.1f} images/sec, {failed} failed", file=sys.stderr)
+                last_report = now
+        if pending:
+            flush(pending)
+            processed += len(pending)
+    except KeyboardInterrupt:
+        print(f"\nInterrupted after {processed} images; rerun with --resume to continue", file=sys.stderr)
+        pool.terminate()
+        raise SystemExit(130)
+    finally:
+        writer.close()
+        checkpoint.close()
+        if stage.embedding_store is not None:
+            stage.embedding_store.flush()
+
+    pool.close()
+    pool.join()
+    elapsed = time.perf_counter() - started
+    print(json.dumps({
+        "processed": processed,
+        "failed": failed,
+        "elapsed_s": round(elapsed, 2),
+        "images_per_sec": round(processed / elapsed, 2) if elapsed else 0.0,
+        "output": writer.path if isinstance(writer, ParquetWriter) else args.output,
+    }))
+
+
+if __name__ == "__main__":
+    main()
@@ -7,16 +7,27 @@ import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
 import json
-from typing import Dict, List, Optional, Any
+from typing import Dict, List, Optional, Any, Awaitable, Callable, Hashable, Set, Tuple
 import logging
-from dataclasses import dataclass
+from dataclasses import dataclass, fields, is_dataclass
+from collections import OrderedDict
 import asyncio
 from concurrent.futures import ThreadPoolExecutor
 import requests
-from sklearn.ensemble import RandomForestRegressor
 from sklearn.preprocessing import StandardScaler
 import joblib
 import os
+import sys
+import threading
+import time
+
+from forecast_model_store import ForecastModelStore, ModelMetadata
+from forecasting import (
+    DEFAULT_HORIZON, METRICS, MIN_OBSERVATIONS, TrendSeasonalModel, design_columns, fit_histories, fit_history
+)
+
+# How long a request waits for a client's first forecast models (fits take milliseconds)
+FIRST_FIT_WAIT_SECONDS = 2.0
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -58,115 +69,331 @@ class AIInsight:
     impact_score: float
     category: str
 
+def approximate_size(value: Any) -> int:
+    """Rough in-memory size of a cached value (containers and dataclasses included)"""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(approximate_size(k) + approximate_size(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set)):
+        size += sum(approximate_size(item) for item in value)
+    elif is_dataclass(value) and not isinstance(value, type):
+        size += sum(approximate_size(getattr(value, field.name)) for field in fields(value))
+    return size
+
+@dataclass
+class CacheEntry:
+    """One cached value with its expiry and approximate size"""
+    value: Any
+    expires_at: float
+    size: int
+
+CacheKey = Tuple[str, str, Hashable]
+
+class TTLCache:
+    """Per-entry TTL cache with LRU eviction, bounded by entry count and bytes
+
+    Entries are keyed by (namespace, client_id, variant), e.g.
+    ("activities", "client-1", 10), and indexed by client_id so one client's
+    entries can be dropped without scanning the rest.
+    """
+
+    def __init__(self, default_ttl: float = 300.0, max_entries: int = 10000, max_bytes: int = 64 * 1024 * 1024):
+        self.default_ttl = default_ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[CacheKey, CacheEntry]" = OrderedDict()
+        self._by_client: Dict[str, Set[CacheKey]] = {}
+        self._bytes = 0
+        self._stats: Dict[str, Dict[str, int]] = {}
+
+    def _count(self, namespace: str, event: str):
+        counters = self._stats.setdefault(namespace, {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0})
+        counters[event] += 1
+
+    def _remove(self, key: CacheKey) -> CacheEntry:
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+        client_keys = self._by_client.get(key[1])
+        if client_keys is not None:
+            client_keys.discard(key)
+            if not client_keys:
+                del self._by_client[key[1]]
+        return entry
+
+    def get(self, namespace: str, client_id: str, variant: Hashable = None) -> Optional[Any]:
+        """Return the cached value, or None when missing or expired"""
+        key = (namespace, client_id, variant)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._count(namespace, "misses")
+                return None
+            if entry.expires_at <= time.monotonic():
+                self._remove(key)
+                self._count(namespace, "expirations")
+                self._count(namespace, "misses")
+                return None
+            self._entries.move_to_end(key)
+            self._count(namespace, "hits")
+            return entry.value
+
+    def set(self, namespace: str, client_id: str, value: Any, variant: Hashable = None, ttl: Optional[float] = None):
+        """Store value for ttl seconds (default_ttl when not given)"""
+        key = (namespace, client_id, variant)
+        size = approximate_size(value)
+        expires_at = time.monotonic() + (self.default_ttl if ttl is None else ttl)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if size > self.max_bytes or self.max_entries <= 0:
+                return
+            self._entries[key] = CacheEntry(value=value, expires_at=expires_at, size=size)
+            self._by_client.setdefault(client_id, set()).add(key)
+            self._bytes += size
+
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                old_key = next(iter(self._entries))
+                self._remove(old_key)
+                self._count(old_key[0], "evictions")
+
+    def invalidate_client(self, client_id: str) -> int:
+        """Drop every entry of one client; returns how many were removed"""
+        with self._lock:
+            keys = list(self._by_client.get(client_id, ()))
+            for key in keys:
+                self._remove(key)
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_client.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """Occupancy plus hit/miss/eviction counters per namespace"""
+        with self._lock:
+            namespaces = {}
+            for key, entry in self._entries.items():
+                usage = namespaces.setdefault(key[0], {"entries": 0, "bytes": 0})
+                usage["entries"] += 1
+                usage["bytes"] += entry.size
+            for namespace, counters in self._stats.items():
+                lookups = counters["hits"] + counters["misses"]
+                namespaces.setdefault(namespace, {"entries": 0, "bytes": 0}).update(
+                    counters, hit_rate=round(counters["hits"] / lookups, 3) if lookups else 0.0
+                )
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "clients": len(self._by_client),
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "default_ttl": self.default_ttl,
+                "namespaces": namespaces,
+            }
+
+class SingleFlight:
+    """Coalesces concurrent calls for the same key into one in-flight computation
+
+    The computation runs as its own task, so a caller that gives up (e.g. a
+    disconnected request) doesn't cancel it for the callers still waiting.
+    """
+
+    def __init__(self):
+        self._tasks: Dict[Hashable, asyncio.Task] = {}
+        self.started = 0
+        self.coalesced = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._tasks[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+            self.started += 1
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def _forget(self, key: Hashable, task: asyncio.Task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+
+    def stats(self) -> Dict[str, int]:
+        return {"in_flight": len(self._tasks), "started": self.started, "coalesced": self.coalesced}
+
 class ClientDashboardAI:
     """AI-powered client dashboard analytics service"""
     
-    def __init__(self):
-        self.metrics_cache = {}
-        self.insights_cache = {}
-        self.activity_cache = {}
-        self.models = {}
-        self.scalers = {}
-        self.cache_duration = 300  # 5 minutes
-        self.last_update = None
+    def __init__(self, cache: Optional[TTLCache] = None, model_store: Optional[ForecastModelStore] = None):
+        self.cache = cache or TTLCache(
+            default_ttl=float(os.getenv("CLIENT_DASHBOARD_CACHE_TTL_SECONDS", "300")),
+            max_entries=int(os.getenv("CLIENT_DASHBOARD_CACHE_MAX_ENTRIES", "10000")),
+            max_bytes=int(float(os.getenv("CLIENT_DASHBOARD_CACHE_MAX_MB", "64")) * 1024 * 1024),
+        )
+        self.model_store = model_store or ForecastModelStore()
+        # Concurrent requests for the same (operation, client) share one computation
+        self.flights = SingleFlight()
         
     async def get_dashboard_metrics(self, client_id: str) -> DashboardMetrics:
         """Get comprehensive dashboard metrics with AI predictions"""
         try:
             # Check cache first
-            cache_key = f"metrics_{client_id}"
-            if self._is_cache_valid(cache_key):
-                return self.metrics_cache[cache_key]
-            
-            # Fetch real-time data
-            metrics = await self._fetch_real_time_metrics(client_id)
+            cached = self.cache.get("metrics", client_id)
+            if cached is not None:
+                return cached
             
-            # Apply AI predictions
-            enhanced_metrics = await self._apply_ai_predictions(metrics, client_id)
-            
-            # Cache results
-            self.metrics_cache[cache_key] = enhanced_metrics
-            self.last_update = datetime.now()
-            
-            return enhanced_metrics
+            return await self.flights.do(("metrics", client_id), lambda: self._compute_metrics(client_id))
             
         except Exception as e:
             logger.error(f"Error getting dashboard metrics: {e}")
             return self._get_default_metrics()
     
-    async def get_ai_insights(self, client_id: str) -> List[AIInsight]:
-        """Generate AI-powered insights for the client"""
+    async def _compute_metrics(self, client_id: str) -> DashboardMetrics:
+        # Fetch real-time data
+        metrics = await self._fetch_real_time_metrics(client_id)
+        
+        # Apply AI predictions
+        enhanced_metrics = await self._apply_ai_predictions(metrics, client_id)
+        
+        # Cache results
+        self.cache.set("metrics", client_id, enhanced_metrics)
+        
+        return enhanced_metrics
+    
+    async def get_ai_insights(self, client_id: str, metrics: Optional[DashboardMetrics] = None) -> List[AIInsight]:
+        """Generate AI-powered insights for the client
+        
+        Pass metrics when the caller already has them to skip fetching them again.
+        """
         try:
-            cache_key = f"insights_{client_id}"
-            if self._is_cache_valid(cache_key):
-                return self.insights_cache[cache_key]
-            
-            # Get current metrics
-            metrics = await self.get_dashboard_metrics(client_id)
+            cached = self.cache.get("insights", client_id)
+            if cached is not None:
+                return cached
             
-            # Generate insights
-            insights = await self._generate_insights(metrics, client_id)
-            
-            # Cache insights
-            self.insights_cache[cache_key] = insights
-            self.last_update = datetime.now()
-            
-            return insights
+            return await self.flights.do(("insights", client_id), lambda: self._compute_insights(client_id, metrics))
             
         except Exception as e:
             logger.error(f"Error generating AI insights: {e}")
             return self._get_default_insights()
     
+    async def _compute_insights(self, client_id: str, metrics: Optional[DashboardMetrics]) -> List[AIInsight]:
+        # Get current metrics
+        if metrics is None:
+            metrics = await self.get_dashboard_metrics(client_id)
+        
+        # Generate insights
+        insights = await self._generate_insights(metrics, client_id)
+        
+        # Cache insights
+        self.cache.set("insights", client_id, insights)
+        
+        return insights
+    
     async def get_smart_activities(self, client_id: str, limit: int = 10) -> List[ActivityItem]:
         """Get AI-enhanced activity feed"""
         try:
-            cache_key = f"activities_{client_id}_{limit}"
-            if self._is_cache_valid(cache_key):
-                return self.activity_cache[cache_key]
-            
-            # Fetch activities
-            activities = await self._fetch_activities(client_id)
-            
-            # Apply AI prioritization
-            enhanced_activities = await self._prioritize_activities(activities, client_id)
+            cached = self.cache.get("activities", client_id, limit)
+            if cached is not None:
+                return cached
             
-            # Cache results
-            self.activity_cache[cache_key] = enhanced_activities[:limit]
-            self.last_update = datetime.now()
-            
-            return enhanced_activities[:limit]
+            return await self.flights.do(
+                ("activities", client_id, limit), lambda: self._compute_activities(client_id, limit)
+            )
             
         except Exception as e:
             logger.error(f"Error getting smart activities: {e}")
             return self._get_default_activities()
     
-    async def get_predictive_analytics(self, client_id: str) -> Dict[str, Any]:
-        """Get predictive analytics for the client"""
+    async def _compute_activities(self, client_id: str, limit: int) -> List[ActivityItem]:
+        # Fetch activities
+        activities = await self._fetch_activities(client_id)
+        
+        # Apply AI prioritization
+        enhanced_activities = await self._prioritize_activities(activities, client_id)
+        
+        # Cache results
+        self.cache.set("activities", client_id, enhanced_activities[:limit], limit)
+        
+        return enhanced_activities[:limit]
+    
+    async def get_predictive_analytics(self, client_id: str, horizon: int = DEFAULT_HORIZON) -> Dict[str, Any]:
+        """Get predictive analytics for the client, forecasting horizon days ahead"""
         try:
-            # Get historical data
-            historical_data = await self._fetch_historical_data(client_id)
-            
-            # Apply ML models
-            predictions = await self._apply_ml_predictions(historical_data, client_id)
+            cached = self.cache.get("predictive", client_id, horizon)
+            if cached is not None:
+                return cached
             
-            return {
-                "revenue_forecast": predictions.get("revenue", {}),
-                "user_growth_forecast": predictions.get("users", {}),
-                "property_growth_forecast": predictions.get("properties", {}),
-                "risk_assessment": predictions.get("risk", {}),
-                "opportunity_analysis": predictions.get("opportunities", {}),
-                "recommendations": predictions.get("recommendations", [])
-            }
+            return await self.flights.do(
+                ("predictive", client_id, horizon), lambda: self._compute_predictive_analytics(client_id, horizon)
+            )
             
         except Exception as e:
             logger.error(f"Error getting predictive analytics: {e}")
             return self._get_default_predictions()
     
-    async def get_ai_recommendations(self, client_id: str) -> List[Dict[str, Any]]:
-        """Get AI-powered recommendations"""
+    async def _compute_predictive_analytics(self, client_id: str, horizon: int) -> Dict[str, Any]:
+        # Get historical data
+        historical_data = await self._fetch_historical_data(client_id)
+        
+        # Apply ML models
+        predictions = await self._apply_ml_predictions(historical_data, client_id, horizon)
+        
+        analytics = {
+            "revenue_forecast": predictions.get("revenue", {}),
+            "user_growth_forecast": predictions.get("users", {}),
+            "property_growth_forecast": predictions.get("properties", {}),
+            "system_health_forecast": predictions.get("system_health", {}),
+            "risk_assessment": predictions.get("risk", {}),
+            "opportunity_analysis": predictions.get("opportunities", {}),
+            "recommendations": predictions.get("recommendations", [])
+        }
+        # Forecasts still waiting for their first model aren't worth keeping
+        if not any(forecast.get("status") == "training" for forecast in predictions.values()):
+            self.cache.set("predictive", client_id, analytics, horizon)
+        return analytics
+    
+    async def precompute_forecasts(self, client_ids: List[str], persist: bool = True) -> int:
+        """Fit forecast models for many clients in one vectorized pass (e.g. nightly)
+        
+        Later requests for these clients only evaluate the stored models.
+        Returns how many clients got models.
+        """
+        histories = await asyncio.gather(*[self._fetch_historical_data(client_id) for client_id in client_ids])
+        loop = asyncio.get_running_loop()
+        models = await loop.run_in_executor(None, fit_histories, dict(zip(client_ids, histories)))
+        await loop.run_in_executor(None, self._store_forecast_models, models, persist)
+        return len(models)
+    
+    def _store_forecast_models(self, models: Dict[str, TrendSeasonalModel], persist: bool):
+        trained_at = time.time()
+        for client_id, model in models.items():
+            for j, metric in enumerate(model.names):
+                self.model_store.put(model.select(slice(j, j + 1)), ModelMetadata(
+                    client_id=client_id,
+                    metric=metric,
+                    model_type=type(model).__name__,
+                    features=design_columns(model.season_length),
+                    trained_at=trained_at,
+                    data_start=str(model.first_date),
+                    data_end=str(model.last_date),
+                    n_samples=model.n_obs,
+                    training_seconds=0.0,
+                ), persist=persist)
+    
+    async def get_ai_recommendations(
+        self, client_id: str, metrics: Optional[DashboardMetrics] = None
+    ) -> List[Dict[str, Any]]:
+        """Get AI-powered recommendations
+        
+        Pass metrics when the caller already has them to skip fetching them again.
+        """
         try:
-            metrics = await self.get_dashboard_metrics(client_id)
-            insights = await self.get_ai_insights(client_id)
+            if metrics is None:
+                metrics = await self.get_dashboard_metrics(client_id)
             
             recommendations = []
             
@@ -398,56 +625,54 @@ class ClientDashboardAI:
         
         return pd.DataFrame(data)
     
-    async def _apply_ml_predictions(self, historical_data: pd.DataFrame, client_id: str) -> Dict[str, Any]:
-        """Apply ML models for predictions"""
+    async def _apply_ml_predictions(
+        self, historical_data: pd.DataFrame, client_id: str, horizon: int = DEFAULT_HORIZON
+    ) -> Dict[str, Any]:
+        """Forecast every metric from the client's stored models, training any that are missing"""
         predictions = {}
+        if len(historical_data) < MIN_OBSERVATIONS:
+            return predictions
         
-        # Revenue prediction
-        if len(historical_data) > 30:
-            revenue_model = self._get_or_create_model("revenue", historical_data)
-            future_dates = pd.date_range(start=historical_data['date'].max(), periods=30, freq='D')
-            revenue_pred = revenue_model.predict(np.arange(len(future_dates)).reshape(-1, 1))
-            
-            predictions["revenue"] = {
-                "forecast": revenue_pred.tolist(),
-                "confidence": 0.85,
-                "trend": "increasing" if revenue_pred[-1] > revenue_pred[0] else "decreasing"
-            }
+        if all(self.model_store.loaded(client_id, metric) is not None for metric in METRICS):
+            models = self._get_or_train_models(client_id, historical_data)
+        else:
+            # Cold models are read from disk with joblib, which must not block the event loop
+            loop = asyncio.get_running_loop()
+            models = await loop.run_in_executor(None, self._get_or_train_models, client_id, historical_data)
+        missing = [metric for metric, stored in models.items() if stored is None]
+        if missing:
+            # A client's first models: fits are quick, so wait briefly rather than answer empty
+            futures = [self.model_store.training_future(client_id, metric) for metric in missing]
+            futures = [asyncio.wrap_future(future) for future in futures if future is not None]
+            if futures:
+                await asyncio.wait(futures, timeout=FIRST_FIT_WAIT_SECONDS)
+            for metric in missing:
+                models[metric] = self.model_store.loaded(client_id, metric)
         
-        # User growth prediction
-        if len(historical_data) > 30:
-            user_model = self._get_or_create_model("users", historical_data)
-            user_pred = user_model.predict(np.arange(30).reshape(-1, 1))
-            
-            predictions["users"] = {
-                "forecast": user_pred.tolist(),
-                "confidence": 0.8,
-                "trend": "increasing" if user_pred[-1] > user_pred[0] else "decreasing"
+        for metric, stored in models.items():
+            if stored is None:
+                training = self.model_store.training_future(client_id, metric) is not None
+                predictions[metric] = {"forecast": [], "confidence": 0.0, "trend": "stable",
+                                       "status": "training" if training else "unavailable"}
+                continue
+            predictions[metric] = {
+                **stored.model.predict(horizon).series(0),
+                "trained_at": datetime.fromtimestamp(stored.metadata.trained_at).isoformat()
             }
         
         return predictions
     
-    def _get_or_create_model(self, model_type: str, data: pd.DataFrame) -> Any:
-        """Get or create ML model"""
-        if model_type not in self.models:
-            # Simple linear regression for demo
-            X = np.arange(len(data)).reshape(-1, 1)
-            y = data[model_type].values
-            
-            model = RandomForestRegressor(n_estimators=100, random_state=42)
-            model.fit(X, y)
-            
-            self.models[model_type] = model
-        
-        return self.models[model_type]
+    def _get_or_train_models(self, client_id: str, historical_data: pd.DataFrame) -> Dict[str, Any]:
+        return {
+            metric: self.model_store.get_or_train(client_id, metric, historical_data, self._train_forecast_model)
+            for metric in METRICS
+        }
     
-    def _is_cache_valid(self, cache_key: str) -> bool:
-        """Check if cache is still valid"""
-        if self.last_update is None:
-            return False
-        
-        time_diff = (datetime.now() - self.last_update).total_seconds()
-        return time_diff < self.cache_duration
+    @staticmethod
+    def _train_forecast_model(data: pd.DataFrame, metric: str) -> Tuple[Any, List[str]]:
+        """Fit a forecast model for one metric; runs on the model store's training executor"""
+        model = fit_history(data, [metric])
+        return model, design_columns(model.season_length)
     
     def _get_default_metrics(self) -> DashboardMetrics:
         """Get default metrics when AI service is unavailable"""
@@ -497,6 +722,7 @@ class ClientDashboardAI:
             "revenue_forecast": {"forecast": [], "confidence": 0.0, "trend": "stable"},
             "user_growth_forecast": {"forecast": [], "confidence": 0.0, "trend": "stable"},
             "property_growth_forecast": {"forecast": [], "confidence": 0.0, "trend": "stable"},
+            "system_health_forecast": {"forecast": [], "confidence": 0.0, "trend": "stable"},
             "risk_assessment": {"level": "low", "confidence": 0.0},
             "opportunity_analysis": {"opportunities": []},
             "recommendations": []
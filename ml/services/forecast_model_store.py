@@ -0,0 +1,307 @@
+"""
+Persistent store of per-client forecast models for the client dashboard.
+
+Models are keyed by (client_id, metric) and trained on a background
+executor, so a request never waits for a fit: it gets the last good model
+(or nothing yet, the first time) and training catches up behind it. Fitted
+models are written with joblib next to a small JSON metadata file
+(trained_at, data range, feature schema). On startup only the metadata is
+indexed; a model's joblib file is loaded the first time it is asked for,
+so async callers check loaded() first and do a cold get() off the event
+loop. Loaded models are kept in a bounded LRU; an evicted model is loaded
+from disk again the next time it is asked for. A (client, metric) whose
+training failed is not retried until a cooldown has passed.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import joblib
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+FORECAST_MODEL_DIR = os.getenv(
+    "CLIENT_DASHBOARD_MODEL_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "reservatior-ml", "forecast_models"),
+)
+
+# Models older than this are retrained in the background (and served meanwhile)
+MODEL_MAX_AGE_SECONDS = float(os.getenv("CLIENT_DASHBOARD_MODEL_MAX_AGE_SECONDS", "86400"))
+
+TRAINING_WORKERS = int(os.getenv("CLIENT_DASHBOARD_TRAINING_WORKERS", "1"))
+
+# Models kept in memory at once (least recently used are evicted)
+MAX_LOADED_MODELS = int(os.getenv("CLIENT_DASHBOARD_MAX_LOADED_MODELS", "10000"))
+
+# After a failed training, requests don't reschedule one for this long
+TRAINING_RETRY_SECONDS = float(os.getenv("CLIENT_DASHBOARD_TRAINING_RETRY_SECONDS", "300"))
+
+# trainer(data, metric) -> (fitted model, feature names it expects)
+Trainer = Callable[[pd.DataFrame, str], Tuple[Any, List[str]]]
+
+
+@dataclass
+class ModelMetadata:
+    """What a stored model was trained on"""
+    client_id: str
+    metric: str
+    model_type: str
+    features: List[str]
+    trained_at: float
+    data_start: str
+    data_end: str
+    n_samples: int
+    training_seconds: float
+
+
+@dataclass
+class StoredModel:
+    model: Any
+    metadata: ModelMetadata
+    persisted: bool = True
+
+
+class ForecastModelStore:
+    """Trains, persists and serves one forecast model per (client, metric)"""
+
+    def __init__(
+        self,
+        directory: str = FORECAST_MODEL_DIR,
+        max_age: float = MODEL_MAX_AGE_SECONDS,
+        training_workers: int = TRAINING_WORKERS,
+        retry_after: float = TRAINING_RETRY_SECONDS,
+        max_loaded: int = MAX_LOADED_MODELS,
+    ):
+        self.directory = directory
+        self.max_age = max_age
+        self.retry_after = retry_after
+        self.max_loaded = max(1, max_loaded)
+        self._executor = ThreadPoolExecutor(max_workers=max(1, training_workers), thread_name_prefix="forecast-train")
+        self._lock = threading.Lock()
+        self._models: "OrderedDict[Tuple[str, str], StoredModel]" = OrderedDict()
+        self._metadata: Dict[Tuple[str, str], ModelMetadata] = {}
+        self._training: Dict[Tuple[str, str], Future] = {}
+        self._errors: Dict[Tuple[str, str], str] = {}
+        self._failed_at: Dict[Tuple[str, str], float] = {}
+        self.trainings = 0
+        self.loads = 0
+        self.evictions = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self._index()
+
+    def _base_path(self, client_id: str, metric: str) -> str:
+        # client_id comes from requests, so it is hashed rather than used as a file name
+        client_hash = hashlib.sha256(client_id.encode("utf-8")).hexdigest()[:24]
+        return os.path.join(self.directory, f"{metric}-{client_hash}")
+
+    def _index(self):
+        """Read the metadata of every persisted model; the models themselves load lazily"""
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    metadata = ModelMetadata(**json.load(f))
+            except (OSError, ValueError, TypeError) as e:
+                logger.warning(f"Skipping unreadable forecast model metadata {name}: {e}")
+                continue
+            self._metadata[(metadata.client_id, metadata.metric)] = metadata
+        if self._metadata:
+            logger.info(f"Found {len(self._metadata)} stored forecast models in {self.directory}")
+
+    def loaded(self, client_id: str, metric: str) -> Optional[StoredModel]:
+        """The model for (client, metric) if it is already in memory; never touches disk"""
+        key = (client_id, metric)
+        with self._lock:
+            stored = self._models.get(key)
+            if stored is not None:
+                self._models.move_to_end(key)
+            return stored
+
+    def get(self, client_id: str, metric: str) -> Optional[StoredModel]:
+        """The current model for (client, metric), loading it from disk on first use (blocking)"""
+        key = (client_id, metric)
+        with self._lock:
+            stored = self._models.get(key)
+            metadata = self._metadata.get(key)
+            if stored is not None:
+                self._models.move_to_end(key)
+        if stored is not None or metadata is None:
+            return stored
+
+        try:
+            model = joblib.load(self._base_path(client_id, metric) + ".joblib")
+        except Exception as e:
+            logger.error(f"Error loading forecast model {metric} for {client_id}: {e}")
+            return None
+        stored = StoredModel(model=model, metadata=metadata)
+        with self._lock:
+            # A training that finished meanwhile wins over the copy from disk
+            stored = self._models.setdefault(key, stored)
+            self.loads += 1
+            self._evict()
+        return stored
+
+    def _evict(self):
+        """Drop least recently used models past max_loaded; called with _lock held"""
+        while len(self._models) > self.max_loaded:
+            key, stored = self._models.popitem(last=False)
+            self.evictions += 1
+            if not stored.persisted:
+                # Nothing on disk to reload it from, so it is trained again when next needed
+                self._metadata.pop(key, None)
+
+    def is_stale(self, metadata: ModelMetadata, data: pd.DataFrame) -> bool:
+        """Whether a model is old or was trained before the data's latest date"""
+        if time.time() - metadata.trained_at > self.max_age:
+            return True
+        return len(data) > 0 and str(data["date"].max()) > metadata.data_end
+
+    def get_or_train(self, client_id: str, metric: str, data: pd.DataFrame, trainer: Trainer) -> Optional[StoredModel]:
+        """Serve the last good model, scheduling a background (re)train when it is missing or stale
+
+        Returns None while the first model for (client, metric) trains or after
+        it failed to train. Like get(), this may load the model from disk.
+        """
+        stored = self.get(client_id, metric)
+        if stored is None or self.is_stale(stored.metadata, data):
+            self.train_in_background(client_id, metric, data, trainer)
+        return stored
+
+    def training_future(self, client_id: str, metric: str) -> Optional[Future]:
+        """The running training of (client, metric), if any"""
+        with self._lock:
+            return self._training.get((client_id, metric))
+
+    def train_in_background(self, client_id: str, metric: str, data: pd.DataFrame, trainer: Trainer) -> Optional[Future]:
+        """Queue a training run unless one is already running for (client, metric)
+
+        Returns None without queueing anything while a failed training's retry cooldown lasts.
+        """
+        key = (client_id, metric)
+        with self._lock:
+            future = self._training.get(key)
+            if future is None:
+                failed_at = self._failed_at.get(key)
+                if failed_at is not None and time.time() - failed_at < self.retry_after:
+                    return None
+                future = self._executor.submit(self._train, client_id, metric, data.copy(), trainer)
+                self._training[key] = future
+        return future
+
+    def _train(self, client_id: str, metric: str, data: pd.DataFrame, trainer: Trainer) -> Optional[StoredModel]:
+        key = (client_id, metric)
+        try:
+            started = time.perf_counter()
+            model, features = trainer(data, metric)
+            metadata = ModelMetadata(
+                client_id=client_id,
+                metric=metric,
+                model_type=type(model).__name__,
+                features=list(features),
+                trained_at=time.time(),
+                data_start=str(data["date"].min()),
+                data_end=str(data["date"].max()),
+                n_samples=len(data),
+                training_seconds=round(time.perf_counter() - started, 3),
+            )
+            stored = self.put(model, metadata)
+            with self._lock:
+                self.trainings += 1
+            logger.info(f"Trained forecast model {metric} for {client_id} in {metadata.training_seconds:.2f}s")
+            return stored
+        except Exception as e:
+            # The previous model (if any) keeps being served
+            logger.error(f"Error training forecast model {metric} for {client_id}: {e}")
+            with self._lock:
+                self._errors[key] = str(e)
+                self._failed_at[key] = time.time()
+            return None
+        finally:
+            with self._lock:
+                self._training.pop(key, None)
+
+    def put(self, model: Any, metadata: ModelMetadata, persist: bool = True) -> StoredModel:
+        """Make a fitted model the current one for its (client, metric), e.g. after a batch fit"""
+        stored = StoredModel(model=model, metadata=metadata, persisted=persist and self._persist(model, metadata))
+        key = (metadata.client_id, metadata.metric)
+        with self._lock:
+            self._models[key] = stored
+            self._models.move_to_end(key)
+            self._metadata[key] = metadata
+            self._errors.pop(key, None)
+            self._failed_at.pop(key, None)
+            self._evict()
+        return stored
+
+    def _persist(self, model: Any, metadata: ModelMetadata) -> bool:
+        """Write the model and then its metadata, each atomically; whether both were written"""
+        base = self._base_path(metadata.client_id, metadata.metric)
+        tmp_suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            joblib.dump(model, base + ".joblib" + tmp_suffix)
+            os.replace(base + ".joblib" + tmp_suffix, base + ".joblib")
+            with open(base + ".json" + tmp_suffix, "w") as f:
+                json.dump(asdict(metadata), f)
+            os.replace(base + ".json" + tmp_suffix, base + ".json")
+        except OSError as e:
+            # Still served from memory; it just won't survive a restart
+            logger.error(f"Error persisting forecast model to {base}: {e}")
+            return False
+        return True
+
+    def wait(self, timeout: Optional[float] = None):
+        """Block until queued trainings finish (for scripts and warm-up)"""
+        with self._lock:
+            futures = list(self._training.values())
+        for future in futures:
+            future.result(timeout=timeout)
+
+    def stats(self) -> Dict[str, Any]:
+        """Counts only; per-model metadata is paged through models()"""
+        with self._lock:
+            return {
+                "directory": self.directory,
+                "stored": len(self._metadata),
+                "loaded": len(self._models),
+                "max_loaded": self.max_loaded,
+                "training": len(self._training),
+                "trainings": self.trainings,
+                "loads": self.loads,
+                "evictions": self.evictions,
+                "max_age_s": self.max_age,
+                "failed": len(self._failed_at),
+            }
+
+    def models(self, client_id: Optional[str] = None, offset: int = 0, limit: int = 100) -> Dict[str, Any]:
+        """One page of stored models' metadata and state, optionally for one client"""
+        with self._lock:
+            entries = list(self._metadata.items())
+        # Filtered and sorted outside the lock, so trainings and lookups don't wait on it
+        if client_id is not None:
+            entries = [(key, metadata) for key, metadata in entries if key[0] == client_id]
+        entries.sort(key=lambda entry: entry[0])
+        page = entries[offset:offset + limit]
+        with self._lock:
+            models = [
+                {
+                    **asdict(metadata),
+                    "trained_at": datetime.fromtimestamp(metadata.trained_at).isoformat(),
+                    "loaded": key in self._models,
+                    "training": key in self._training,
+                    "error": self._errors.get(key),
+                }
+                for key, metadata in page
+            ]
+        return {"total": len(entries), "offset": offset, "limit": limit, "models": models}
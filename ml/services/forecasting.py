@@ -0,0 +1,265 @@
+"""
+Vectorized forecasting for the client dashboard's predictive analytics.
+
+Every metric of every client is modelled as a linear trend plus a weekly
+seasonal profile, fitted by least squares over a trailing window of daily
+history. Series that share a date grid share one design matrix, so fitting
+thousands of clients is a single matrix product per chunk rather than one
+model fit per (client, metric); forecasting 10k clients x 4 metrics takes a
+few seconds on one core, which makes nightly precomputation practical.
+Prediction intervals come from each series' residual spread and the OLS
+leverage of the forecast dates, so they widen the further out they reach.
+
+    python3 services/forecasting.py --clients 10000 --horizon 30
+"""
+
+import os
+import time
+from dataclasses import dataclass
+from statistics import NormalDist
+from typing import Dict, Iterator, List, Mapping, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+METRICS = ("revenue", "users", "properties", "system_health")
+
+DEFAULT_HORIZON = int(os.getenv("CLIENT_DASHBOARD_FORECAST_HORIZON", "30"))
+MAX_HORIZON = 365
+
+# Trailing days of history each fit uses, so the trend follows recent behaviour
+DEFAULT_WINDOW = int(os.getenv("CLIENT_DASHBOARD_FORECAST_WINDOW_DAYS", "365"))
+
+SEASON_LENGTH = 7
+INTERVAL_LEVEL = 0.9
+MIN_OBSERVATIONS = 2 * SEASON_LENGTH
+
+# Series fitted per matrix product, to bound the residual matrix's memory
+FIT_CHUNK_SERIES = 8192
+
+
+def _season_phase(dates: pd.DatetimeIndex, season_length: int) -> np.ndarray:
+    return (dates - pd.Timestamp(0)).days.values % season_length
+
+
+def _design(t: np.ndarray, phase: np.ndarray, season_length: int) -> np.ndarray:
+    """Columns: intercept, day index, one indicator per season phase but the first"""
+    X = np.zeros((len(t), 2 + season_length - 1))
+    X[:, 0] = 1.0
+    X[:, 1] = t
+    rows = np.nonzero(phase > 0)[0]
+    X[rows, 1 + phase[rows]] = 1.0
+    return X
+
+
+def design_columns(season_length: int = SEASON_LENGTH) -> List[str]:
+    return ["intercept", "day_index"] + [f"season_{phase}" for phase in range(1, season_length)]
+
+
+@dataclass
+class ForecastBatch:
+    """Forecasts for a batch of series over the same future dates"""
+    dates: pd.DatetimeIndex
+    mean: np.ndarray        # (series, horizon)
+    lower: np.ndarray
+    upper: np.ndarray
+    level: float
+
+    def __post_init__(self):
+        self.date_labels = [date.date().isoformat() for date in self.dates]
+
+    def series(self, index: int) -> Dict:
+        """Forecast of one series as returned by the predictive analytics API"""
+        mean = self.mean[index]
+        return {
+            "forecast": mean.tolist(),
+            "lower": self.lower[index].tolist(),
+            "upper": self.upper[index].tolist(),
+            "dates": list(self.date_labels),
+            "confidence": self.level,
+            "trend": "increasing" if mean[-1] > mean[0] else "decreasing",
+        }
+
+
+@dataclass
+class TrendSeasonalModel:
+    """Fitted trend + seasonality coefficients for series sharing one date grid"""
+    names: List[str]
+    coef: np.ndarray        # (columns, series)
+    sigma: np.ndarray       # (series,) residual standard deviation
+    xtx_inv: np.ndarray     # (columns, columns)
+    last_date: pd.Timestamp
+    n_obs: int
+    season_length: int = SEASON_LENGTH
+
+    def predict(self, horizon: int = DEFAULT_HORIZON, level: float = INTERVAL_LEVEL) -> ForecastBatch:
+        dates = pd.date_range(start=self.last_date + pd.Timedelta(days=1), periods=horizon, freq="D")
+        X = _design(np.arange(self.n_obs, self.n_obs + horizon), _season_phase(dates, self.season_length),
+                    self.season_length)
+        mean = (X @ self.coef).T
+        leverage = np.einsum("hp,pq,hq->h", X, self.xtx_inv, X)
+        z = NormalDist().inv_cdf(0.5 + level / 2)
+        half_width = z * self.sigma[:, None] * np.sqrt(1.0 + leverage)[None, :]
+        return ForecastBatch(dates=dates, mean=mean, lower=mean - half_width, upper=mean + half_width, level=level)
+
+    def select(self, rows: slice) -> "TrendSeasonalModel":
+        """The model of a subset of the series (e.g. one client's metrics out of a batch fit)"""
+        return TrendSeasonalModel(
+            names=self.names[rows],
+            coef=self.coef[:, rows].copy(),
+            sigma=self.sigma[rows].copy(),
+            xtx_inv=self.xtx_inv,
+            last_date=self.last_date,
+            n_obs=self.n_obs,
+            season_length=self.season_length,
+        )
+
+    @property
+    def first_date(self) -> pd.Timestamp:
+        return self.last_date - pd.Timedelta(days=self.n_obs - 1)
+
+
+def fit_trend_seasonal(
+    values: np.ndarray,
+    last_date,
+    names: Optional[Sequence[str]] = None,
+    season_length: int = SEASON_LENGTH,
+) -> TrendSeasonalModel:
+    """Fit every row of values (series x consecutive days ending at last_date) in one pass"""
+    values = np.asarray(values, dtype=np.float64)
+    if values.ndim == 1:
+        values = values[None, :]
+    n_series, n_obs = values.shape
+    last_date = pd.Timestamp(last_date).normalize()
+    dates = pd.date_range(end=last_date, periods=n_obs, freq="D")
+
+    X = _design(np.arange(n_obs), _season_phase(dates, season_length), season_length)
+    xtx_inv = np.linalg.pinv(X.T @ X)
+    projection = xtx_inv @ X.T
+    dof = max(n_obs - X.shape[1], 1)
+
+    coef = np.empty((X.shape[1], n_series))
+    sigma = np.empty(n_series)
+    for start in range(0, n_series, FIT_CHUNK_SERIES):
+        chunk = values[start:start + FIT_CHUNK_SERIES].T
+        chunk_coef = projection @ chunk
+        residuals = chunk - X @ chunk_coef
+        coef[:, start:start + FIT_CHUNK_SERIES] = chunk_coef
+        sigma[start:start + FIT_CHUNK_SERIES] = np.sqrt(np.einsum("ts,ts->s", residuals, residuals) / dof)
+
+    return TrendSeasonalModel(
+        names=list(names) if names is not None else [str(i) for i in range(n_series)],
+        coef=coef,
+        sigma=sigma,
+        xtx_inv=xtx_inv,
+        last_date=last_date,
+        n_obs=n_obs,
+        season_length=season_length,
+    )
+
+
+def _trailing_values(history: pd.DataFrame, metrics: Sequence[str], window: int) -> np.ndarray:
+    """(metrics, days) of the last window days; column by column, which is far cheaper than history[metrics]"""
+    return np.array([history[metric].to_numpy(dtype=np.float64)[-window:] for metric in metrics])
+
+
+def fit_history(history: pd.DataFrame, metrics: Sequence[str] = METRICS, window: int = DEFAULT_WINDOW) -> TrendSeasonalModel:
+    """Fit all metrics of one client's daily history (a frame with a date column)"""
+    values = _trailing_values(history, metrics, window)
+    if values.shape[1] < MIN_OBSERVATIONS:
+        raise ValueError(f"Need at least {MIN_OBSERVATIONS} days of history, got {values.shape[1]}")
+    return fit_trend_seasonal(values, history["date"].iloc[-1], metrics)
+
+
+def _fit_groups(
+    histories: Mapping[str, pd.DataFrame], metrics: Sequence[str], window: int
+) -> Iterator[Tuple[List[str], TrendSeasonalModel]]:
+    """Batch fits of clients whose trimmed histories end on the same day with the same length
+
+    Each model holds len(metrics) consecutive series per client, in client_ids order.
+    """
+    groups: Dict[tuple, List[str]] = {}
+    trimmed = {}
+    for client_id, history in histories.items():
+        values = _trailing_values(history, metrics, window)
+        if values.shape[1] < MIN_OBSERVATIONS:
+            continue
+        trimmed[client_id] = values
+        groups.setdefault((pd.Timestamp(history["date"].iloc[-1]), values.shape[1]), []).append(client_id)
+
+    for (last_date, _), client_ids in groups.items():
+        values = np.concatenate([trimmed[client_id] for client_id in client_ids])
+        names = [metric for _ in client_ids for metric in metrics]
+        yield client_ids, fit_trend_seasonal(values, last_date, names)
+
+
+def fit_histories(
+    histories: Mapping[str, pd.DataFrame],
+    metrics: Sequence[str] = METRICS,
+    window: int = DEFAULT_WINDOW,
+) -> Dict[str, TrendSeasonalModel]:
+    """One model per client (its metrics as series), fitted in as few passes as possible
+
+    Clients with fewer than MIN_OBSERVATIONS days of history are left out.
+    """
+    n_metrics = len(metrics)
+    models = {}
+    for client_ids, model in _fit_groups(histories, metrics, window):
+        for i, client_id in enumerate(client_ids):
+            models[client_id] = model.select(slice(i * n_metrics, (i + 1) * n_metrics))
+    return models
+
+
+def forecast_histories(
+    histories: Mapping[str, pd.DataFrame],
+    metrics: Sequence[str] = METRICS,
+    horizon: int = DEFAULT_HORIZON,
+    level: float = INTERVAL_LEVEL,
+    window: int = DEFAULT_WINDOW,
+) -> Dict[str, Dict[str, Dict]]:
+    """Forecast every metric of many clients: {client_id: {metric: forecast}}
+
+    Histories are daily frames with a date column; clients with fewer than
+    MIN_OBSERVATIONS days are left out.
+    """
+    results = {}
+    n_metrics = len(metrics)
+    for client_ids, model in _fit_groups(histories, metrics, window):
+        batch = model.predict(horizon, level)
+        for i, client_id in enumerate(client_ids):
+            results[client_id] = {metric: batch.series(i * n_metrics + j) for j, metric in enumerate(metrics)}
+    return results
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Time a forecast of synthetic client histories")
+    parser.add_argument("--clients", type=int, default=10000)
+    parser.add_argument("--days", type=int, default=DEFAULT_WINDOW)
+    parser.add_argument("--horizon", type=int, default=DEFAULT_HORIZON)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    dates = pd.date_range(end=pd.Timestamp.now().normalize(), periods=args.days, freq="D")
+    trend = np.linspace(0.0, 1.0, args.days)
+    histories = {
+        f"client-{i}": pd.DataFrame({
+            "date": dates,
+            "revenue": 45000 + 5000 * trend + rng.normal(0, 2000, args.days),
+            "users": 2500 + 300 * trend + rng.normal(0, 100, args.days),
+            "properties": 1250 + 100 * trend + rng.normal(0, 50, args.days),
+            "system_health": 0.97 + rng.normal(0, 0.01, args.days),
+        })
+        for i in range(args.clients)
+    }
+
+    started = time.perf_counter()
+    forecasts = forecast_histories(histories, horizon=args.horizon)
+    elapsed = time.perf_counter() - started
+    print(f"Forecast {len(forecasts)} clients x {len(METRICS)} metrics x {args.horizon} days "
+          f"in {elapsed:.2f}s ({elapsed / max(len(forecasts), 1) * 1e6:.0f} us/client)")
+
+
+if __name__ == "__main__":
+    main()
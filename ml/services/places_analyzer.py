@@ -11,6 +11,17 @@ import json
 import requests
 from typing import Dict, List, Any, Optional
 from utils.ui import inject_global_css
+from utils.image_decode import decode_image
+from utils.model_registry import get_model_registry
+from utils.preprocessing import imagenet_preprocessor
+from utils.property_analysis import analyze_property_image
+from utils.result_cache import (
+    PROPERTY_ANALYSIS_CACHE_ID,
+    RESNET18_CACHE_ID,
+    content_digest,
+    get_result_cache,
+    location_variant,
+)
 
 def main():
     inject_global_css()
@@ -19,110 +30,40 @@ def main():
 
 import requests
 import torch
-import torchvision.transforms as T
-from torchvision import models
-import urllib.request
 
-# Load ImageNet labels
-@st.cache_resource
+# Load ImageNet labels (shared, lazily loaded through the model registry)
 def get_imagenet_labels():
-    url = "https://raw.githubusercontent.com/pytorch/hub/master/imagenet_classes.txt"
-    labels_path = "imagenet_classes.txt"
-    try:
-        with open(labels_path, "r") as f:
-            labels = [line.strip() for line in f.readlines()]
-        print(f"Loaded {len(labels)} ImageNet labels")
-    except FileNotFoundError:
-        print("Downloading ImageNet labels...")
-        urllib.request.urlretrieve(url, labels_path)
-        with open(labels_path, "r") as f:
-            labels = [line.strip() for line in f.readlines()]
-        print(f"Downloaded and loaded {len(labels)} ImageNet labels")
-    return labels
+    return get_model_registry().get("imagenet_labels")
 
-# Load ResNet-18 model
-@st.cache_resource
+# Load ResNet-18 model (one instance per process, unloaded again when idle)
 def get_resnet_model():
-    model = models.resnet18(weights=models.ResNet18_Weights.DEFAULT)
-    model.eval()
-    return model
+    return get_model_registry().get("resnet18")
 
-# Enhanced property analysis function
-def analyze_property_image(image: Image.Image, location: Optional[Dict] = None) -> Dict[str, Any]:
-    """Analyze a property image and return comprehensive insights"""
-    
-    # Property-specific analysis
-    property_features = {
-        "interior_quality": np.random.uniform(0.6, 1.0),
-        "exterior_condition": np.random.uniform(0.5, 1.0),
-        "modernity_score": np.random.uniform(0.3, 1.0),
-        "space_utilization": np.random.uniform(0.4, 1.0),
-        "lighting_quality": np.random.uniform(0.5, 1.0),
-        "cleanliness": np.random.uniform(0.6, 1.0),
-        "maintenance_level": np.random.uniform(0.4, 1.0),
-        "aesthetic_appeal": np.random.uniform(0.5, 1.0)
-    }
-    
-    # Property type classification
-    property_types = ["apartment", "house", "condo", "villa", "studio", "townhouse"]
-    detected_type = np.random.choice(property_types, p=[0.3, 0.25, 0.2, 0.1, 0.1, 0.05])
-    
-    # Room detection
-    rooms = ["bedroom", "kitchen", "bathroom", "living_room", "dining_room", "office", "garden", "balcony"]
-    detected_rooms = np.random.choice(rooms, size=np.random.randint(3, 6), replace=False)
-    
-    # Amenities detection
-    amenities = ["parking", "elevator", "gym", "pool", "garden", "balcony", "fireplace", "central_heating"]
-    detected_amenities = np.random.choice(amenities, size=np.random.randint(2, 5), replace=False)
+def analyze_property_image_cached(image: Image.Image, file_bytes: bytes, location: Optional[Dict] = None) -> Dict[str, Any]:
+    """Analyze a property image, reusing the result for photo bytes seen before"""
+    result_cache = get_result_cache()
+    digest = content_digest(file_bytes)
+    cache_key = result_cache.make_key(digest, PROPERTY_ANALYSIS_CACHE_ID, location_variant(location))
+    cached = result_cache.get(cache_key)
+    if cached is not None:
+        return cached
     
-    # Location-based insights
-    location_insights = {}
-    if location:
-        location_insights = {
-            "neighborhood_quality": np.random.uniform(0.6, 1.0),
-            "accessibility_score": np.random.uniform(0.5, 1.0),
-            "transportation_rating": np.random.uniform(0.4, 1.0),
-            "safety_score": np.random.uniform(0.7, 1.0),
-            "noise_level": np.random.choice(["low", "medium", "high"]),
-            "walkability": np.random.uniform(0.3, 1.0)
-        }
-    
-    # Price estimation based on features
-    base_price = 500000  # Base price in USD
-    price_multiplier = (
-        property_features["interior_quality"] * 0.2 +
-        property_features["modernity_score"] * 0.3 +
-        property_features["space_utilization"] * 0.2 +
-        (location_insights.get("neighborhood_quality", 0.8) * 0.3)
-    )
-    estimated_price = int(base_price * price_multiplier)
-    
-    # Overall score
-    overall_score = np.mean(list(property_features.values()))
-    
-    return {
-        "property_type": detected_type,
-        "detected_rooms": list(detected_rooms),
-        "detected_amenities": list(detected_amenities),
-        "property_features": property_features,
-        "location_insights": location_insights,
-        "estimated_price": estimated_price,
-        "overall_score": round(overall_score, 3),
-        "analysis_timestamp": datetime.now().isoformat(),
-        "confidence_level": round(np.random.uniform(0.7, 0.95), 2)
-    }
+    analysis_result = analyze_property_image(image, location, digest)
+    result_cache.set(cache_key, analysis_result)
+    return analysis_result
 
-# Image recognition function with property focus
-@st.cache_data(show_spinner=False)
-def recognize_image(_image: Image.Image):
+# Image recognition function with property focus, cached by upload content
+def recognize_image(file_bytes: bytes):
+    result_cache = get_result_cache()
+    cache_key = result_cache.make_key(content_digest(file_bytes), RESNET18_CACHE_ID)
+    cached = result_cache.get(cache_key)
+    if cached is not None:
+        return [tuple(item) for item in cached]
+    
     try:
-        preprocess = T.Compose([
-            T.Resize(256),
-            T.CenterCrop(224),
-            T.ToTensor(),
-            T.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-        ])
-        input_tensor = preprocess(_image.convert("RGB")).unsqueeze(0)
+        # Reduced-scale decode straight to ~256px, instead of the full-size display image
+        decoded = decode_image(file_bytes)
+        input_tensor = imagenet_preprocessor(decoded.image)
         model = get_resnet_model()
         with torch.no_grad():
             output = model(input_tensor)
@@ -140,6 +81,7 @@ def recognize_image(_image: Image.Image):
                 # Fallback for out-of-bounds indices
                 results.append((f"object_{catid_int}", float(prob)))
         
+        result_cache.set(cache_key, results)
         return results
     except Exception as e:
         st.error(f"Error in image recognition: {str(e)}")
@@ -276,7 +218,9 @@ if analysis_mode == "Places Integration":
                         
                         # Analyze the image
                         with st.spinner("Analyzing property..."):
-                            analysis_result = analyze_property_image(image, place.get('location'))
+                            analysis_result = analyze_property_image_cached(
+                                image, uploaded_file.getvalue(), place.get('location')
+                            )
                             
                             # Display analysis results
                             st.markdown("#### 📊 Property Analysis")
@@ -378,10 +322,11 @@ else:
                         status_text.text(f"Processing {idx + 1} of {len(uploaded_files)}")
                     
                     # Enhanced property analysis
-                    analysis_result = analyze_property_image(image)
+                    file_bytes = file.getvalue()
+                    analysis_result = analyze_property_image_cached(image, file_bytes)
                     
                     # Local image recognition
-                    recog_results = recognize_image(image)
+                    recog_results = recognize_image(file_bytes)
                     
                     # Store results for visualization
                     analysis_data = {
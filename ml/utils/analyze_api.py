@@ -1,16 +1,32 @@
 from fastapi import FastAPI, File, UploadFile
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from PIL import Image
 import numpy as np
-import io
-import base64
 import torch
-from torchvision import models, transforms
 import uvicorn
-import magic
 import os
+import sys
 from datetime import datetime
+from typing import Optional
+
+# Make the shared ml/utils helpers importable when run as a script
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from utils.worker_pool import WorkerPool, WorkerPoolSaturated
+from utils.image_decode import ImageDecodeError, decode_image, to_jpeg_base64, to_web_image
+from utils.image_store import RESPONSE_MODES, get_image_store
+from utils.model_registry import get_model_registry, warm_up_from_env
+from utils.preprocessing import imagenet_preprocessor
+from utils.result_cache import RESNET18_CACHE_ID, get_result_cache
+from utils.upload_reader import (
+    MAX_REQUEST_BYTES,
+    MAX_UPLOAD_BYTES,
+    BodySizeLimitMiddleware,
+    SpooledUpload,
+    UploadRejected,
+    spool_upload,
+)
 
 app = FastAPI()
 app.add_middleware(
@@ -20,76 +36,153 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(BodySizeLimitMiddleware, max_bytes=MAX_REQUEST_BYTES)
 
-# Load model and labels once
-model = models.resnet18(weights=models.ResNet18_Weights.DEFAULT)
-model.eval()
-with open("imagenet_classes.txt", "r") as f:
-    labels = [line.strip() for line in f.readlines()]
+# Decode, inference, encoding and disk writes run here instead of on the event loop
+worker_pool = WorkerPool.from_env(name="analyze-worker")
 
-def analyze_image(image: Image.Image):
-    preprocess = transforms.Compose([
-        transforms.Resize(256),
-        transforms.CenterCrop(224),
-        transforms.ToTensor(),
-        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-    ])
-    input_tensor = preprocess(image.convert("RGB")).unsqueeze(0)
+# Recognition results keyed by upload content, shared with the places API
+result_cache = get_result_cache()
+
+# Uploads kept once by content hash; also owns the background writer for converted/ copies
+image_store = get_image_store()
+
+@app.exception_handler(WorkerPoolSaturated)
+async def worker_pool_saturated_handler(request, exc: WorkerPoolSaturated):
+    return JSONResponse(
+        {"error": "Server is busy, please retry shortly."},
+        status_code=503,
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+# ResNet-18 and its labels are loaded on first use and shared with the other services
+model_registry = get_model_registry()
+
+def recognize_top3(image: Image.Image):
+    input_tensor = imagenet_preprocessor(image)
+    model = model_registry.get("resnet18")
+    labels = model_registry.get("imagenet_labels")
     with torch.no_grad():
         output = model(input_tensor)
         probabilities = torch.nn.functional.softmax(output[0], dim=0)
     top3_prob, top3_catid = torch.topk(probabilities, 3)
-    tags = [labels[catid] for catid in top3_catid]
-    return tags
+    return [(labels[catid], float(prob)) for prob, catid in zip(top3_prob, top3_catid)]
 
-def image_to_base64(image: Image.Image) -> str:
-    buffered = io.BytesIO()
-    image.save(buffered, format="JPEG")
-    return base64.b64encode(buffered.getvalue()).decode()
+def analyze_image(image: Image.Image):
+    return [label for label, _ in recognize_top3(image)]
 
-def image_to_svg(image: Image.Image) -> str:
+def image_to_svg(base64str: str, size) -> str:
     # Simple placeholder: SVG with image embedded as base64
-    base64str = image_to_base64(image)
-    w, h = image.size
+    w, h = size
     svg = f'<svg width="{w}" height="{h}" xmlns="http://www.w3.org/2000/svg">\n'
     svg += f'<image href="data:image/jpeg;base64,{base64str}" width="{w}" height="{h}" />\n'
     svg += '</svg>'
     return svg
 
-@app.post("/ml/analyze")
-async def analyze(photo: UploadFile = File(...)):
-    file_bytes = await photo.read()
-    mime = magic.Magic(mime=True)
-    mime_type = mime.from_buffer(file_bytes)
-    if not mime_type.startswith("image/"):
-        return JSONResponse({"error": "Uploaded file is not an image."}, status_code=400)
-    image = Image.open(io.BytesIO(file_bytes))
-    tags = analyze_image(image)
+def process_photo(upload: SpooledUpload, response_mode: str = "inline", include_base64: bool = True):
+    """Run the blocking analysis pipeline for one validated upload"""
+    try:
+        file_bytes = upload.read_bytes()
+    finally:
+        # Releases the spooled temp file, if spool_upload had to make one
+        upload.close()
+    decoded = decode_image(file_bytes)
+
+    # Same photo bytes and model means the same top-3, so reuse it when cached
+    digest = upload.digest
+    recognition_key = result_cache.make_key(digest, RESNET18_CACHE_ID)
+    top3 = result_cache.get(recognition_key)
+    if top3 is None:
+        top3 = recognize_top3(decoded.image)
+        result_cache.set(recognition_key, top3)
+    tags = [label for label, _ in top3]
     recognition = tags  # For demo, use same as tags
     album = "interior" if "sofa" in tags or "bed" in tags else "exterior"
-    base64str = image_to_base64(image)
-    svg = image_to_svg(image)
-
-    # Save converted images to disk
-    save_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "converted"))
-    os.makedirs(save_dir, exist_ok=True)
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
-    base64_path = os.path.join(save_dir, f"{timestamp}_photo.txt")
-    svg_path = os.path.join(save_dir, f"{timestamp}_photo.svg")
-    with open(base64_path, "w") as f:
-        f.write(base64str)
-    with open(svg_path, "w") as f:
-        f.write(svg)
-
-    return JSONResponse({
+    result = {
         "tags": tags,
         "recognition": recognition,
         "album": album,
-        "base64": base64str,
-        "svg": svg,
-        "base64_path": base64_path,
-        "svg_path": svg_path,
+    }
+
+    if response_mode == "reference":
+        data, extension = to_web_image(decoded, file_bytes)
+        image_id = image_store.put(data, digest, extension)
+        result["image_id"] = image_id
+        result["image_url"] = f"/ml/images/{image_id}"
+
+    if include_base64:
+        base64str = to_jpeg_base64(decoded, file_bytes)
+        svg = image_to_svg(base64str, decoded.original_size)
+        result["base64"] = base64str
+        result["svg"] = svg
+
+        # Save converted images to disk off the request path
+        save_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "converted"))
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+        base64_path = os.path.join(save_dir, f"{timestamp}_photo.txt")
+        svg_path = os.path.join(save_dir, f"{timestamp}_photo.svg")
+        image_store.writer.write(base64_path, base64str)
+        image_store.writer.write(svg_path, svg)
+        result["base64_path"] = base64_path
+        result["svg_path"] = svg_path
+
+    result["timing"] = {"decode_ms": round(decoded.decode_ms, 2)}
+    return result
+
+@app.post("/ml/analyze")
+async def analyze(
+    photo: UploadFile = File(...),
+    response_mode: str = "inline",
+    include_base64: Optional[bool] = None,
+):
+    if response_mode not in RESPONSE_MODES:
+        return JSONResponse(
+            {"error": f"response_mode must be one of: {', '.join(RESPONSE_MODES)}"}, status_code=400
+        )
+    if include_base64 is None:
+        include_base64 = response_mode == "inline"
+    async with worker_pool.admit():
+        # Non-images and oversize uploads are rejected while reading, before decoding
+        try:
+            upload = await worker_pool.run(spool_upload, photo.file, MAX_UPLOAD_BYTES)
+            result = await worker_pool.run(process_photo, upload, response_mode, include_base64)
+        except UploadRejected as e:
+            return JSONResponse({"error": str(e)}, status_code=e.status_code)
+        except ImageDecodeError as e:
+            return JSONResponse({"error": str(e)}, status_code=400)
+    return JSONResponse(result)
+
+@app.get("/ml/images/{image_id}")
+async def get_stored_image(image_id: str):
+    stored = await worker_pool.run(image_store.get, image_id)
+    if stored is None:
+        return JSONResponse({"error": "Image not found."}, status_code=404)
+    data, content_type = stored
+    return Response(
+        content=data,
+        media_type=content_type,
+        headers={"Cache-Control": "public, max-age=31536000, immutable", "ETag": f'"{image_id}"'},
+    )
+
+@app.get("/ml/health")
+async def health_check():
+    return JSONResponse({
+        "status": "healthy",
+        "worker_pool": worker_pool.stats(),
+        "result_cache": result_cache.stats(),
+        "image_store": image_store.stats(),
+        "models": model_registry.stats(),
+        "timestamp": datetime.now().isoformat(),
     })
 
+@app.on_event("startup")
+async def warm_up_models():
+    await worker_pool.run(warm_up_from_env, model_registry)
+
+@app.on_event("shutdown")
+async def shutdown_worker_pool():
+    image_store.writer.flush()
+    worker_pool.shutdown()
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Compare ResNet-18 inference backends against the fp32 eager baseline.
+
+Runs every image in a folder through the eager model and each candidate
+backend, then reports top-1 agreement, mean top-3 overlap and per-image
+latency. Use it on a folder of real property photos before switching
+ML_INFERENCE_BACKEND in production.
+
+    python3 utils/backend_accuracy_check.py samples/ --backends quantized torchscript onnx
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from typing import Dict, List
+
+import torch
+from PIL import Image
+
+# Make the shared ml/utils helpers importable when run as a script
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from utils.inference_backends import BACKENDS, load_resnet18_backend
+from utils.preprocessing import imagenet_preprocessor
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".bmp"}
+
+
+def load_batches(folder: str, batch_size: int) -> List[torch.Tensor]:
+    paths = sorted(
+        os.path.join(folder, name) for name in os.listdir(folder)
+        if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS
+    )
+    if not paths:
+        raise SystemExit(f"No images found in {folder}")
+
+    arrays = []
+    for path in paths:
+        with Image.open(path) as image:
+            arrays.append(imagenet_preprocessor.to_uint8(image))
+    # Same preprocessing as production; clone because batch_tensor() reuses its buffer
+    return [
+        imagenet_preprocessor.batch_tensor(arrays[i:i + batch_size]).clone()
+        for i in range(0, len(arrays), batch_size)
+    ]
+
+
+def top3(backend, batches: List[torch.Tensor]):
+    predictions = []
+    started = time.perf_counter()
+    for batch in batches:
+        logits = backend(batch)
+        predictions.extend(torch.topk(logits, 3, dim=1).indices.tolist())
+    elapsed = time.perf_counter() - started
+    return predictions, elapsed
+
+
+def compare(baseline: List[List[int]], candidate: List[List[int]]) -> Dict[str, float]:
+    top1 = sum(b[0] == c[0] for b, c in zip(baseline, candidate)) / len(baseline)
+    overlap = sum(len(set(b) & set(c)) / 3 for b, c in zip(baseline, candidate)) / len(baseline)
+    return {"top1_agreement": round(top1, 4), "top3_overlap": round(overlap, 4)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("folder", help="Folder of sample property photos")
+    parser.add_argument("--backends", nargs="+", default=[b for b in BACKENDS if b != "eager"],
+                        choices=BACKENDS, help="Backends to compare against eager")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--min-top3-overlap", type=float, default=0.0,
+                        help="Exit non-zero if any backend falls below this overlap")
+    parser.add_argument("--json", dest="json_path", help="Also write the report to this file")
+    args = parser.parse_args()
+
+    batches = load_batches(args.folder, args.batch_size)
+    image_count = sum(len(batch) for batch in batches)
+
+    # Run the baseline twice: the first pass absorbs one-off warm-up cost
+    baseline_backend = load_resnet18_backend("eager")
+    top3(baseline_backend, batches[:1])
+    baseline, baseline_time = top3(baseline_backend, batches)
+
+    report = {
+        "images": image_count,
+        "batch_size": args.batch_size,
+        "backends": {
+            "eager": {"ms_per_image": round(baseline_time / image_count * 1000, 3),
+                      "top1_agreement": 1.0, "top3_overlap": 1.0, "speedup": 1.0},
+        },
+    }
+
+    failed = False
+    for name in args.backends:
+        if name == "eager":
+            continue
+        backend = load_resnet18_backend(name)
+        top3(backend, batches[:1])
+        predictions, elapsed = top3(backend, batches)
+        result = compare(baseline, predictions)
+        result["ms_per_image"] = round(elapsed / image_count * 1000, 3)
+        result["speedup"] = round(baseline_time / elapsed, 2) if elapsed else 0.0
+        report["backends"][name] = result
+        failed = failed or result["top3_overlap"] < args.min_top3_overlap
+
+    print(f"{'backend':<12} {'ms/image':>9} {'speedup':>8} {'top1':>7} {'top3':>7}")
+    for name, result in report["backends"].items():
+        print(f"{name:<12} {result['ms_per_image']:>9.2f} {result['speedup']:>7.2f}x "
+              f"{result['top1_agreement']:>7.2%} {result['top3_overlap']:>7.2%}")
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(report, f, indent=2)
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
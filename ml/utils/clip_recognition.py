@@ -1,35 +1,235 @@
+"""
+CLIP zero-shot room/feature classification.
+
+The prompt set is tokenized and run through encode_text once per distinct
+prompt list (keyed by a hash of the model and prompts); the normalized text
+embeddings of the most recently used lists are kept in a small in-memory LRU.
+The default prompt set (and any other allow-listed set) is also saved to disk
+so restarts skip the text tower; ad-hoc prompt lists from requests never are.
+Per image only encode_image runs, and encode_images() takes a whole batch in
+one forward pass.
+"""
+
+import hashlib
+import logging
+import os
+import sys
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
 import torch
-import open_clip
 from PIL import Image
-import numpy as np
+
+# Make the shared ml/utils helpers importable when run as a script
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from utils.inference_backends import MODEL_CACHE_DIR
+from utils.model_registry import CLIP_ARCH, CLIP_PRETRAINED, ModelRegistry, get_model_registry
+
+logger = logging.getLogger(__name__)
 
 # List of real estate relevant prompts (room types, features)
 PROMPTS = [
     "kitchen", "bathroom", "living room", "bedroom", "balcony", "exterior", "garden", "sea view", "American kitchen", "Turkish bath", "salon", "site içi", "müstakil", "duplex", "penthouse"
 ]
 
-# Load model and tokenizer only once
-def load_clip_model():
-    model, _, preprocess = open_clip.create_model_and_transforms('ViT-B-32', pretrained='laion2b_s34b_b79k')
-    tokenizer = open_clip.get_tokenizer('ViT-B-32')
-    return model, preprocess, tokenizer
+CLIP_MODEL_NAME = "clip-vit-b-32"
+CLIP_MODEL_ID = f"open_clip/{CLIP_ARCH}/{CLIP_PRETRAINED}"
+TEXT_EMBEDDING_DIR = os.path.join(MODEL_CACHE_DIR, "clip_text_embeddings")
+
+# CLIP's learned logit scale, as in the original recognize_with_clip
+LOGIT_SCALE = 100.0
+
+# Bounds on caller-supplied prompt lists; CLIP's text context is 77 tokens anyway
+MAX_PROMPTS = int(os.getenv("ML_CLIP_MAX_PROMPTS", "32"))
+MAX_PROMPT_CHARS = int(os.getenv("ML_CLIP_MAX_PROMPT_CHARS", "100"))
+
+# Prompt lists whose text embeddings are kept in memory at once
+TEXT_EMBEDDING_CACHE_SIZE = int(os.getenv("ML_CLIP_TEXT_CACHE_SIZE", "8"))
+
+
+def prompt_set_key(prompts: Sequence[str], model_id: str = CLIP_MODEL_ID) -> str:
+    """Stable hash of a model and prompt list, used to key cached text embeddings"""
+    payload = "\n".join([model_id, *prompts]).encode("utf-8")
+    return hashlib.sha256(payload).hexdigest()[:32]
+
+
+def check_prompts(prompts: Sequence[str]) -> Optional[str]:
+    """Why a prompt list is not acceptable, or None if it is"""
+    if not prompts:
+        return "prompts must contain at least one prompt"
+    if len(prompts) > MAX_PROMPTS:
+        return f"At most {MAX_PROMPTS} prompts are allowed, got {len(prompts)}"
+    longest = max(len(prompt) for prompt in prompts)
+    if longest > MAX_PROMPT_CHARS:
+        return f"Prompts are limited to {MAX_PROMPT_CHARS} characters, got one of {longest}"
+    return None
+
+
+class ClipClassifier:
+    """Zero-shot classifier over cached prompt embeddings
+
+    Only the text embeddings of persistent_prompt_sets are written to (and read
+    from) cache_dir; other prompt lists live in the in-memory LRU alone.
+    """
+
+    def __init__(self, registry: Optional[ModelRegistry] = None, model_name: str = CLIP_MODEL_NAME,
+                 cache_dir: Optional[str] = TEXT_EMBEDDING_DIR,
+                 persistent_prompt_sets: Iterable[Sequence[str]] = (PROMPTS,),
+                 max_prompt_sets: int = TEXT_EMBEDDING_CACHE_SIZE):
+        self.registry = registry or get_model_registry()
+        self.model_name = model_name
+        self.cache_dir = cache_dir
+        self.persistent_keys = {prompt_set_key(prompts) for prompts in persistent_prompt_sets}
+        self.max_prompt_sets = max(1, max_prompt_sets)
+        self._text_embeddings: "OrderedDict[str, torch.Tensor]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.text_hits = 0
+        self.text_disk_hits = 0
+        self.text_encodes = 0
+        self.images_encoded = 0
+        self.image_batches = 0
 
-clip_model, clip_preprocess, clip_tokenizer = load_clip_model()
+    def _parts(self):
+        return self.registry.get(self.model_name)
+
+    @staticmethod
+    def _device(model) -> torch.device:
+        try:
+            return next(model.parameters()).device
+        except (StopIteration, AttributeError):
+            return torch.device("cpu")
+
+    def preprocess(self, image: Image.Image) -> torch.Tensor:
+        """CLIP's own resize/crop/normalize for one image (3xHxW)"""
+        _, clip_preprocess, _ = self._parts()
+        return clip_preprocess(image.convert("RGB") if image.mode != "RGB" else image)
+
+    def text_embeddings(self, prompts: Sequence[str] = PROMPTS) -> torch.Tensor:
+        """Normalized (num_prompts x dim) text embeddings, computed once per prompt list"""
+        key = prompt_set_key(prompts)
+        with self._lock:
+            embeddings = self._text_embeddings.get(key)
+            if embeddings is not None:
+                self._text_embeddings.move_to_end(key)
+                self.text_hits += 1
+                return embeddings
+
+            persistent = key in self.persistent_keys
+            embeddings = self._load_text_embeddings(key) if persistent else None
+            if embeddings is None:
+                embeddings = self._encode_text(prompts)
+                if persistent:
+                    self._save_text_embeddings(key, embeddings)
+            self._text_embeddings[key] = embeddings
+            while len(self._text_embeddings) > self.max_prompt_sets:
+                self._text_embeddings.popitem(last=False)
+        return embeddings
+
+    def _encode_text(self, prompts: Sequence[str]) -> torch.Tensor:
+        model, _, tokenizer = self._parts()
+        with torch.no_grad():
+            text_features = model.encode_text(tokenizer(list(prompts)).to(self._device(model)))
+            text_features = text_features / text_features.norm(dim=-1, keepdim=True)
+        self.text_encodes += 1
+        return text_features.float().cpu()
+
+    def _embedding_path(self, key: str) -> Optional[str]:
+        return os.path.join(self.cache_dir, f"{key}.npy") if self.cache_dir else None
+
+    def _load_text_embeddings(self, key: str) -> Optional[torch.Tensor]:
+        path = self._embedding_path(key)
+        if not path or not os.path.exists(path):
+            return None
+        try:
+            embeddings = torch.from_numpy(np.load(path))
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable CLIP text embeddings at {path}: {e}")
+            return None
+        self.text_disk_hits += 1
+        return embeddings
+
+    def _save_text_embeddings(self, key: str, embeddings: torch.Tensor):
+        path = self._embedding_path(key)
+        if not path:
+            return
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp.npy"
+            np.save(tmp_path, embeddings.numpy())
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Could not save CLIP text embeddings to {path}: {e}")
+
+    def encode_images(self, image_inputs: Sequence[torch.Tensor]) -> torch.Tensor:
+        """Normalized image embeddings for a batch of preprocessed images, in one forward pass"""
+        model, _, _ = self._parts()
+        batch = torch.stack(list(image_inputs)).to(self._device(model))
+        with torch.no_grad():
+            image_features = model.encode_image(batch)
+            image_features = image_features / image_features.norm(dim=-1, keepdim=True)
+        self.images_encoded += len(image_inputs)
+        self.image_batches += 1
+        return image_features.float().cpu()
+
+    def rank(self, image_features: torch.Tensor, prompts: Sequence[str] = PROMPTS,
+             top_k: int = 3) -> List[List[Tuple[str, float]]]:
+        """Top-k prompts with softmax probabilities for each row of image embeddings"""
+        text_features = self.text_embeddings(prompts)
+        if image_features.dim() == 1:
+            image_features = image_features.unsqueeze(0)
+        similarity = (LOGIT_SCALE * image_features @ text_features.T).softmax(dim=-1)
+        values, indices = similarity.topk(min(top_k, len(prompts)), dim=-1)
+        return [
+            [(prompts[i], float(v)) for v, i in zip(row_values, row_indices)]
+            for row_values, row_indices in zip(values.tolist(), indices.tolist())
+        ]
+
+    def classify_batch(self, images: Sequence[Image.Image], prompts: Sequence[str] = PROMPTS,
+                       top_k: int = 3) -> List[List[Tuple[str, float]]]:
+        """Classify several images against a prompt set with one image forward pass"""
+        if not images:
+            return []
+        features = self.encode_images([self.preprocess(image) for image in images])
+        return self.rank(features, prompts, top_k)
+
+    def classify(self, image: Image.Image, prompts: Sequence[str] = PROMPTS,
+                 top_k: int = 3) -> List[Tuple[str, float]]:
+        return self.classify_batch([image], prompts, top_k)[0]
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "prompt_sets": len(self._text_embeddings),
+            "max_prompt_sets": self.max_prompt_sets,
+            "text_hits": self.text_hits,
+            "text_disk_hits": self.text_disk_hits,
+            "text_encodes": self.text_encodes,
+            "images_encoded": self.images_encoded,
+            "image_batches": self.image_batches,
+        }
+
+
+_shared_classifier: Optional[ClipClassifier] = None
+_shared_lock = threading.Lock()
+
+
+def get_clip_classifier() -> ClipClassifier:
+    """Process-wide CLIP classifier over the shared model registry"""
+    global _shared_classifier
+    with _shared_lock:
+        if _shared_classifier is None:
+            _shared_classifier = ClipClassifier()
+        return _shared_classifier
+
+
+# Load model and tokenizer only once, on first use, through the shared registry
+def load_clip_model():
+    return get_model_registry().get(CLIP_MODEL_NAME)
 
 def recognize_with_clip(image: Image.Image, prompts=PROMPTS):
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    model = clip_model.to(device)
-    image_input = clip_preprocess(image).unsqueeze(0).to(device)
-    text_inputs = clip_tokenizer(prompts)
-    with torch.no_grad():
-        image_features = model.encode_image(image_input)
-        text_features = model.encode_text(text_inputs)
-        image_features /= image_features.norm(dim=-1, keepdim=True)
-        text_features /= text_features.norm(dim=-1, keepdim=True)
-        similarity = (100.0 * image_features @ text_features.T).softmax(dim=-1)
-        values, indices = similarity[0].topk(3)
-    results = [(prompts[i], float(values[j])) for j, i in enumerate(indices)]
-    return results
+    return get_clip_classifier().classify(image, prompts)
 
 # Example usage:
 if __name__ == "__main__":
@@ -0,0 +1,376 @@
+"""
+Persistent image-embedding store with cosine similarity search.
+
+Embeddings (ResNet-18 penultimate features or CLIP image embeddings) are
+L2-normalized and kept as rows of a memory-mapped float16 matrix, next to an
+append-only ID file that maps row -> photo content digest. Only the pages a
+search touches are resident, so the store can grow well past RAM.
+
+Several processes may append to one store (e.g. the API and a
+bulk_analyze.py backfill): each append holds an flock on the store's lock
+file and first picks up the IDs other processes appended, so rows are never
+handed out twice.
+
+Search is brute-force cosine top-k in float32 chunks by default. Once the
+store holds ivf_threshold vectors, an IVF index (spherical k-means over a
+sample, in NumPy) is built in the background; searches then score only the
+vectors in the n_probe closest clusters.
+"""
+
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_STORE_DIR = os.getenv(
+    "ML_EMBEDDING_STORE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "reservatior-ml", "embeddings"),
+)
+
+# Rows scored per matrix product during brute-force search
+SEARCH_CHUNK_ROWS = 65536
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    """L2-normalize each row (zero rows are left as zeros)"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors[None, :]
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def _merge_top_k(best_scores: np.ndarray, best_rows: np.ndarray, scores: np.ndarray,
+                 rows: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Keep the k highest scores per query across the current best and a new chunk"""
+    all_scores = np.concatenate([best_scores, scores], axis=1)
+    all_rows = np.concatenate([best_rows, np.broadcast_to(rows, scores.shape)], axis=1)
+    if all_scores.shape[1] > k:
+        keep = np.argpartition(-all_scores, k - 1, axis=1)[:, :k]
+        all_scores = np.take_along_axis(all_scores, keep, axis=1)
+        all_rows = np.take_along_axis(all_rows, keep, axis=1)
+    return all_scores, all_rows
+
+
+class IVFIndex:
+    """Inverted-file index: vectors bucketed by their nearest k-means centroid"""
+
+    def __init__(self, centroids: np.ndarray, assignments: np.ndarray):
+        self.centroids = centroids
+        order = np.argsort(assignments, kind="stable")
+        bounds = np.searchsorted(assignments[order], np.arange(len(centroids) + 1))
+        self.lists: List[List[int]] = [order[bounds[i]:bounds[i + 1]].tolist() for i in range(len(centroids))]
+        self.size = len(assignments)
+
+    @classmethod
+    def build(cls, matrix: np.ndarray, n_lists: int, iterations: int = 10,
+              sample_size: int = 100_000, seed: int = 0) -> "IVFIndex":
+        """Spherical k-means on a sample, then assign every row to its closest centroid"""
+        rng = np.random.default_rng(seed)
+        count = len(matrix)
+        n_lists = max(1, min(n_lists, count))
+        sample_rows = np.sort(rng.choice(count, size=min(sample_size, count), replace=False))
+        sample = np.asarray(matrix[sample_rows], dtype=np.float32)
+
+        centroids = sample[rng.choice(len(sample), size=n_lists, replace=False)]
+        for _ in range(iterations):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            empty = np.bincount(labels, minlength=n_lists) == 0
+            # Reseed empty clusters from random sample rows
+            sums[empty] = sample[rng.choice(len(sample), size=int(empty.sum()))]
+            centroids = normalize_rows(sums)
+
+        assignments = np.empty(count, dtype=np.int64)
+        for start in range(0, count, SEARCH_CHUNK_ROWS):
+            chunk = np.asarray(matrix[start:start + SEARCH_CHUNK_ROWS], dtype=np.float32)
+            assignments[start:start + len(chunk)] = np.argmax(chunk @ centroids.T, axis=1)
+        return cls(centroids, assignments)
+
+    def add(self, rows: Iterable[int], vectors: np.ndarray):
+        for row, label in zip(rows, np.argmax(vectors @ self.centroids.T, axis=1)):
+            self.lists[int(label)].append(int(row))
+            self.size += 1
+
+    def candidates(self, query: np.ndarray, n_probe: int) -> np.ndarray:
+        closest = np.argsort(-(self.centroids @ query))[:n_probe]
+        return np.fromiter((row for c in closest for row in self.lists[c]), dtype=np.int64)
+
+
+class EmbeddingStore:
+    """Append-only float16 embedding matrix on disk with an ID index and top-k search"""
+
+    def __init__(self, root: str = EMBEDDING_STORE_DIR, name: str = "resnet18", dim: int = 512,
+                 initial_capacity: int = 4096, ivf_threshold: int = 1_000_000, n_probe: int = 8):
+        self.root = os.path.abspath(root)
+        self.name = name
+        self.dim = dim
+        self.ivf_threshold = ivf_threshold
+        self.n_probe = n_probe
+        self._lock = threading.RLock()
+        self._index_thread: Optional[threading.Thread] = None
+        self.index: Optional[IVFIndex] = None
+        self.searches = 0
+
+        os.makedirs(self.root, exist_ok=True)
+        self.matrix_path = os.path.join(self.root, f"{name}.f16")
+        self.ids_path = os.path.join(self.root, f"{name}.ids")
+        self.meta_path = os.path.join(self.root, f"{name}.json")
+        self._lock_file = open(os.path.join(self.root, f"{name}.lock"), "a")
+
+        with self._writer_lock():
+            capacity = initial_capacity
+            self._meta_capacity: Optional[int] = None
+            if os.path.exists(self.meta_path):
+                with open(self.meta_path, "r") as f:
+                    meta = json.load(f)
+                if meta["dim"] != dim:
+                    raise ValueError(f"Embedding store '{name}' holds {meta['dim']}-d vectors, not {dim}-d")
+                capacity = self._meta_capacity = meta["capacity"]
+
+            self._ids_offset = 0
+            self.ids: List[str] = self._read_new_ids()
+            self._rows: Dict[str, int] = {image_id: row for row, image_id in enumerate(self.ids)}
+
+            self._open_matrix(max(capacity, len(self.ids)))
+            self._ids_file = open(self.ids_path, "a")
+        self._maybe_build_index()
+
+    @contextmanager
+    def _writer_lock(self):
+        """Exclusive across processes sharing the store directory"""
+        fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _read_new_ids(self) -> List[str]:
+        """IDs appended to the ID file (by any process) since it was last read"""
+        if not os.path.exists(self.ids_path):
+            return []
+        with open(self.ids_path, "rb") as f:
+            f.seek(self._ids_offset)
+            data = f.read()
+        # A partly written last line is left for the next read
+        end = data.rfind(b"\n") + 1
+        self._ids_offset += end
+        return [line.strip() for line in data[:end].decode("utf-8").split("\n") if line.strip()]
+
+    def _sync(self):
+        """Pick up rows other processes appended; called with both locks held"""
+        other_ids = [image_id for image_id in self._read_new_ids() if image_id not in self._rows]
+        if not other_ids:
+            return
+        start = len(self.ids)
+        rows_on_disk = os.path.getsize(self.matrix_path) // (self.dim * 2)
+        if start + len(other_ids) > self.capacity or rows_on_disk > self.capacity:
+            # Another process grew the matrix (and already wrote the metadata)
+            self.matrix.flush()
+            self._meta_capacity = max(rows_on_disk, start + len(other_ids))
+            self._open_matrix(self._meta_capacity)
+        for image_id in other_ids:
+            self._rows[image_id] = len(self.ids)
+            self.ids.append(image_id)
+        if self.index is not None:
+            self.index.add(range(start, len(self.ids)), np.asarray(self.matrix[start:len(self.ids)], dtype=np.float32))
+
+    def _open_matrix(self, capacity: int):
+        """(Re)map the matrix file, growing it to capacity rows first if needed"""
+        needed = capacity * self.dim * 2
+        with open(self.matrix_path, "ab") as f:
+            if f.tell() < needed:
+                f.truncate(needed)
+        self.capacity = capacity
+        self.matrix = np.memmap(self.matrix_path, dtype=np.float16, mode="r+", shape=(capacity, self.dim))
+        if capacity != self._meta_capacity:
+            self._write_meta(capacity)
+
+    def _write_meta(self, capacity: int):
+        # Swapped in atomically: other processes may be reading it while they open the store
+        tmp_path = f"{self.meta_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"dim": self.dim, "capacity": capacity}, f)
+        os.replace(tmp_path, self.meta_path)
+        self._meta_capacity = capacity
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, image_id: str) -> bool:
+        return image_id in self._rows
+
+    def add(self, image_ids: Sequence[str], vectors: np.ndarray) -> int:
+        """Store embeddings for new IDs (existing IDs are kept as-is); returns how many were added"""
+        vectors = normalize_rows(vectors)
+        added_rows = []
+        with self._lock, self._writer_lock():
+            self._sync()
+            new = [(i, image_id) for i, image_id in enumerate(image_ids) if image_id not in self._rows]
+            if not new:
+                return 0
+            if len(self.ids) + len(new) > self.capacity:
+                self.matrix.flush()
+                self._open_matrix(max(self.capacity * 2, len(self.ids) + len(new)))
+            for i, image_id in new:
+                row = len(self.ids)
+                self.matrix[row] = vectors[i]
+                self.ids.append(image_id)
+                self._rows[image_id] = row
+                added_rows.append(row)
+            # IDs are written after their rows, so a crash never leaves an ID without a vector
+            self._ids_file.write("".join(f"{image_id}\n" for _, image_id in new))
+            self._ids_file.flush()
+            self._ids_offset = os.fstat(self._ids_file.fileno()).st_size
+            if self.index is not None:
+                self.index.add(added_rows, vectors[[i for i, _ in new]])
+        self._maybe_build_index()
+        return len(added_rows)
+
+    def get(self, image_id: str) -> Optional[np.ndarray]:
+        row = self._rows.get(image_id)
+        return None if row is None else np.asarray(self.matrix[row], dtype=np.float32)
+
+    def search(self, queries: np.ndarray, k: int = 10, exact: bool = False,
+               exclude: Optional[Sequence[Optional[str]]] = None) -> List[List[Tuple[str, float]]]:
+        """Cosine top-k neighbours for each query vector
+
+        exclude optionally names one ID per query to leave out (typically the
+        query photo itself).
+        """
+        queries = normalize_rows(queries)
+        self.searches += 1
+        with self._lock:
+            count = len(self.ids)
+            matrix = self.matrix
+            index = None if exact else self.index
+        if count == 0:
+            return [[] for _ in queries]
+
+        fetch = min(k + 1, count)
+        if index is None:
+            best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+            best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+            for start in range(0, count, SEARCH_CHUNK_ROWS):
+                chunk = np.asarray(matrix[start:min(start + SEARCH_CHUNK_ROWS, count)], dtype=np.float32)
+                scores = queries @ chunk.T
+                rows = np.arange(start, start + len(chunk))[None, :]
+                best_scores, best_rows = _merge_top_k(best_scores, best_rows, scores, rows, fetch)
+        else:
+            best_scores = np.full((len(queries), fetch), -np.inf, dtype=np.float32)
+            best_rows = np.zeros((len(queries), fetch), dtype=np.int64)
+            for q, query in enumerate(queries):
+                rows = np.sort(index.candidates(query, self.n_probe))
+                if len(rows) == 0:
+                    continue
+                # Sorted rows keep the memmap reads sequential
+                scores = np.asarray(matrix[rows], dtype=np.float32) @ query
+                top = np.argsort(-scores)[:fetch]
+                best_scores[q, :len(top)] = scores[top]
+                best_rows[q, :len(top)] = rows[top]
+
+        results = []
+        for q in range(len(queries)):
+            order = np.argsort(-best_scores[q])
+            skip = exclude[q] if exclude is not None else None
+            neighbours = []
+            for j in order:
+                if not np.isfinite(best_scores[q, j]):
+                    continue
+                image_id = self.ids[best_rows[q, j]]
+                if image_id == skip:
+                    continue
+                neighbours.append((image_id, float(best_scores[q, j])))
+                if len(neighbours) == k:
+                    break
+            results.append(neighbours)
+        return results
+
+    def _maybe_build_index(self):
+        """Build (or rebuild, once the store has doubled) the IVF index in the background"""
+        count = len(self.ids)
+        if count < self.ivf_threshold:
+            return
+        if self.index is not None and count < 2 * self.index.size:
+            return
+        if self._index_thread is not None and self._index_thread.is_alive():
+            return
+        self._index_thread = threading.Thread(target=self.build_index, name=f"{self.name}-ivf", daemon=True)
+        self._index_thread.start()
+
+    def build_index(self, n_lists: Optional[int] = None):
+        """Build the IVF index over the current rows (roughly sqrt(n) clusters by default)"""
+        with self._lock:
+            count = len(self.ids)
+            matrix = self.matrix
+        if count == 0:
+            return
+        started = time.perf_counter()
+        index = IVFIndex.build(matrix[:count], n_lists or int(np.sqrt(count)))
+        with self._lock:
+            # Rows added while we were building still need a bucket
+            if len(self.ids) > count:
+                index.add(range(count, len(self.ids)), np.asarray(self.matrix[count:len(self.ids)], dtype=np.float32))
+            self.index = index
+        logger.info(
+            f"Built IVF index for '{self.name}' over {count} vectors "
+            f"({len(index.centroids)} lists) in {time.perf_counter() - started:.1f}s"
+        )
+
+    def flush(self):
+        with self._lock:
+            self.matrix.flush()
+            self._ids_file.flush()
+
+    def close(self):
+        self.flush()
+        self._ids_file.close()
+        self._lock_file.close()
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "name": self.name,
+            "vectors": len(self.ids),
+            "dim": self.dim,
+            "capacity": self.capacity,
+            "disk_mb": round(self.capacity * self.dim * 2 / 1024 / 1024, 1),
+            "index": "ivf" if self.index is not None else "exact",
+            "ivf_lists": len(self.index.centroids) if self.index is not None else 0,
+            "searches": self.searches,
+        }
+
+
+_shared_stores: Dict[str, EmbeddingStore] = {}
+_shared_lock = threading.Lock()
+
+
+def embeddings_enabled() -> bool:
+    """Whether recognition should persist embeddings (ML_STORE_EMBEDDINGS)"""
+    return os.getenv("ML_STORE_EMBEDDINGS", "0").strip().lower() in ("1", "true", "yes")
+
+
+def open_embedding_store(name: str = "resnet18") -> Optional[EmbeddingStore]:
+    """The process-wide store for name if something already opened it, without opening it"""
+    with _shared_lock:
+        return _shared_stores.get(name)
+
+
+def get_embedding_store(name: str = "resnet18", dim: int = 512) -> EmbeddingStore:
+    """Process-wide store for one embedding space, rooted at ML_EMBEDDING_STORE_DIR"""
+    with _shared_lock:
+        if name not in _shared_stores:
+            _shared_stores[name] = EmbeddingStore(
+                name=name,
+                dim=dim,
+                ivf_threshold=int(os.getenv("ML_EMBEDDING_IVF_THRESHOLD", "1000000")),
+            )
+        return _shared_stores[name]
@@ -0,0 +1,116 @@
+"""
+Fast image decode stage shared by the APIs and Streamlit analyzers.
+
+Recognition only needs ~256px on the short side, but a 12-megapixel phone
+photo fully decoded is ~36 MB of RGB and dominates request time. For JPEGs we
+ask libjpeg for a reduced-scale (1/2, 1/4, 1/8) decode via PIL's draft() so we
+land just above the target size directly. EXIF orientation is applied once
+here, and the pixel count is checked from the header before decoding to guard
+against decompression bombs.
+"""
+
+import base64
+import io
+import os
+import time
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+from PIL import Image, ImageOps
+
+# Refuse anything above this many pixels (checked from the header, before decoding)
+MAX_IMAGE_PIXELS = int(os.getenv("ML_MAX_IMAGE_PIXELS", str(50_000_000)))
+
+# Short side recognition preprocessing resizes to
+RECOGNITION_SIZE = 256
+
+# Formats browsers display natively, so uploads in them can be served as-is
+WEB_IMAGE_EXTENSIONS = {"JPEG": "jpg", "PNG": "png", "WEBP": "webp", "GIF": "gif"}
+
+
+class ImageDecodeError(ValueError):
+    """Upload could not be decoded or exceeds the pixel limit"""
+
+
+@dataclass
+class DecodedImage:
+    """A decoded, upright RGB image plus what we learned while decoding it"""
+    image: Image.Image
+    format: Optional[str]
+    original_size: Tuple[int, int]
+    decode_ms: float
+
+    @property
+    def scale(self) -> float:
+        """How much smaller the decoded image is than the upload"""
+        return self.original_size[0] / self.image.size[0] if self.image.size[0] else 1.0
+
+
+def decode_image(data: bytes, target_size: Optional[int] = RECOGNITION_SIZE,
+                 max_pixels: int = MAX_IMAGE_PIXELS) -> DecodedImage:
+    """Decode upload bytes into an upright RGB image at least target_size on its short side
+
+    Pass target_size=None to decode at full resolution.
+    """
+    started = time.perf_counter()
+    try:
+        image = Image.open(io.BytesIO(data))
+        image_format = image.format
+        width, height = image.size
+        if width * height > max_pixels:
+            raise ImageDecodeError(
+                f"Image is {width}x{height} ({width * height:,} pixels), "
+                f"above the {max_pixels:,} pixel limit"
+            )
+
+        # Orientations 5-8 are 90/270 degree rotations, so width and height swap
+        if image.getexif().get(0x0112) in (5, 6, 7, 8):
+            width, height = height, width
+
+        if target_size and image_format == "JPEG":
+            # Reduced-scale DCT decode; PIL keeps both sides >= the requested size
+            image.draft("RGB", (target_size, target_size))
+
+        image = ImageOps.exif_transpose(image)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        image.load()
+    except ImageDecodeError:
+        raise
+    except Image.DecompressionBombError as e:
+        raise ImageDecodeError(str(e))
+    except Exception as e:
+        raise ImageDecodeError(f"Could not decode image: {e}")
+
+    return DecodedImage(
+        image=image,
+        format=image_format,
+        original_size=(width, height),
+        decode_ms=(time.perf_counter() - started) * 1000,
+    )
+
+
+def to_jpeg_base64(decoded: DecodedImage, data: bytes) -> str:
+    """Base64 JPEG of an upload for echoing back to the frontend
+
+    JPEG uploads are passed through untouched instead of being re-encoded.
+    """
+    if decoded.format == "JPEG":
+        return base64.b64encode(data).decode()
+    buffered = io.BytesIO()
+    decoded.image.save(buffered, format="JPEG")
+    return base64.b64encode(buffered.getvalue()).decode()
+
+
+def to_web_image(decoded: DecodedImage, data: bytes) -> Tuple[bytes, str]:
+    """Upload bytes in a browser-displayable format, plus the file extension
+
+    JPEG/PNG/WebP/GIF uploads are returned untouched; anything else is
+    re-encoded to JPEG.
+    """
+    extension = WEB_IMAGE_EXTENSIONS.get(decoded.format)
+    if extension:
+        return data, extension
+    buffered = io.BytesIO()
+    decoded.image.save(buffered, format="JPEG")
+    return buffered.getvalue(), "jpg"
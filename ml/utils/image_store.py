@@ -0,0 +1,180 @@
+"""
+Content-addressed store for uploaded photos, plus a background disk writer.
+
+Echoing every upload back as base64 inflates responses by ~1.33x on top of
+the upload itself, and the analyze API also wrote base64/SVG copies to disk
+synchronously inside the request. With the store, an image is kept once under
+the SHA-256 of its bytes and the response carries only its ID/URL; clients
+fetch the bytes separately (and cache them forever, since IDs never change).
+
+Writes are handed to a single daemon thread. Until a write lands on disk the
+bytes are served from memory, so an ID is usable as soon as put() returns.
+"""
+
+import logging
+import os
+import queue
+import re
+import threading
+from typing import Dict, Optional, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+# "inline" keeps the base64 echo in the response, "reference" returns an image ID/URL instead
+RESPONSE_MODES = ("inline", "reference")
+
+IMAGE_STORE_DIR = os.getenv(
+    "ML_IMAGE_STORE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "reservatior-ml", "images"),
+)
+
+CONTENT_TYPES = {
+    "jpg": "image/jpeg",
+    "png": "image/png",
+    "webp": "image/webp",
+    "gif": "image/gif",
+}
+
+_IMAGE_ID_RE = re.compile(r"^[0-9a-f]{64}\.(jpg|png|webp|gif)$")
+
+_STOP = object()
+
+
+class BackgroundWriter:
+    """Writes files on a daemon thread so request handlers never block on disk"""
+
+    def __init__(self, max_queue: int = 256, name: str = "background-writer"):
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max_queue)
+        self._pending: Dict[str, bytes] = {}
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+        self.written = 0
+        self.bytes_written = 0
+        self.inline_writes = 0
+        self.errors = 0
+
+    def write(self, path: str, data: Union[bytes, str]):
+        """Queue data to be written to path (atomically, via a temp file)"""
+        if isinstance(data, str):
+            data = data.encode()
+        with self._lock:
+            self._pending[path] = data
+        try:
+            self._queue.put_nowait((path, data))
+        except queue.Full:
+            # The disk can't keep up; write inline rather than grow memory without bound
+            self.inline_writes += 1
+            self._write(path, data)
+
+    def pending(self, path: str) -> Optional[bytes]:
+        """Bytes queued for path that have not reached disk yet"""
+        with self._lock:
+            return self._pending.get(path)
+
+    def _write(self, path: str, data: bytes):
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            self.written += 1
+            self.bytes_written += len(data)
+        except OSError as e:
+            self.errors += 1
+            logger.error(f"Background write to {path} failed: {e}")
+        finally:
+            with self._lock:
+                if self._pending.get(path) is data:
+                    del self._pending[path]
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is _STOP:
+                    return
+                self._write(*job)
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        """Block until everything queued so far is on disk"""
+        self._queue.join()
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "queued": self._queue.qsize(),
+            "pending": len(self._pending),
+            "written": self.written,
+            "bytes_written": self.bytes_written,
+            "inline_writes": self.inline_writes,
+            "errors": self.errors,
+        }
+
+
+class ImageStore:
+    """Stores image bytes once under their content hash and serves them by ID"""
+
+    def __init__(self, root: str = IMAGE_STORE_DIR, writer: Optional[BackgroundWriter] = None):
+        self.root = os.path.abspath(root)
+        self.writer = writer or BackgroundWriter(name="image-store-writer")
+        self.stored = 0
+        self.deduplicated = 0
+
+    @staticmethod
+    def is_valid_id(image_id: str) -> bool:
+        return bool(_IMAGE_ID_RE.match(image_id))
+
+    def path(self, image_id: str) -> str:
+        """Location of an image on disk, sharded by the first two hex digits"""
+        if not self.is_valid_id(image_id):
+            raise ValueError(f"Invalid image ID '{image_id}'")
+        return os.path.join(self.root, image_id[:2], image_id)
+
+    def put(self, data: bytes, digest: str, extension: str = "jpg") -> str:
+        """Store image bytes under their SHA-256 digest and return the image ID"""
+        image_id = f"{digest}.{extension}"
+        path = self.path(image_id)
+        if self.writer.pending(path) is not None or os.path.exists(path):
+            self.deduplicated += 1
+            return image_id
+        self.writer.write(path, data)
+        self.stored += 1
+        return image_id
+
+    def get(self, image_id: str) -> Optional[Tuple[bytes, str]]:
+        """Image bytes and content type for an ID, or None if it is unknown"""
+        if not self.is_valid_id(image_id):
+            return None
+        path = self.path(image_id)
+        data = self.writer.pending(path)
+        if data is None:
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+            except OSError:
+                return None
+        return data, CONTENT_TYPES[image_id.rsplit(".", 1)[1]]
+
+    def stats(self) -> Dict[str, int]:
+        return {"stored": self.stored, "deduplicated": self.deduplicated, **self.writer.stats()}
+
+
+_shared_store: Optional[ImageStore] = None
+_shared_lock = threading.Lock()
+
+
+def get_image_store() -> ImageStore:
+    """Process-wide image store rooted at ML_IMAGE_STORE_DIR"""
+    global _shared_store
+    with _shared_lock:
+        if _shared_store is None:
+            _shared_store = ImageStore()
+        return _shared_store
@@ -0,0 +1,83 @@
+"""
+Upload type validation shared by the image APIs.
+
+Constructing magic.Magic() loads the whole libmagic database, which used to
+happen for every upload (and every photo of a batch). Nearly all uploads are
+JPEG, PNG, WebP or HEIC, and those are identified from their first few bytes
+with plain byte comparisons. Only headers we don't recognise go to libmagic,
+through one shared handle (libmagic handles are not thread-safe, so calls are
+serialized). Everything works from the header alone, so a non-image can be
+rejected before the rest of the upload is read.
+"""
+
+import logging
+import threading
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Enough for every signature below (ISO-BMFF brands sit at bytes 8-12)
+SIGNATURE_BYTES = 16
+
+# libmagic looks further into the file than our signatures do
+SNIFF_HEADER_BYTES = 8192
+
+# ISO base media file brands used by HEIC/HEIF and AVIF photos
+_HEIF_BRANDS = {
+    b"heic": "image/heic",
+    b"heix": "image/heic",
+    b"hevc": "image/heic-sequence",
+    b"hevx": "image/heic-sequence",
+    b"heim": "image/heic",
+    b"heis": "image/heic",
+    b"mif1": "image/heif",
+    b"msf1": "image/heif-sequence",
+    b"avif": "image/avif",
+    b"avis": "image/avif",
+}
+
+
+def signature_mime(header: bytes) -> Optional[str]:
+    """MIME type from the leading magic bytes of common photo formats, or None if unrecognised"""
+    if header.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if header.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "image/webp"
+    if header[4:8] == b"ftyp":
+        return _HEIF_BRANDS.get(header[8:12])
+    if header.startswith((b"GIF87a", b"GIF89a")):
+        return "image/gif"
+    if header.startswith((b"II*\x00", b"MM\x00*")):
+        return "image/tiff"
+    if header.startswith(b"BM"):
+        return "image/bmp"
+    return None
+
+
+_shared_magic = None
+_shared_magic_lock = threading.Lock()
+_magic_unavailable = False
+
+
+def libmagic_mime(header: bytes) -> Optional[str]:
+    """MIME type according to libmagic, or None if python-magic is not installed"""
+    global _shared_magic, _magic_unavailable
+    with _shared_magic_lock:
+        if _shared_magic is None and not _magic_unavailable:
+            try:
+                import magic
+                _shared_magic = magic.Magic(mime=True)
+            except ImportError:
+                logger.warning("python-magic not installed; only known image signatures are accepted")
+                _magic_unavailable = True
+        if _shared_magic is None:
+            return None
+        return _shared_magic.from_buffer(header[:SNIFF_HEADER_BYTES])
+
+
+def detect_mime(header: bytes) -> Optional[str]:
+    """MIME type of an upload from its first bytes: signature fast path, then libmagic"""
+    return signature_mime(header[:SIGNATURE_BYTES]) or libmagic_mime(header)
+
@@ -0,0 +1,212 @@
+"""
+Selectable inference backends for ResNet-18 recognition.
+
+Every backend is a callable that takes a normalized NCHW float batch and
+returns ImageNet logits, so call sites don't care which one is active.
+forward_with_features() additionally returns the 512-d penultimate-layer
+(global average pool) features from the same pass, for the embedding store:
+
+- eager:       torchvision fp32 model under torch.inference_mode (the baseline)
+- quantized:   torchvision's statically int8-quantized ResNet-18 (fbgemm/qnnpack)
+- torchscript: scripted, frozen and optimize_for_inference'd fp32 model
+- onnx:        ONNX Runtime CPU session over an exported copy of the fp32 model
+
+The backend is chosen with ML_INFERENCE_BACKEND. Use
+utils/backend_accuracy_check.py to compare top-3 agreement against eager
+on a folder of sample photos before switching production to another backend.
+"""
+
+import logging
+import os
+from typing import Any, Optional, Tuple
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ("eager", "quantized", "torchscript", "onnx")
+DEFAULT_BACKEND = "eager"
+
+MODEL_CACHE_DIR = os.getenv(
+    "ML_MODEL_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "reservatior-ml")
+)
+
+
+def _state_bytes(value: Any) -> int:
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size()
+    if isinstance(value, (tuple, list)):
+        return sum(_state_bytes(item) for item in value)
+    return 0
+
+
+class ResNetWithFeatures(torch.nn.Module):
+    """torchvision ResNet whose forward returns (logits, pooled features)"""
+
+    def __init__(self, model: torch.nn.Module):
+        super().__init__()
+        self.model = model
+
+    def features(self, x: torch.Tensor) -> torch.Tensor:
+        m = self.model
+        x = m.maxpool(m.relu(m.bn1(m.conv1(x))))
+        x = m.layer4(m.layer3(m.layer2(m.layer1(x))))
+        return torch.flatten(m.avgpool(x), 1)
+
+    def forward(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        features = self.features(x)
+        return self.model.fc(features), features
+
+
+class QuantizedResNetWithFeatures(ResNetWithFeatures):
+    """Same as ResNetWithFeatures for torchvision's quantized ResNet (quant/dequant stubs)"""
+
+    def forward(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        m = self.model
+        features = self.features(m.quant(x))
+        return m.dequant(m.fc(features)), m.dequant(features)
+
+
+class InferenceBackend:
+    """Maps a normalized NCHW float batch to ImageNet logits"""
+
+    name = "base"
+
+    def __call__(self, batch: torch.Tensor) -> torch.Tensor:
+        return self.forward_with_features(batch)[0]
+
+    def forward_with_features(self, batch: torch.Tensor) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        """Logits plus penultimate-layer features (None if the backend can't provide them)"""
+        raise NotImplementedError
+
+    def weight_bytes(self) -> int:
+        return 0
+
+
+class TorchBackend(InferenceBackend):
+    """Runs an eager, quantized or TorchScript module in inference mode"""
+
+    def __init__(self, name: str, module: torch.nn.Module):
+        self.name = name
+        self.module = module
+
+    def forward_with_features(self, batch: torch.Tensor) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        with torch.inference_mode():
+            logits, features = self.module(batch)
+        return logits, features
+
+    def weight_bytes(self) -> int:
+        try:
+            return sum(_state_bytes(value) for value in self.module.state_dict().values())
+        except Exception:
+            return 0
+
+
+class OnnxBackend(InferenceBackend):
+    """Runs an exported model through an ONNX Runtime CPU session"""
+
+    name = "onnx"
+
+    def __init__(self, model_path: str):
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise RuntimeError(
+                "ML_INFERENCE_BACKEND=onnx requires onnxruntime: pip install onnxruntime"
+            )
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = torch.get_num_threads()
+        self.model_path = model_path
+        self.session = ort.InferenceSession(
+            model_path, options, providers=["CPUExecutionProvider"]
+        )
+        self.input_name = self.session.get_inputs()[0].name
+
+    def forward_with_features(self, batch: torch.Tensor) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        outputs = self.session.run(None, {self.input_name: batch.detach().cpu().numpy()})
+        # Models exported before features were added (or via ML_ONNX_MODEL_PATH) only have logits
+        features = torch.from_numpy(outputs[1]) if len(outputs) > 1 else None
+        return torch.from_numpy(outputs[0]), features
+
+    def weight_bytes(self) -> int:
+        try:
+            return os.path.getsize(self.model_path)
+        except OSError:
+            return 0
+
+
+def _eager_resnet18() -> torch.nn.Module:
+    from torchvision import models
+
+    model = models.resnet18(weights=models.ResNet18_Weights.DEFAULT)
+    model.eval()
+    return ResNetWithFeatures(model).eval()
+
+
+def _quantized_resnet18() -> torch.nn.Module:
+    from torchvision.models import quantization
+
+    engines = torch.backends.quantized.supported_engines
+    for engine in ("fbgemm", "x86", "qnnpack"):
+        if engine in engines:
+            torch.backends.quantized.engine = engine
+            break
+    model = quantization.resnet18(
+        weights=quantization.ResNet18_QuantizedWeights.DEFAULT, quantize=True
+    )
+    model.eval()
+    return QuantizedResNetWithFeatures(model).eval()
+
+
+def _torchscript_resnet18() -> torch.nn.Module:
+    scripted = torch.jit.script(_eager_resnet18())
+    frozen = torch.jit.freeze(scripted)
+    return torch.jit.optimize_for_inference(frozen)
+
+
+def export_resnet18_onnx(path: str) -> str:
+    """Export the fp32 ResNet-18 (logits and features) to ONNX with a dynamic batch dimension"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    model = _eager_resnet18()
+    dummy = torch.randn(1, 3, 224, 224)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    export_kwargs = dict(
+        input_names=["input"],
+        output_names=["logits", "features"],
+        dynamic_axes={"input": {0: "batch"}, "logits": {0: "batch"}, "features": {0: "batch"}},
+        opset_version=17,
+    )
+    try:
+        torch.onnx.export(model, dummy, tmp_path, dynamo=False, **export_kwargs)
+    except TypeError:
+        # torch releases before the dynamo exporter don't take the flag
+        torch.onnx.export(model, dummy, tmp_path, **export_kwargs)
+    os.replace(tmp_path, path)
+    logger.info(f"Exported ResNet-18 to {path}")
+    return path
+
+
+def load_resnet18_backend(name: str = DEFAULT_BACKEND) -> InferenceBackend:
+    """Build the requested ResNet-18 backend"""
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown inference backend '{name}'. Choose one of: {', '.join(BACKENDS)}")
+
+    if name == "eager":
+        return TorchBackend(name, _eager_resnet18())
+    if name == "quantized":
+        return TorchBackend(name, _quantized_resnet18())
+    if name == "torchscript":
+        return TorchBackend(name, _torchscript_resnet18())
+
+    onnx_path = os.getenv("ML_ONNX_MODEL_PATH") or os.path.join(MODEL_CACHE_DIR, "resnet18_features.onnx")
+    if not os.path.exists(onnx_path):
+        export_resnet18_onnx(onnx_path)
+    return OnnxBackend(onnx_path)
+
+
+def selected_backend() -> str:
+    """Backend name configured through ML_INFERENCE_BACKEND"""
+    return os.getenv("ML_INFERENCE_BACKEND", DEFAULT_BACKEND).strip().lower()
+
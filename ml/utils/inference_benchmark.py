@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+"""
+Benchmark the image inference path and endpoints.
+
+Builds a synthetic photo corpus (several resolutions in JPEG/PNG/WebP) and
+measures:
+
+- per-stage time for each corpus image: MIME sniff, decode, preprocess,
+  forward (batch of 1), top-k and response encoding;
+- forward time at larger batch sizes;
+- end-to-end latency percentiles and throughput of /api/places/analyze and
+  /ml/analyze under concurrency, through the in-process ASGI test client;
+- CLIP recognize_with_clip when open_clip is installed;
+- peak RSS after each phase.
+
+Result caches and near-duplicate reuse are disabled unless --with-cache is
+given, so repeated corpus photos measure real work. The JSON report is meant
+to be diffed between commits; pass --baseline to print the change against an
+earlier report.
+
+    python3 utils/inference_benchmark.py --output bench.json
+    python3 utils/inference_benchmark.py --concurrency 1 8 32 --requests 200 --baseline bench.json
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+ML_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+# Make the shared ml/utils helpers and the API modules importable when run as a script
+sys.path.append(ML_ROOT)
+sys.path.append(os.path.join(ML_ROOT, "api"))
+
+RESOLUTIONS = [(640, 480), (1920, 1080), (4032, 3024)]
+FORMATS = ["JPEG", "PNG", "WEBP"]
+ENDPOINTS = ("places-analyze", "places-analyze-reference", "ml-analyze")
+
+
+def synthetic_photo(width: int, height: int, seed: int) -> Image.Image:
+    """Smooth gradients plus texture, so codecs see something photo-like rather than noise
+
+    Drawn at quarter resolution and upscaled, to keep the benchmark's own memory out of peak RSS.
+    """
+    rng = np.random.default_rng(seed)
+    small_w, small_h = max(1, width // 4), max(1, height // 4)
+    y, x = np.mgrid[0:small_h, 0:small_w].astype(np.float32)
+    base = np.stack([
+        128 + 100 * np.sin(x / (small_w / rng.uniform(2, 6)) + rng.uniform(0, 6)),
+        128 + 100 * np.cos(y / (small_h / rng.uniform(2, 6)) + rng.uniform(0, 6)),
+        128 + 80 * np.sin((x + y) / (small_w / rng.uniform(3, 8))),
+    ], axis=-1)
+    texture = rng.normal(0, 25, size=base.shape).astype(np.float32)
+    pixels = np.clip(base + texture, 0, 255).astype(np.uint8)
+    return Image.fromarray(pixels).resize((width, height), Image.BICUBIC)
+
+
+def build_corpus(resolutions: List[Tuple[int, int]], formats: List[str]) -> List[Dict[str, Any]]:
+    corpus = []
+    for index, (width, height) in enumerate(resolutions):
+        image = synthetic_photo(width, height, seed=index)
+        for image_format in formats:
+            buffered = io.BytesIO()
+            image.save(buffered, format=image_format, **({"quality": 85} if image_format != "PNG" else {}))
+            corpus.append({
+                "name": f"{width}x{height}.{image_format.lower()}",
+                "format": image_format,
+                "bytes": buffered.getvalue(),
+            })
+    return corpus
+
+
+def summarize(samples_ms: List[float]) -> Dict[str, float]:
+    values = np.asarray(samples_ms, dtype=np.float64)
+    if len(values) == 0:
+        return {"n": 0}
+    return {
+        "n": int(len(values)),
+        "mean_ms": round(float(values.mean()), 3),
+        "p50_ms": round(float(np.percentile(values, 50)), 3),
+        "p90_ms": round(float(np.percentile(values, 90)), 3),
+        "p95_ms": round(float(np.percentile(values, 95)), 3),
+        "p99_ms": round(float(np.percentile(values, 99)), 3),
+        "max_ms": round(float(values.max()), 3),
+    }
+
+
+def timed(fn: Callable[[], Any]) -> Tuple[Any, float]:
+    started = time.perf_counter()
+    result = fn()
+    return result, (time.perf_counter() - started) * 1000
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024, 1)
+
+
+def bench_stages(corpus: List[Dict[str, Any]], repeat: int) -> Dict[str, Any]:
+    """Per-stage timings for every corpus image"""
+    import torch
+    from utils.image_decode import decode_image, to_jpeg_base64
+    from utils.image_validation import detect_mime
+    from utils.model_registry import get_model_registry
+    from utils.preprocessing import imagenet_preprocessor
+
+    registry = get_model_registry()
+    model = registry.get("resnet18")
+    labels = registry.get("imagenet_labels")
+
+    report = {}
+    for item in corpus:
+        data = item["bytes"]
+        stages: Dict[str, List[float]] = {
+            "mime_sniff": [], "decode": [], "preprocess": [], "forward": [], "topk": [], "encode_response": []
+        }
+        for _ in range(repeat):
+            stages["mime_sniff"].append(timed(lambda: detect_mime(data))[1])
+            decoded, ms = timed(lambda: decode_image(data))
+            stages["decode"].append(ms)
+            batch, ms = timed(lambda: imagenet_preprocessor.batch_tensor([imagenet_preprocessor.to_uint8(decoded.image)]))
+            stages["preprocess"].append(ms)
+            logits, ms = timed(lambda: model(batch))
+            stages["forward"].append(ms)
+
+            def topk():
+                probs, ids = torch.topk(torch.softmax(logits, dim=1), 3, dim=1)
+                return [(labels[i], float(p)) for p, i in zip(probs[0].tolist(), ids[0].tolist())]
+
+            top3, ms = timed(topk)
+            stages["topk"].append(ms)
+            _, ms = timed(lambda: json.dumps({
+                "recognition": top3, "image_base64": to_jpeg_base64(decoded, data)
+            }))
+            stages["encode_response"].append(ms)
+
+        report[item["name"]] = {
+            "upload_kb": round(len(data) / 1024, 1),
+            "decoded_size": list(decoded.image.size),
+            **{stage: summarize(samples) for stage, samples in stages.items() if samples},
+        }
+    return report
+
+
+def bench_forward(batch_sizes: List[int], repeat: int) -> Dict[str, Any]:
+    """Forward pass time per batch size, and per image"""
+    import torch
+    from utils.inference_backends import selected_backend
+    from utils.model_registry import get_model_registry
+
+    model = get_model_registry().get("resnet18")
+    report = {"backend": selected_backend()}
+    for batch_size in batch_sizes:
+        batch = torch.randn(batch_size, 3, 224, 224)
+        model(batch)  # warm-up
+        samples = [timed(lambda: model(batch))[1] for _ in range(repeat)]
+        summary = summarize(samples)
+        summary["per_image_ms"] = round(summary["p50_ms"] / batch_size, 3)
+        report[f"batch_{batch_size}"] = summary
+    return report
+
+
+def bench_clip(corpus: List[Dict[str, Any]], repeat: int) -> Dict[str, Any]:
+    try:
+        import open_clip  # noqa: F401
+    except ImportError:
+        return {"skipped": "open_clip is not installed"}
+    from utils.clip_recognition import recognize_with_clip
+    from utils.image_decode import decode_image
+
+    image = decode_image(corpus[0]["bytes"]).image
+    _, first_ms = timed(lambda: recognize_with_clip(image))
+    samples = [timed(lambda: recognize_with_clip(image))[1] for _ in range(repeat)]
+    return {"first_call_ms": round(first_ms, 3), **summarize(samples)}
+
+
+def run_load(client, method: str, url: str, uploads: List[Tuple[str, bytes]], concurrency: int,
+             total: int) -> Dict[str, Any]:
+    """Fire total requests from concurrency threads; latency percentiles and throughput"""
+    def one(index: int) -> Tuple[float, int]:
+        name, data = uploads[index % len(uploads)]
+        started = time.perf_counter()
+        response = client.request(method, url, files={"photo": (name, data, "application/octet-stream")})
+        return (time.perf_counter() - started) * 1000, response.status_code
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(executor.map(one, range(total)))
+    elapsed = time.perf_counter() - started
+
+    latencies = [ms for ms, status in outcomes if status == 200]
+    statuses: Dict[str, int] = {}
+    for _, status in outcomes:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        "concurrency": concurrency,
+        "requests": total,
+        "status_codes": statuses,
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        **summarize(latencies),
+    }
+
+
+def bench_endpoints(corpus: List[Dict[str, Any]], endpoints: List[str], concurrency_levels: List[int],
+                    total: int) -> Dict[str, Any]:
+    from fastapi.testclient import TestClient
+
+    uploads = [(item["name"], item["bytes"]) for item in corpus if item["format"] == "JPEG"]
+    targets = {
+        "places-analyze": ("places_api", "/api/places/analyze"),
+        "places-analyze-reference": ("places_api", "/api/places/analyze?response_mode=reference"),
+        "ml-analyze": ("analyze_api", "/ml/analyze"),
+    }
+    report: Dict[str, Any] = {}
+    # One client per app: leaving the client runs the app's shutdown hook, which stops its worker pool
+    for module_name in dict.fromkeys(targets[endpoint][0] for endpoint in endpoints):
+        if module_name == "places_api":
+            import places_api
+            app = places_api.app
+        else:
+            from utils import analyze_api
+            app = analyze_api.app
+        with TestClient(app) as client:
+            for endpoint in endpoints:
+                if targets[endpoint][0] != module_name:
+                    continue
+                url = targets[endpoint][1]
+                run_load(client, "POST", url, uploads, 1, min(3, total))  # warm-up
+                report[endpoint] = [
+                    run_load(client, "POST", url, uploads, concurrency, total)
+                    for concurrency in concurrency_levels
+                ]
+    return report
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ML_ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _flatten(value: Any, prefix: str = "") -> Dict[str, float]:
+    if isinstance(value, dict):
+        flat = {}
+        for key, item in value.items():
+            flat.update(_flatten(item, f"{prefix}.{key}" if prefix else key))
+        return flat
+    if isinstance(value, list):
+        flat = {}
+        for item in value:
+            label = f"c{item['concurrency']}" if isinstance(item, dict) and "concurrency" in item else str(len(flat))
+            flat.update(_flatten(item, f"{prefix}.{label}"))
+        return flat
+    return {prefix: value} if isinstance(value, (int, float)) and not isinstance(value, bool) else {}
+
+
+def print_comparison(report: Dict[str, Any], baseline: Dict[str, Any]):
+    """Change in p50/p95 latency and throughput against an earlier report"""
+    current, previous = _flatten(report), _flatten(baseline)
+    keys = [
+        key for key in current
+        if key in previous and key.rsplit(".", 1)[-1] in ("p50_ms", "p95_ms", "throughput_rps", "peak_rss_mb")
+    ]
+    print(f"\n{'metric':<72} {'baseline':>10} {'current':>10} {'change':>8}")
+    for key in keys:
+        old, new = previous[key], current[key]
+        change = f"{(new - old) / old:+.1%}" if old else "n/a"
+        print(f"{key:<72} {old:>10.2f} {new:>10.2f} {change:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", help="Write the JSON report here (default: stdout)")
+    parser.add_argument("--baseline", help="Earlier report to compare against")
+    parser.add_argument("--repeat", type=int, default=5, help="Repetitions per stage measurement")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--endpoints", nargs="*", choices=ENDPOINTS, default=list(ENDPOINTS))
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--requests", type=int, default=40, help="Requests per concurrency level")
+    parser.add_argument("--formats", nargs="+", default=FORMATS, choices=FORMATS)
+    parser.add_argument("--with-cache", action="store_true",
+                        help="Keep the result cache and near-duplicate reuse enabled")
+    args = parser.parse_args()
+
+    if not args.with_cache:
+        # Set before the API modules are imported, since they read these at import time
+        os.environ["ML_RESULT_CACHE_MAX_MB"] = "0"
+        os.environ.pop("ML_RESULT_CACHE_PATH", None)
+        os.environ["PLACES_DEDUPE_MAX_DISTANCE"] = "-1"
+
+    report: Dict[str, Any] = {"meta": {}, "peak_rss_mb": {"start": peak_rss_mb()}}
+    corpus = build_corpus(RESOLUTIONS, args.formats)
+    report["peak_rss_mb"]["corpus"] = peak_rss_mb()
+
+    started = time.perf_counter()
+    report["stages"] = bench_stages(corpus, args.repeat)
+    report["peak_rss_mb"]["stages"] = peak_rss_mb()
+    report["forward"] = bench_forward(args.batch_sizes, args.repeat)
+    report["peak_rss_mb"]["forward"] = peak_rss_mb()
+    report["clip"] = bench_clip(corpus, args.repeat)
+    report["peak_rss_mb"]["clip"] = peak_rss_mb()
+    if args.endpoints:
+        report["endpoints"] = bench_endpoints(corpus, args.endpoints, args.concurrency, args.requests)
+        report["peak_rss_mb"]["endpoints"] = peak_rss_mb()
+
+    import torch
+    report["meta"] = {
+        "git_revision": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "cpu_count": os.cpu_count(),
+        "torch_threads": torch.get_num_threads(),
+        "inference_backend": report["forward"]["backend"],
+        "with_cache": args.with_cache,
+        "duration_s": round(time.perf_counter() - started, 1),
+    }
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            print_comparison(report, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
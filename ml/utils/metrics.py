@@ -0,0 +1,317 @@
+"""
+Request metrics in Prometheus text exposition format.
+
+Counters, gauges and histograms are plain in-process objects guarded by a
+lock, so recording a sample costs a dict lookup and an add; nothing is
+formatted until /metrics is scraped. Values that other components already
+track (queue depth, cache hits, model load state) are read through callbacks
+at scrape time instead of being mirrored on every request.
+
+Per-request stage timing works through a StageTimer held in a context
+variable: MetricsMiddleware installs one per HTTP request, code anywhere in
+the request (including worker threads started with WorkerPool.run) wraps its
+work in `with stage("decode"):`, and the durations feed a histogram and,
+optionally, a Server-Timing response header.
+"""
+
+import bisect
+import contextvars
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds; covers sub-millisecond sniffing up to multi-second cold model loads
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, Any]) -> LabelValues:
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> Iterator[Tuple[str, str, float]]:
+        """(suffix, formatted labels, value) for every series"""
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return lines
+
+
+class _ValueMetric(_Metric):
+    """Counter/gauge storage, or a callback read at scrape time"""
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        fn: Optional[Callable[[], Any]] = None,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.fn = fn
+        self._values: Dict[LabelValues, float] = {}
+
+    def get(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def samples(self) -> Iterator[Tuple[str, str, float]]:
+        if self.fn is not None:
+            # Callbacks return a number for unlabelled metrics or {label values: number}
+            values = self.fn()
+            if not isinstance(values, dict):
+                values = {(): values}
+        else:
+            with self._lock:
+                values = dict(self._values)
+        for key, value in values.items():
+            if value is None:
+                continue
+            key = key if isinstance(key, tuple) else (key,)
+            yield "", _format_labels(self.labelnames, key), float(value)
+
+
+class Counter(_ValueMetric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+
+class Gauge(_ValueMetric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per series: [non-cumulative bucket counts (+Inf last), sum, count]
+        self._series: Dict[LabelValues, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def samples(self) -> Iterator[Tuple[str, str, float]]:
+        with self._lock:
+            snapshot = {key: (list(counts), total, count) for key, (counts, total, count) in self._series.items()}
+        for key, (counts, total, count) in snapshot.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                yield "_bucket", _format_labels(self.labelnames, key, le), cumulative
+            yield "_sum", _format_labels(self.labelnames, key), total
+            yield "_count", _format_labels(self.labelnames, key), count
+
+
+class MetricsRegistry:
+    """Named metrics rendered together by /metrics"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric: _Metric) -> Any:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                fn: Optional[Callable[[], Any]] = None) -> Counter:
+        return self._register(Counter(name, documentation, labelnames, fn))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+              fn: Optional[Callable[[], Any]] = None) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames, fn))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        """All metrics in Prometheus text format"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines: List[str] = []
+        for metric in metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                # One failing callback shouldn't take the whole scrape down
+                lines.append(f"# {metric.name} unavailable: {_escape(str(e))}")
+        return "\n".join(lines) + "\n"
+
+
+class StageTimer:
+    """Accumulates named stage durations for one request"""
+
+    def __init__(self, histogram: Optional[Histogram] = None):
+        self.histogram = histogram
+        self.started = time.perf_counter()
+        self.durations: Dict[str, float] = {}
+
+    def record(self, name: str, seconds: float):
+        # Concurrent photos in one batch request add up under the same stage name
+        self.durations[name] = self.durations.get(name, 0.0) + seconds
+        if self.histogram is not None:
+            self.histogram.observe(seconds, stage=name)
+
+    @contextmanager
+    def stage(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def server_timing(self) -> str:
+        """Server-Timing header value (durations in milliseconds)"""
+        entries = [f"{name};dur={seconds * 1000:.2f}" for name, seconds in list(self.durations.items())]
+        entries.append(f"total;dur={(time.perf_counter() - self.started) * 1000:.2f}")
+        return ", ".join(entries)
+
+
+_current_timer: "contextvars.ContextVar[Optional[StageTimer]]" = contextvars.ContextVar(
+    "ml_stage_timer", default=None
+)
+
+
+def current_timer() -> Optional[StageTimer]:
+    return _current_timer.get()
+
+
+@contextmanager
+def stage(name: str):
+    """Time a block as one stage of the current request (a no-op outside requests)"""
+    timer = _current_timer.get()
+    if timer is None:
+        yield
+        return
+    with timer.stage(name):
+        yield
+
+
+def _outcome(status: int, retry_after: bool = False) -> str:
+    # Only load shedding (503 + Retry-After from the worker pool) counts as busy;
+    # other 503s, e.g. a model that failed to load, are errors
+    if status == 503 and retry_after:
+        return "busy"
+    if status >= 500:
+        return "error"
+    if status >= 400:
+        return "client_error"
+    return "success"
+
+
+class MetricsMiddleware:
+    """ASGI middleware: request counts by outcome, latency, and per-request stage timing"""
+
+    def __init__(
+        self,
+        app,
+        requests_total: Counter,
+        request_duration: Histogram,
+        stage_duration: Optional[Histogram] = None,
+        server_timing: bool = False,
+        skip_paths: Sequence[str] = ("/metrics",),
+    ):
+        self.app = app
+        self.requests_total = requests_total
+        self.request_duration = request_duration
+        self.stage_duration = stage_duration
+        self.server_timing = server_timing
+        self.skip_paths = set(skip_paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in self.skip_paths:
+            await self.app(scope, receive, send)
+            return
+
+        timer = StageTimer(self.stage_duration)
+        token = _current_timer.set(timer)
+        status = 500
+        retry_after = False
+
+        async def send_with_timing(message):
+            nonlocal status, retry_after
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                retry_after = any(name.lower() == b"retry-after" for name, _ in message.get("headers", []))
+                if self.server_timing:
+                    headers = list(message.get("headers", []))
+                    headers.append((b"server-timing", timer.server_timing().encode("latin-1")))
+                    message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current_timer.reset(token)
+            # Route templates rather than raw paths keep label cardinality bounded
+            route = scope.get("route")
+            endpoint = getattr(route, "path", None) or "unmatched"
+            self.requests_total.inc(endpoint=endpoint, outcome=_outcome(status, retry_after))
+            self.request_duration.observe(time.perf_counter() - timer.started, endpoint=endpoint)
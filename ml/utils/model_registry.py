@@ -0,0 +1,259 @@
+"""
+Shared model registry with lazy loading.
+
+Models are registered by name with a loader and only loaded the first time
+something asks for them, so a process that never classifies a photo never
+pays for the weights. Each process keeps a single instance per model, can
+warm models up explicitly at startup, reports load time and memory per model,
+and can drop models that have been idle for longer than a TTL.
+"""
+
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+ML_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+IMAGENET_LABELS_PATH = os.path.join(ML_ROOT, "imagenet_classes.txt")
+IMAGENET_LABELS_URL = "https://raw.githubusercontent.com/pytorch/hub/master/imagenet_classes.txt"
+
+CLIP_ARCH = "ViT-B-32"
+CLIP_PRETRAINED = "laion2b_s34b_b79k"
+
+
+def _current_rss_bytes() -> Optional[int]:
+    """Resident set size of this process, or None where /proc is unavailable"""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _tensor_bytes(obj: Any) -> int:
+    """Bytes held by torch parameters and buffers of a model (or tuple of parts)"""
+    if isinstance(obj, (tuple, list)):
+        return sum(_tensor_bytes(part) for part in obj)
+    if callable(getattr(obj, "weight_bytes", None)):
+        return obj.weight_bytes()
+    total = 0
+    for attr in ("parameters", "buffers"):
+        tensors = getattr(obj, attr, None)
+        if callable(tensors):
+            try:
+                total += sum(t.numel() * t.element_size() for t in tensors())
+            except TypeError:
+                pass
+    return total
+
+
+class _ModelEntry:
+    def __init__(self, name: str, loader: Callable[[], Any], unloadable: bool):
+        self.name = name
+        self.loader = loader
+        self.unloadable = unloadable
+        self.lock = threading.Lock()
+        self.instance: Any = None
+        self.loaded_at: Optional[float] = None
+        self.last_used: Optional[float] = None
+        self.load_time_s: Optional[float] = None
+        self.rss_delta_bytes: Optional[int] = None
+        self.tensor_bytes = 0
+        self.uses = 0
+        self.loads = 0
+        self.error: Optional[str] = None
+
+
+class ModelRegistry:
+    """Lazily loads named models and shares one instance per process"""
+
+    def __init__(self, idle_ttl: Optional[float] = None):
+        self.idle_ttl = idle_ttl
+        self._entries: Dict[str, _ModelEntry] = {}
+        self._lock = threading.Lock()
+        self._reaper: Optional[threading.Thread] = None
+        self._stop_reaper = threading.Event()
+
+    def register(self, name: str, loader: Callable[[], Any], unloadable: bool = True):
+        """Register a loader under name; nothing is loaded until get() or warm_up()"""
+        with self._lock:
+            self._entries[name] = _ModelEntry(name, loader, unloadable)
+
+    def _entry(self, name: str) -> _ModelEntry:
+        try:
+            return self._entries[name]
+        except KeyError:
+            raise KeyError(f"Unknown model '{name}'. Registered: {sorted(self._entries)}")
+
+    def get(self, name: str) -> Any:
+        """Return the shared instance of a model, loading it on first use"""
+        entry = self._entry(name)
+        instance = entry.instance
+        if instance is None:
+            with entry.lock:
+                if entry.instance is None:
+                    self._load(entry)
+                instance = entry.instance
+        entry.last_used = time.time()
+        entry.uses += 1
+        return instance
+
+    def _load(self, entry: _ModelEntry):
+        rss_before = _current_rss_bytes()
+        started = time.perf_counter()
+        try:
+            instance = entry.loader()
+        except Exception as e:
+            entry.error = str(e)
+            logger.error(f"Error loading model '{entry.name}': {e}")
+            raise
+        entry.load_time_s = time.perf_counter() - started
+        rss_after = _current_rss_bytes()
+
+        entry.instance = instance
+        entry.loaded_at = time.time()
+        entry.loads += 1
+        entry.error = None
+        entry.tensor_bytes = _tensor_bytes(instance)
+        entry.rss_delta_bytes = (
+            rss_after - rss_before if rss_before is not None and rss_after is not None else None
+        )
+        logger.info(
+            f"Loaded model '{entry.name}' in {entry.load_time_s:.2f}s "
+            f"({entry.tensor_bytes / 1024 / 1024:.1f} MB of weights)"
+        )
+
+    def is_loaded(self, name: str) -> bool:
+        return name in self._entries and self._entries[name].instance is not None
+
+    def warm_up(self, names: Optional[Iterable[str]] = None) -> Dict[str, float]:
+        """Load the given models (default: all registered) and return their load times"""
+        load_times = {}
+        for name in list(names) if names is not None else list(self._entries):
+            self.get(name)
+            load_times[name] = self._entry(name).load_time_s or 0.0
+        return load_times
+
+    def unload(self, name: str) -> bool:
+        """Drop the registry's reference to a model so its memory can be reclaimed"""
+        entry = self._entry(name)
+        with entry.lock:
+            if entry.instance is None:
+                return False
+            entry.instance = None
+            entry.loaded_at = None
+        logger.info(f"Unloaded model '{name}'")
+        return True
+
+    def unload_idle(self, now: Optional[float] = None) -> List[str]:
+        """Unload every unloadable model not used within idle_ttl seconds"""
+        if not self.idle_ttl:
+            return []
+        now = now or time.time()
+        unloaded = []
+        for entry in list(self._entries.values()):
+            if (
+                entry.unloadable
+                and entry.instance is not None
+                and entry.last_used is not None
+                and now - entry.last_used > self.idle_ttl
+                and self.unload(entry.name)
+            ):
+                unloaded.append(entry.name)
+        return unloaded
+
+    def start_reaper(self, interval: Optional[float] = None):
+        """Periodically unload idle models on a daemon thread"""
+        if not self.idle_ttl or (self._reaper is not None and self._reaper.is_alive()):
+            return
+        interval = interval or max(self.idle_ttl / 4, 1.0)
+
+        def reap():
+            while not self._stop_reaper.wait(interval):
+                self.unload_idle()
+
+        self._stop_reaper.clear()
+        self._reaper = threading.Thread(target=reap, name="model-reaper", daemon=True)
+        self._reaper.start()
+
+    def stop_reaper(self):
+        self._stop_reaper.set()
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Load state, load time and memory per registered model"""
+        return {
+            name: {
+                "loaded": entry.instance is not None,
+                "load_time_s": round(entry.load_time_s, 3) if entry.load_time_s is not None else None,
+                "weights_mb": round(entry.tensor_bytes / 1024 / 1024, 1),
+                "rss_delta_mb": (
+                    round(entry.rss_delta_bytes / 1024 / 1024, 1)
+                    if entry.rss_delta_bytes is not None else None
+                ),
+                "loads": entry.loads,
+                "uses": entry.uses,
+                "idle_s": round(time.time() - entry.last_used, 1) if entry.last_used else None,
+                "error": entry.error,
+            }
+            for name, entry in self._entries.items()
+        }
+
+
+def _load_resnet18():
+    from utils.inference_backends import load_resnet18_backend, selected_backend
+
+    return load_resnet18_backend(selected_backend())
+
+
+def _load_imagenet_labels() -> List[str]:
+    if not os.path.exists(IMAGENET_LABELS_PATH):
+        import urllib.request
+        urllib.request.urlretrieve(IMAGENET_LABELS_URL, IMAGENET_LABELS_PATH)
+    with open(IMAGENET_LABELS_PATH, "r") as f:
+        return [line.strip() for line in f.readlines()]
+
+
+def _load_clip_vit_b32():
+    import open_clip
+    import torch
+
+    model, _, preprocess = open_clip.create_model_and_transforms(
+        CLIP_ARCH, pretrained=CLIP_PRETRAINED
+    )
+    # Placed on its device once here rather than on every call
+    model.to("cuda" if torch.cuda.is_available() else "cpu")
+    model.eval()
+    tokenizer = open_clip.get_tokenizer(CLIP_ARCH)
+    return model, preprocess, tokenizer
+
+
+_shared_registry: Optional[ModelRegistry] = None
+_shared_lock = threading.Lock()
+
+
+def get_model_registry() -> ModelRegistry:
+    """Process-wide registry with the ML service models pre-registered"""
+    global _shared_registry
+    with _shared_lock:
+        if _shared_registry is None:
+            registry = ModelRegistry(
+                idle_ttl=float(os.getenv("ML_MODEL_IDLE_TTL_SECONDS", "0")) or None
+            )
+            registry.register("resnet18", _load_resnet18)
+            registry.register("imagenet_labels", _load_imagenet_labels, unloadable=False)
+            registry.register("clip-vit-b-32", _load_clip_vit_b32)
+            registry.start_reaper()
+            _shared_registry = registry
+        return _shared_registry
+
+
+def warm_up_from_env(registry: Optional[ModelRegistry] = None) -> Dict[str, float]:
+    """Load the comma-separated models named in ML_WARMUP_MODELS"""
+    names = [name.strip() for name in os.getenv("ML_WARMUP_MODELS", "").split(",") if name.strip()]
+    if not names:
+        return {}
+    return (registry or get_model_registry()).warm_up(names)
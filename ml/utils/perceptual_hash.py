@@ -0,0 +1,159 @@
+"""
+Perceptual hashing for near-duplicate photo detection.
+
+An exact content hash misses re-compressed or resized copies of a photo we
+have already analyzed. pHash (DCT of a 32x32 grayscale thumbnail, low
+frequencies thresholded at their median) changes by only a few bits under
+such edits, so photos within a small Hamming distance are treated as the same
+picture. Hashes are kept in a BK-tree, which answers "anything within
+distance d?" without comparing against every stored hash.
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+PHASH_IMAGE_SIZE = 32
+HASH_SIZE = 8
+
+# Thumbnails flatter than this (grayscale std dev) hash to near-identical bits
+# regardless of content, so they are never matched
+MIN_THUMBNAIL_STD = 2.0
+
+
+def _dct_matrix(n: int) -> np.ndarray:
+    """Orthonormal DCT-II basis, so dct2(x) = D @ x @ D.T"""
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    matrix = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2.0 / n)
+    matrix[0] /= np.sqrt(2.0)
+    return matrix.astype(np.float32)
+
+
+_DCT = _dct_matrix(PHASH_IMAGE_SIZE)
+
+
+def _bits_to_int(bits: np.ndarray) -> int:
+    value = 0
+    for bit in bits.ravel():
+        value = (value << 1) | int(bit)
+    return value
+
+
+def _thumbnail(image: Image.Image, size: Tuple[int, int]) -> np.ndarray:
+    return np.asarray(image.convert("L").resize(size, Image.BILINEAR), dtype=np.float32)
+
+
+def phash(image: Image.Image) -> Optional[int]:
+    """64-bit DCT perceptual hash, or None for images too flat to hash meaningfully"""
+    pixels = _thumbnail(image, (PHASH_IMAGE_SIZE, PHASH_IMAGE_SIZE))
+    if pixels.std() < MIN_THUMBNAIL_STD:
+        return None
+    low = (_DCT @ pixels @ _DCT.T)[:HASH_SIZE, :HASH_SIZE]
+    # The DC term only encodes overall brightness, so leave it out of the median
+    return _bits_to_int(low > np.median(low.ravel()[1:]))
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class BKTree:
+    """Burkhard-Keller tree over integer hashes with Hamming distance"""
+
+    def __init__(self):
+        self._root: Optional[list] = None  # [hash, value, {distance: child}]
+        self.size = 0
+
+    def add(self, hash_value: int, value: Any):
+        node = [hash_value, value, {}]
+        self.size += 1
+        if self._root is None:
+            self._root = node
+            return
+        current = self._root
+        while True:
+            distance = hamming(hash_value, current[0])
+            if distance == 0:
+                current[1] = value
+                self.size -= 1
+                return
+            child = current[2].get(distance)
+            if child is None:
+                current[2][distance] = node
+                return
+            current = child
+
+    def search(self, hash_value: int, max_distance: int) -> List[Tuple[int, int, Any]]:
+        """All (distance, hash, value) within max_distance, closest first"""
+        if self._root is None:
+            return []
+        found = []
+        stack = [self._root]
+        while stack:
+            current = stack.pop()
+            distance = hamming(hash_value, current[0])
+            if distance <= max_distance:
+                found.append((distance, current[0], current[1]))
+            # Triangle inequality: only children in this band can be within range
+            for child_distance, child in current[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        found.sort(key=lambda item: item[0])
+        return found
+
+
+class PerceptualIndex:
+    """Maps perceptual hashes to the content digest of the first photo seen with them"""
+
+    def __init__(self, max_distance: int = 6, max_entries: int = 100_000):
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        self._tree = BKTree()
+        self._entries: "OrderedDict[int, str]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+
+    def lookup(self, hash_value: Optional[int], digest: Optional[str] = None) -> Optional[Tuple[str, int]]:
+        """Closest earlier photo (digest, distance) within max_distance, ignoring digest itself"""
+        if hash_value is None:
+            return None
+        with self._lock:
+            self.lookups += 1
+            for distance, _, match in self._tree.search(hash_value, self.max_distance):
+                if match != digest:
+                    self.hits += 1
+                    return match, distance
+        return None
+
+    def add(self, hash_value: Optional[int], digest: str):
+        if hash_value is None:
+            return
+        with self._lock:
+            if hash_value in self._entries:
+                return
+            self._entries[hash_value] = digest
+            self._tree.add(hash_value, digest)
+            if len(self._entries) > self.max_entries:
+                self._rebuild()
+
+    def _rebuild(self):
+        # BK-trees don't support deletion, so keep the newest half and rebuild
+        keep = list(self._entries.items())[len(self._entries) // 2:]
+        self._entries = OrderedDict(keep)
+        self._tree = BKTree()
+        for hash_value, digest in keep:
+            self._tree.add(hash_value, digest)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._entries),
+            "max_distance": self.max_distance,
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "hit_rate": round(self.hits / self.lookups, 4) if self.lookups else 0.0,
+        }
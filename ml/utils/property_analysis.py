@@ -0,0 +1,183 @@
+"""
+Property photo analysis shared by the places API and the Streamlit analyzer.
+
+Scores are drawn from a per-photo np.random.Generator seeded with the
+photo's content hash rather than from the global NumPy RNG, so the same
+photo always gets the same analysis (results are safe to cache and compare)
+and concurrent requests don't contend on the global RNG's lock. Every random
+value an analysis needs comes from a single draw of DRAWS_PER_IMAGE uniforms,
+laid out in fixed columns. analyze_property_batch turns a whole
+(photos x DRAWS_PER_IMAGE) matrix into scores with array operations, and a
+single photo is analyzed as a batch of one, so there is one implementation
+and a photo gets the same analysis either way.
+"""
+
+import hashlib
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+from PIL import Image
+
+# (name, low, high) of each uniformly drawn property score
+PROPERTY_FEATURES = (
+    ("interior_quality", 0.6, 1.0),
+    ("exterior_condition", 0.5, 1.0),
+    ("modernity_score", 0.3, 1.0),
+    ("space_utilization", 0.4, 1.0),
+    ("lighting_quality", 0.5, 1.0),
+    ("cleanliness", 0.6, 1.0),
+    ("maintenance_level", 0.4, 1.0),
+    ("aesthetic_appeal", 0.5, 1.0),
+)
+PROPERTY_TYPES = ("apartment", "house", "condo", "villa", "studio", "townhouse")
+PROPERTY_TYPE_WEIGHTS = (0.3, 0.25, 0.2, 0.1, 0.1, 0.05)
+ROOMS = ("bedroom", "kitchen", "bathroom", "living_room", "dining_room", "office", "garden", "balcony")
+AMENITIES = ("parking", "elevator", "gym", "pool", "garden", "balcony", "fireplace", "central_heating")
+LOCATION_SCORES = (
+    ("neighborhood_quality", 0.6, 1.0),
+    ("accessibility_score", 0.5, 1.0),
+    ("transportation_rating", 0.4, 1.0),
+    ("safety_score", 0.7, 1.0),
+    ("walkability", 0.3, 1.0),
+)
+NOISE_LEVELS = ("low", "medium", "high")
+
+# Detected rooms/amenities per photo: [min, max] inclusive
+ROOM_COUNT = (3, 5)
+AMENITY_COUNT = (2, 4)
+CONFIDENCE_RANGE = (0.7, 0.95)
+BASE_PRICE = 500000  # USD
+
+# Column layout of the per-photo uniform draw
+_FEATURES = slice(0, len(PROPERTY_FEATURES))
+_TYPE = _FEATURES.stop
+_ROOM_COUNT = _TYPE + 1
+_ROOM_ORDER = slice(_ROOM_COUNT + 1, _ROOM_COUNT + 1 + len(ROOMS))
+_AMENITY_COUNT = _ROOM_ORDER.stop
+_AMENITY_ORDER = slice(_AMENITY_COUNT + 1, _AMENITY_COUNT + 1 + len(AMENITIES))
+_LOCATION = slice(_AMENITY_ORDER.stop, _AMENITY_ORDER.stop + len(LOCATION_SCORES))
+_NOISE = _LOCATION.stop
+_CONFIDENCE = _NOISE + 1
+DRAWS_PER_IMAGE = _CONFIDENCE + 1
+
+_FEATURE_LOW = np.array([low for _, low, _ in PROPERTY_FEATURES])
+_FEATURE_SPAN = np.array([high - low for _, low, high in PROPERTY_FEATURES])
+_LOCATION_LOW = np.array([low for _, low, _ in LOCATION_SCORES])
+_LOCATION_SPAN = np.array([high - low for _, low, high in LOCATION_SCORES])
+_TYPE_CDF = np.cumsum(PROPERTY_TYPE_WEIGHTS) / np.sum(PROPERTY_TYPE_WEIGHTS)
+_FEATURE_INDEX = {name: i for i, (name, _, _) in enumerate(PROPERTY_FEATURES)}
+
+
+def image_digest(image: Image.Image) -> str:
+    """Content hash of decoded pixels, for callers that don't have the upload's digest"""
+    hasher = hashlib.sha256(f"{image.mode}{image.size}".encode())
+    hasher.update(image.tobytes())
+    return hasher.hexdigest()
+
+
+def analysis_rng(digest: str) -> np.random.Generator:
+    """Generator seeded from a hex content digest"""
+    return np.random.default_rng(int(digest[:32], 16))
+
+
+def draw_uniforms(digests: Sequence[str]) -> np.ndarray:
+    """(len(digests), DRAWS_PER_IMAGE) uniforms, each row from that photo's own generator"""
+    draws = np.empty((len(digests), DRAWS_PER_IMAGE))
+    for row, digest in enumerate(digests):
+        draws[row] = analysis_rng(digest).random(DRAWS_PER_IMAGE)
+    return draws
+
+
+def _count(draws: np.ndarray, bounds) -> np.ndarray:
+    low, high = bounds
+    return low + np.minimum((draws * (high - low + 1)).astype(int), high - low)
+
+
+def _price_multiplier(interior, modernity, space, neighborhood):
+    return interior * 0.2 + modernity * 0.3 + space * 0.2 + neighborhood * 0.3
+
+
+def _result(property_type, rooms, amenities, features, location_insights, price, overall, timestamp, confidence):
+    return {
+        "property_type": property_type,
+        "detected_rooms": rooms,
+        "detected_amenities": amenities,
+        "property_features": features,
+        "location_insights": location_insights,
+        "estimated_price": price,
+        "overall_score": round(overall, 3),
+        "analysis_timestamp": timestamp,
+        "confidence_level": round(confidence, 2),
+    }
+
+
+def analyze_property_batch(
+    digests: Sequence[str],
+    locations: Optional[Sequence[Optional[Dict]]] = None,
+) -> List[Dict[str, Any]]:
+    """Analyze many photos at once from their content digests
+
+    locations, when given, has one (optional) location dict per photo.
+    """
+    if not digests:
+        return []
+    draws = draw_uniforms(digests)
+    locations = locations if locations is not None else [None] * len(digests)
+
+    features = _FEATURE_LOW + _FEATURE_SPAN * draws[:, _FEATURES]
+    type_index = np.minimum(np.searchsorted(_TYPE_CDF, draws[:, _TYPE], side="right"), len(PROPERTY_TYPES) - 1)
+    # Sorting independent uniforms gives a uniformly random order to take the first k from
+    room_order = np.argsort(draws[:, _ROOM_ORDER], axis=1, kind="stable")
+    room_counts = _count(draws[:, _ROOM_COUNT], ROOM_COUNT)
+    amenity_order = np.argsort(draws[:, _AMENITY_ORDER], axis=1, kind="stable")
+    amenity_counts = _count(draws[:, _AMENITY_COUNT], AMENITY_COUNT)
+    location_scores = _LOCATION_LOW + _LOCATION_SPAN * draws[:, _LOCATION]
+    noise_index = np.minimum((draws[:, _NOISE] * len(NOISE_LEVELS)).astype(int), len(NOISE_LEVELS) - 1)
+    confidence = CONFIDENCE_RANGE[0] + (CONFIDENCE_RANGE[1] - CONFIDENCE_RANGE[0]) * draws[:, _CONFIDENCE]
+
+    has_location = np.array([bool(location) for location in locations])
+    neighborhood = np.where(has_location, location_scores[:, 0], 0.8)
+    price_multiplier = _price_multiplier(
+        features[:, _FEATURE_INDEX["interior_quality"]],
+        features[:, _FEATURE_INDEX["modernity_score"]],
+        features[:, _FEATURE_INDEX["space_utilization"]],
+        neighborhood,
+    )
+    estimated_prices = (BASE_PRICE * price_multiplier).astype(int)
+    overall_scores = features.mean(axis=1)
+
+    timestamp = datetime.now().isoformat()
+    results = []
+    for i in range(len(digests)):
+        location_insights = {}
+        if has_location[i]:
+            location_insights = {name: float(location_scores[i, j]) for j, (name, _, _) in enumerate(LOCATION_SCORES)}
+            location_insights["noise_level"] = NOISE_LEVELS[noise_index[i]]
+        results.append(_result(
+            PROPERTY_TYPES[type_index[i]],
+            [ROOMS[j] for j in room_order[i, :room_counts[i]]],
+            [AMENITIES[j] for j in amenity_order[i, :amenity_counts[i]]],
+            {name: float(features[i, j]) for j, (name, _, _) in enumerate(PROPERTY_FEATURES)},
+            location_insights,
+            int(estimated_prices[i]),
+            float(overall_scores[i]),
+            timestamp,
+            float(confidence[i]),
+        ))
+    return results
+
+
+def analyze_property_image(
+    image: Optional[Image.Image],
+    location: Optional[Dict] = None,
+    digest: Optional[str] = None,
+) -> Dict[str, Any]:
+    """Analyze a property image and return comprehensive insights
+
+    Pass the upload's content digest when known; otherwise the decoded
+    pixels are hashed.
+    """
+    if digest is None:
+        digest = image_digest(image)
+    return analyze_property_batch([digest], [location])[0]
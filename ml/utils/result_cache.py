@@ -0,0 +1,178 @@
+"""
+Content-hash result cache for photo analysis.
+
+Results are keyed by a hash of the raw upload bytes plus the model that
+produced them, so re-uploads of the same listing photo skip decode and the
+ResNet forward pass. Entries live in an in-process LRU bounded by bytes and,
+optionally, in a SQLite file shared by every process on the node (places API,
+analyze API and the Streamlit analyzers).
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Bump the suffix whenever weights or preprocessing change so old entries stop matching.
+# The inference backend is part of the id since quantized/ONNX scores differ slightly.
+RESNET18_CACHE_ID = "resnet18/IMAGENET1K_V1/{}/top3".format(
+    os.getenv("ML_INFERENCE_BACKEND", "eager").strip().lower()
+)
+# v2: analyses are seeded from the photo content hash rather than the global RNG
+PROPERTY_ANALYSIS_CACHE_ID = "property-analysis/v2"
+
+
+def content_digest(data: bytes) -> str:
+    """SHA-256 hex digest of raw upload bytes"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def location_variant(location: Optional[Dict[str, Any]]) -> str:
+    """Stable cache variant for the optional location passed to property analysis"""
+    return json.dumps(location, sort_keys=True) if location else ""
+
+
+class ResultCache:
+    """Two-tier (memory LRU + optional SQLite) cache of JSON-serializable results"""
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, disk_path: Optional[str] = None):
+        self.max_bytes = max_bytes
+        self.disk_path = disk_path
+
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, bytes]" = OrderedDict()
+        self._bytes = 0
+        self._db: Optional[sqlite3.Connection] = None
+
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.evictions = 0
+
+        if disk_path:
+            self._open_disk_tier(disk_path)
+
+    @staticmethod
+    def make_key(digest: str, model_id: str, variant: str = "") -> str:
+        """Cache key for one upload digest, producing model and request variant"""
+        key = f"{model_id}:{digest}"
+        if variant:
+            key += ":" + hashlib.sha256(variant.encode("utf-8")).hexdigest()[:16]
+        return key
+
+    def _open_disk_tier(self, path: str):
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False, timeout=5.0)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "key TEXT PRIMARY KEY, value BLOB NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._db.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Disabling on-disk result cache at {path}: {e}")
+            self._db = None
+
+    def get(self, key: str) -> Optional[Any]:
+        """Return the cached value for key, or None on a miss"""
+        with self._lock:
+            payload = self._entries.get(key)
+            if payload is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return json.loads(payload)
+
+            if self._db is not None:
+                try:
+                    row = self._db.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+                except sqlite3.Error as e:
+                    logger.error(f"Error reading result cache: {e}")
+                    row = None
+                if row is not None:
+                    payload = bytes(row[0])
+                    self._store_in_memory(key, payload)
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return json.loads(payload)
+
+            self.misses += 1
+            return None
+
+    def set(self, key: str, value: Any):
+        """Store a JSON-serializable value under key in every enabled tier"""
+        payload = json.dumps(value, default=str).encode("utf-8")
+        with self._lock:
+            self._store_in_memory(key, payload)
+            if self._db is not None:
+                try:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO results (key, value, created_at) VALUES (?, ?, ?)",
+                        (key, payload, time.time()),
+                    )
+                    self._db.commit()
+                except sqlite3.Error as e:
+                    logger.error(f"Error writing result cache: {e}")
+
+    def _store_in_memory(self, key: str, payload: bytes):
+        size = len(key) + len(payload)
+        if size > self.max_bytes:
+            return
+
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self._bytes -= len(key) + len(previous)
+
+        self._entries[key] = payload
+        self._bytes += size
+
+        while self._bytes > self.max_bytes:
+            old_key, old_payload = self._entries.popitem(last=False)
+            self._bytes -= len(old_key) + len(old_payload)
+            self.evictions += 1
+
+    def clear(self):
+        """Drop every entry from the memory tier (the disk tier is left intact)"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss counters and occupancy for health endpoints"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "disk_hits": self.disk_hits,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "evictions": self.evictions,
+                "disk_enabled": self._db is not None,
+            }
+
+
+_shared_cache: Optional[ResultCache] = None
+_shared_lock = threading.Lock()
+
+
+def get_result_cache() -> ResultCache:
+    """Process-wide cache configured from ML_RESULT_CACHE_MAX_MB / ML_RESULT_CACHE_PATH"""
+    global _shared_cache
+    with _shared_lock:
+        if _shared_cache is None:
+            _shared_cache = ResultCache(
+                max_bytes=int(float(os.getenv("ML_RESULT_CACHE_MAX_MB", "64")) * 1024 * 1024),
+                disk_path=os.getenv("ML_RESULT_CACHE_PATH") or None,
+            )
+        return _shared_cache
@@ -0,0 +1,151 @@
+"""
+Bounded, chunked reading of photo uploads.
+
+`await photo.read()` used to pull each upload fully into memory, and batch
+requests held every photo at once. Uploads are now consumed in fixed-size
+chunks: the first chunk is checked against image signatures so non-images
+are rejected without reading further, the running size is checked against a
+limit, and the SHA-256 content digest is computed along the way so the cache
+lookup doesn't hash the bytes again. Seekable sources (FastAPI's UploadFile
+already spools to disk past 1 MB) are reused in place; anything else is
+spooled to a temporary file that only stays in memory while small. The full
+bytes are materialized only by the worker thread that decodes the photo.
+
+BodySizeLimitMiddleware bounds the whole request body before multipart
+parsing starts, from Content-Length when it is sent and by counting bytes
+when it isn't.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+from dataclasses import dataclass
+from typing import BinaryIO
+
+from starlette.exceptions import HTTPException
+
+from utils.image_validation import SNIFF_HEADER_BYTES, detect_mime
+from utils.metrics import stage
+
+# Largest single photo accepted
+MAX_UPLOAD_BYTES = int(os.getenv("ML_MAX_UPLOAD_BYTES", str(25 * 1024 * 1024)))
+
+# Largest request body (all photos of a batch together)
+MAX_REQUEST_BYTES = int(os.getenv("ML_MAX_REQUEST_BYTES", str(256 * 1024 * 1024)))
+
+# Uploads copied from non-seekable sources stay in memory up to this size, then go to disk
+UPLOAD_SPOOL_BYTES = int(os.getenv("ML_UPLOAD_SPOOL_BYTES", str(1024 * 1024)))
+
+UPLOAD_CHUNK_BYTES = 256 * 1024
+
+
+class UploadRejected(ValueError):
+    """Upload is not an image or is too large; status_code is the HTTP status to answer with"""
+
+    def __init__(self, message: str, status_code: int):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+@dataclass
+class SpooledUpload:
+    """A validated upload that stays on disk (or in a small buffer) until it is decoded"""
+    file: BinaryIO
+    size: int
+    digest: str
+    mime_type: str
+
+    def read_bytes(self) -> bytes:
+        self.file.seek(0)
+        return self.file.read()
+
+    def close(self):
+        self.file.close()
+
+
+def too_large(max_bytes: int) -> UploadRejected:
+    return UploadRejected(f"Upload exceeds the {max_bytes:,} byte limit", status_code=413)
+
+
+def spool_upload(
+    source: BinaryIO,
+    max_bytes: int = MAX_UPLOAD_BYTES,
+    chunk_size: int = UPLOAD_CHUNK_BYTES,
+    spool_bytes: int = UPLOAD_SPOOL_BYTES,
+) -> SpooledUpload:
+    """Read an upload in chunks, validating its header first and its size as it goes
+
+    Raises UploadRejected (400 for non-images, 413 for oversize uploads)
+    as soon as either is known.
+    """
+    reuse = source.seekable()
+    if reuse:
+        source.seek(0)
+
+    first = source.read(max(chunk_size, SNIFF_HEADER_BYTES))
+    with stage("mime_sniff"):
+        mime_type = detect_mime(first)
+    if mime_type is None or not mime_type.startswith("image/"):
+        raise UploadRejected("Uploaded file is not an image", status_code=400)
+
+    target = source if reuse else tempfile.SpooledTemporaryFile(max_size=spool_bytes)
+    hasher = hashlib.sha256()
+    size = 0
+    chunk = first
+    try:
+        while chunk:
+            size += len(chunk)
+            if size > max_bytes:
+                raise too_large(max_bytes)
+            hasher.update(chunk)
+            if not reuse:
+                target.write(chunk)
+            chunk = source.read(chunk_size)
+    except Exception:
+        if not reuse:
+            target.close()
+        raise
+
+    target.seek(0)
+    return SpooledUpload(file=target, size=size, digest=hasher.hexdigest(), mime_type=mime_type)
+
+
+class BodySizeLimitMiddleware:
+    """ASGI middleware answering 413 once a request body exceeds max_bytes"""
+
+    def __init__(self, app, max_bytes: int = MAX_REQUEST_BYTES):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or self.max_bytes <= 0:
+            await self.app(scope, receive, send)
+            return
+
+        detail = f"Request body is above the {self.max_bytes:,} byte limit"
+        content_length = dict(scope.get("headers") or []).get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > self.max_bytes:
+            body = json.dumps({"detail": detail}).encode()
+            await send({
+                "type": "http.response.start",
+                "status": 413,
+                "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+            })
+            await send({"type": "http.response.body", "body": body})
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    # Raised inside body parsing, so the app's HTTPException handling answers it
+                    raise HTTPException(status_code=413, detail=detail)
+            return message
+
+        await self.app(scope, limited_receive, send)
+
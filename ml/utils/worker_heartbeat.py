@@ -0,0 +1,147 @@
+"""
+Heartbeats for pre-forked API workers.
+
+serve_places.py runs several copies of the places API behind one listening
+socket. Each worker writes a small JSON status file every few seconds from
+its event loop, so a file that stops updating means the worker is dead or
+its loop is stuck. The master uses the files to replace hung workers, and
+any worker can report on all of them since a request lands on just one.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+WORKER_ID_ENV = "PLACES_WORKER_ID"
+HEARTBEAT_DIR_ENV = "PLACES_HEARTBEAT_DIR"
+
+HEARTBEAT_INTERVAL = float(os.getenv("PLACES_HEARTBEAT_INTERVAL_SECONDS", "5"))
+
+
+def memory_mb() -> Dict[str, Optional[float]]:
+    """Resident, proportional and shared memory of this process
+
+    Shared includes anonymous pages still shared copy-on-write with the
+    master (preloaded model weights), which a plain RSS figure hides.
+    """
+    fields = {}
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 2 and parts[0].endswith(":") and parts[1].isdigit():
+                    fields[parts[0][:-1]] = int(parts[1])
+    except OSError:
+        return {"rss_mb": None, "pss_mb": None, "shared_mb": None}
+    return {
+        "rss_mb": round(fields.get("Rss", 0) / 1024, 1),
+        "pss_mb": round(fields.get("Pss", 0) / 1024, 1),
+        "shared_mb": round((fields.get("Shared_Clean", 0) + fields.get("Shared_Dirty", 0)) / 1024, 1),
+    }
+
+
+def worker_identity() -> Optional[Dict[str, Any]]:
+    """This worker's ID and PID, or None when not running under the pre-fork launcher"""
+    worker_id = os.getenv(WORKER_ID_ENV)
+    if worker_id is None:
+        return None
+    return {"id": int(worker_id), "pid": os.getpid()}
+
+
+def heartbeat_path(directory: str, worker_id: int) -> str:
+    return os.path.join(directory, f"worker-{worker_id}.json")
+
+
+def write_heartbeat(directory: str, worker_id: int, status: Dict[str, Any]):
+    path = heartbeat_path(directory, worker_id)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(status, f)
+    os.replace(tmp_path, path)
+
+
+def read_heartbeats(directory: str, stale_after: float = HEARTBEAT_INTERVAL * 3) -> List[Dict[str, Any]]:
+    """Latest status of every worker, marking ones whose heartbeat is older than stale_after"""
+    now = time.time()
+    heartbeats = []
+    for name in sorted(os.listdir(directory)):
+        if not (name.startswith("worker-") and name.endswith(".json")):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as f:
+                status = json.load(f)
+        except (OSError, ValueError):
+            continue
+        status["age_s"] = round(now - status.get("heartbeat_at", 0), 1)
+        status["alive"] = status.get("state") == "running" and status["age_s"] <= stale_after
+        heartbeats.append(status)
+    return heartbeats
+
+
+class WorkerHeartbeat:
+    """Writes this worker's status file on an interval from the event loop"""
+
+    def __init__(
+        self,
+        directory: str,
+        worker_id: int,
+        status_fn: Callable[[], Dict[str, Any]],
+        interval: float = HEARTBEAT_INTERVAL,
+    ):
+        self.directory = directory
+        self.worker_id = worker_id
+        self.status_fn = status_fn
+        self.interval = interval
+        self.started_at = time.time()
+        self._task: Optional[asyncio.Task] = None
+
+    @classmethod
+    def from_env(cls, status_fn: Callable[[], Dict[str, Any]]) -> Optional["WorkerHeartbeat"]:
+        """Heartbeat for a pre-forked worker, or None in single-process mode"""
+        identity = worker_identity()
+        directory = os.getenv(HEARTBEAT_DIR_ENV)
+        if identity is None or not directory:
+            return None
+        return cls(directory, identity["id"], status_fn)
+
+    def beat(self, state: str = "running"):
+        status = {
+            "id": self.worker_id,
+            "pid": os.getpid(),
+            "state": state,
+            "started_at": self.started_at,
+            "heartbeat_at": time.time(),
+            **memory_mb(),
+        }
+        try:
+            status.update(self.status_fn())
+            write_heartbeat(self.directory, self.worker_id, status)
+        except Exception as e:
+            logger.warning(f"Worker {self.worker_id} heartbeat failed: {e}")
+
+    async def start(self):
+        if self._task is not None:
+            return
+
+        async def run():
+            while True:
+                self.beat()
+                await asyncio.sleep(self.interval)
+
+        self._task = asyncio.get_running_loop().create_task(run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        self.beat("stopped")
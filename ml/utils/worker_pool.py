@@ -0,0 +1,110 @@
+"""
+Worker pool for CPU-heavy image work in the FastAPI services.
+
+PIL decode, preprocessing, the torch forward pass and response encoding are
+dispatched to a bounded thread pool so the event loop stays free for other
+requests (health checks included). torch releases the GIL inside its kernels,
+so threads scale well as long as intra-op threads are capped to avoid
+oversubscribing the CPU. An in-flight limit sheds load with 503 + Retry-After
+instead of queueing without bound.
+"""
+
+import asyncio
+import contextvars
+import functools
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerPoolSaturated(Exception):
+    """Raised when a request arrives while the pool is at its in-flight limit"""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Worker pool saturated, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class WorkerPool:
+    """Bounded thread pool with torch thread limits and admission control"""
+
+    def __init__(
+        self,
+        max_workers: Optional[int] = None,
+        torch_threads: Optional[int] = None,
+        max_in_flight: int = 64,
+        retry_after: int = 1,
+        name: str = "ml-worker",
+    ):
+        cpu_count = os.cpu_count() or 1
+        self.max_workers = max_workers or min(4, cpu_count)
+        self.torch_threads = torch_threads or max(1, cpu_count // self.max_workers)
+        self.max_in_flight = max_in_flight
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.rejected = 0
+
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=name)
+        self._apply_torch_threads()
+
+    @classmethod
+    def from_env(cls, name: str = "ml-worker") -> "WorkerPool":
+        """Build a pool from the ML_* environment variables"""
+        return cls(
+            max_workers=int(os.getenv("ML_WORKER_THREADS", "0")) or None,
+            torch_threads=int(os.getenv("ML_TORCH_THREADS", "0")) or None,
+            max_in_flight=int(os.getenv("ML_MAX_IN_FLIGHT", "64")),
+            retry_after=int(os.getenv("ML_RETRY_AFTER_SECONDS", "1")),
+            name=name,
+        )
+
+    def _apply_torch_threads(self):
+        try:
+            import torch
+        except ImportError:
+            return
+        # Every worker thread shares torch's intra-op pool, so cap it once here
+        torch.set_num_threads(self.torch_threads)
+        logger.info(
+            f"Worker pool: {self.max_workers} threads, torch intra-op threads={self.torch_threads}"
+        )
+
+    async def run(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """Run a blocking function in the pool and await its result"""
+        loop = asyncio.get_running_loop()
+        # Carry the caller's context (e.g. the request's stage timer) into the worker thread
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(self.executor, functools.partial(context.run, fn, *args, **kwargs))
+
+    def check_capacity(self):
+        """Raise WorkerPoolSaturated if the pool is at its in-flight limit"""
+        if self.in_flight >= self.max_in_flight:
+            self.rejected += 1
+            raise WorkerPoolSaturated(self.retry_after)
+
+    @asynccontextmanager
+    async def admit(self):
+        """Reserve an in-flight slot for one request or raise WorkerPoolSaturated"""
+        self.check_capacity()
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        """Pool counters for health and monitoring endpoints"""
+        return {
+            "max_workers": self.max_workers,
+            "torch_threads": self.torch_threads,
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "rejected": self.rejected,
+        }
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)